@@ -6,58 +6,334 @@ Created on Mon Jun 13 22:39:29 2022
 @author: alyabolowich
 """
 
+import os
+import io
+import csv
+import json
+import uuid
+import threading
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
-from flask import request, jsonify, Flask, render_template
-from markupsafe import escape
+import psycopg2.extensions
+import psycopg2.pool
+from flask import request, jsonify, Flask, render_template, Response, send_file, g
 from flask_caching import Cache
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 import config
+import queries
+import caching
+import cube
+import metrics
+import encoding
 #import config
 
 app = Flask(__name__)
 
 app.config['DEBUG'] = True
-app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = encoding.pretty_json
+app.json = encoding.FastJSONProvider(app)
 
 
+# Rows fetched per round-trip when streaming
+stream_batch_size = getattr(config, "stream_batch_size", 2000)
+
 cache = Cache(config={'CACHE_TYPE': 'simple'}) 
 cache.init_app(app)
 
+# Response cache, per worker or shared (see caching.responseCache())
+response_cache = caching.responseCache(app)
+
+# Memory-mapped emissions cube, when config.api_backend is "cube"
+cubes = cube.CubeStore() if cube.api_backend == "cube" else None
+
 #%% 
 @app.errorhandler(Exception)
-def response(status, data=None, message="OK"):
-    return jsonify({"status": status, "result": data, "message": message})
+def response(status, data=None, message="OK", **extra):
+    if status != 200:
+        # Errors are not given validators, see cacheHeaders()
+        g.no_store = True
+    metrics.addRows(metrics.countRows(data))
+    with metrics.phase("encode"):
+        if encoding.wantsColumnar(request.args):
+            data = encoding.columnar(data)
+        return jsonify(queries.envelope(status, data, message, **extra))
 
 #Error handler from pallets projects Flask documentation: https://flask.palletsprojects.com/en/1.1.x/patterns/errorpages/
 @app.errorhandler(404)
 def resource_404(e):
+    g.no_store = True
     return jsonify({"status": 404, "result": None, "message": "Not found. The URL is not valid, please verify the URL is correct."})
 
 @app.errorhandler(500)
 def resource_500(e):
+    g.no_store = True
     return jsonify({"status": 500, "result": None, "message": e})
 
-#%% Singleton to create connection
+#%% Instrumentation
+
+class TimedCursor(psycopg2.extras.DictCursor):
+    ''' DictCursor that adds the time spent executing queries and fetching
+    rows to the metrics of the current request. '''
+
+    def execute(self, query, vars=None):
+        with metrics.phase("execute"):
+            return super().execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        with metrics.phase("execute"):
+            return super().copy_expert(sql, file, size)
+
+    def fetchone(self):
+        with metrics.phase("fetch"):
+            return super().fetchone()
+
+    def fetchmany(self, size=None):
+        with metrics.phase("fetch"):
+            return super().fetchmany(size)
+
+    def fetchall(self):
+        with metrics.phase("fetch"):
+            return super().fetchall()
+
+    def executePrepared(self, query, vars=None):
+        ''' Run a query from queries.buildEmissionsQuery() as a server-side
+        prepared statement (see queries.prepareStatement()). It is prepared
+        the first time its connection sees it, and only EXECUTEd afterwards,
+        which skips parsing and planning. When a new dataset is loaded, the
+        connection's statements are deallocated and prepared again. '''
+
+        con     = self.connection
+        version = queries.datasetVersion()
+        if con.version != version:
+            if con.prepared:
+                self.execute("DEALLOCATE ALL;")
+            con.prepared, con.version = set(), version
+
+        name, text = queries.prepareStatement(query)
+        if name not in con.prepared:
+            self.execute("PREPARE {} AS {};".format(name, text))
+            con.prepared.add(name)
+
+        arguments = "({})".format(", ".join(["%s"] * len(vars))) if vars else ""
+        return self.execute("EXECUTE {}{};".format(name, arguments), vars)
+
+@app.before_request
+def startTiming():
+    metrics.startRequest()
+
+@app.after_request
+def finishTiming(resp):
+    # Streamed bodies have no length yet, only their time to first byte is seen
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.finishRequest(route, resp.status_code, resp.content_length)
+    return resp
+
+#%% Compression
+
+@app.after_request
+def compressBody(resp):
+    ''' gzip or brotli compress JSON, CSV and NDJSON bodies for clients
+    that accept it. Files and streamed bodies are sent as they are. '''
+    if (resp.status_code not in (200, 304) or resp.direct_passthrough or resp.is_streamed
+            or "Content-Encoding" in resp.headers):
+        return resp
+
+    coding = encoding.negotiate(request.headers.get("Accept-Encoding"))
+    if resp.status_code == 304:
+        # Same validator and Vary as the 200 the client holds
+        if "ETag" in resp.headers:
+            resp.headers["ETag"] = encoding.revalidatedETag(resp.headers["ETag"],
+                                                            request.headers.get("If-None-Match"), coding)
+        resp.vary.add("Accept-Encoding")
+        return resp
+    if not encoding.compressible(resp.mimetype, resp.content_length):
+        return resp
+
+    resp.vary.add("Accept-Encoding")
+    if coding is None:
+        return resp
+
+    with metrics.phase("encode"):
+        resp.set_data(encoding.compress(resp.get_data(), coding))
+    resp.headers["Content-Encoding"] = coding
+    if "ETag" in resp.headers:
+        resp.headers["ETag"] = encoding.variantETag(resp.headers["ETag"], coding)
+    return resp
+
+#%% Conditional requests
+
+@app.before_request
+def notModified():
+    ''' Answer 304 Not Modified, before any query runs, when the client
+    already holds the response for the current dataset version. '''
+    if not queries.cacheable(request.method, request.path):
+        return None
+
+    g.validators = queries.validators(request.path, request.args.items(multi=True))
+    if queries.notModified(*g.validators, request.headers.get("If-None-Match"),
+                           request.headers.get("If-Modified-Since")):
+        return Response(status=304)
+
+@app.after_request
+def cacheHeaders(resp):
+    ''' ETag, Last-Modified and Cache-Control on cacheable responses, so
+    clients and proxies can revalidate or reuse them. '''
+    validators = g.get("validators")
+    if validators is None:
+        return resp
+
+    if resp.status_code == 304 or (resp.status_code == 200 and not g.get("no_store")):
+        etag, last_modified = validators
+        resp.headers["ETag"] = etag
+        if last_modified:
+            resp.headers["Last-Modified"] = last_modified
+        resp.headers["Cache-Control"] = queries.cache_control
+    else:
+        resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+#%% Connection pool
+
+class PreparingConnection(psycopg2.extensions.connection):
+    ''' Connection keeping track of the statements prepared on it, and of
+    the dataset version they were prepared for (see
+    TimedCursor.executePrepared()). '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.version  = None
+
+class ConnectionPool:
+    ''' Thread-safe pool of Postgres connections shared by every request.
+
+    Each request checks out its own connection and returns it when done, so
+    queries from different worker threads run side by side instead of
+    queueing on one socket. Connections are pinged on checkout and broken
+    ones are discarded and replaced, so one failed transaction cannot poison
+    the connection for everyone else.
+
+    Pool size is read from config.db_pool ({"minconn": 1, "maxconn": 10} by
+    default). '''
 
-class Connection:
     __instance = None
-    
-    def __init__(self):
-        self.cur = self.get_con()  
-        
+    __lock = threading.Lock()
+
     def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = object.__new__(cls)
+        # One pool per process, created lazily on first use
+        with cls.__lock:
+            if cls.__instance is None:
+                instance = object.__new__(cls)
+                instance.setup()
+                cls.__instance = instance
         return cls.__instance
-            
-    def get_con(self):
-        con = psycopg2.connect(#database="bsp5", user="postgres", password="5555", host="localhost")
-                               database = config.db_connection["database"], 
-                               user     = config.db_connection["user"], 
-                               password = config.db_connection["password"], 
-                               host     = config.db_connection["host"])
-        cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        return cur
+
+    def setup(self):
+        pool_config  = getattr(config, "db_pool", {})
+        self.minconn = pool_config.get("minconn", 1)
+        self.maxconn = pool_config.get("maxconn", 10)
+
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.minconn,
+                        self.maxconn,
+                        database = config.db_connection["database"],
+                        user     = config.db_connection["user"],
+                        password = config.db_connection["password"],
+                        host     = config.db_connection["host"],
+                        options  = queries.connectionOptions(),
+                        connection_factory = PreparingConnection)
+
+        # psycopg2 raises PoolError when the pool is exhausted; the semaphore
+        # makes requests wait for a free connection instead.
+        self.available = threading.BoundedSemaphore(self.maxconn)
+
+    def isAlive(self, con):
+        ''' Liveness check run on every checkout. '''
+        if con.closed:
+            return False
+        try:
+            with con.cursor() as cur:
+                cur.execute('SELECT 1;')
+            con.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def checkout(self):
+        ''' Get a live connection from the pool, reconnecting if the pooled
+        one has gone away. '''
+        self.available.acquire()
+        try:
+            con = self.pool.getconn()
+            if not self.isAlive(con):
+                # Closing it frees the slot and getconn() opens a new one
+                self.pool.putconn(con, close=True)
+                con = self.pool.getconn()
+        except Exception:
+            self.available.release()
+            raise
+        return con
+
+    def checkin(self, con, broken=False):
+        ''' Return a connection to the pool. Broken connections are closed
+        and replaced on the next checkout. '''
+        try:
+            if not broken and not con.closed:
+                # End the read transaction so the connection goes back clean
+                con.rollback()
+            self.pool.putconn(con, close=broken or bool(con.closed))
+        finally:
+            self.available.release()
+
+    @contextmanager
+    def cursor(self, name=None):
+        ''' Check out a connection for the duration of a request and yield a
+        DictCursor on it. Giving a name opens a server-side cursor, which
+        fetches rows in batches of cursor.itersize as they are iterated. '''
+        con = self.checkout()
+        broken = False
+        try:
+            with con.cursor(name=name, cursor_factory=TimedCursor) as cur:
+                yield cur
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            try:
+                con.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            self.checkin(con, broken)
+
+def loadDimensions():
+    ''' Load the dimension lookup once per dataset version: the name -> key
+    map of the partitioned layout, and the regions, stressors and sectors
+    requests are validated against. '''
+    if not queries.dimensions.loaded():
+        with ConnectionPool().cursor() as cur:
+            try:
+                queries.dimensions.load(cur)
+            except psycopg2.errors.UndefinedTable:
+                if queries.storage_layout == "partitioned":
+                    raise
+                # Regional tables loaded before the dimension tables existed,
+                # requests are not validated
+                queries.dimensions.update(None, queries.datasetVersion())
+
+# Validation sets are loaded at startup, or on the first request when the
+# database is not reachable yet
+if cubes is None:
+    try:
+        loadDimensions()
+    except Exception as e:
+        print("Dimensions not loaded at startup: {}".format(e))
 
 #%%
 @app.route('/')
@@ -73,12 +349,12 @@ def home():
 @app.route('/v1/sectors')
 def allsectors():
     try:
-        con = Connection()
-        con.cur.execute('SELECT * from sectors;')
+        with ConnectionPool().cursor() as cur:
+            cur.execute('SELECT * from sectors;')
+            record = cur.fetchall()
     except Exception as e:
         return resource_500(str(e))
-    
-    record = con.cur.fetchall()
+
     record = [dict(row) for row in record]
     return response(200, record)
 
@@ -87,12 +363,12 @@ def allsectors():
 @app.route('/v1/regions')
 def allregions():
     try:
-        con = Connection()
-        con.cur.execute('SELECT * from regions;')
+        with ConnectionPool().cursor() as cur:
+            cur.execute('SELECT * from regions;')
+            record = cur.fetchall()
     except Exception as e:
         return resource_500(str(e))
 
-    record = con.cur.fetchall()
     record = [dict(row) for row in record]
     return response(200, record)
 
@@ -102,102 +378,303 @@ def allregions():
 @app.route('/v1/<lens>/<region>')
 def dcba(lens, region): 
 
-    if lens == "consumption":
-        query = 'SELECT * FROM "{}_dcba" WHERE'.format(escape(region)) 
- 
-    elif lens == "production":
-        query = 'SELECT * FROM "{}_dpba" WHERE'.format(escape(region)) 
-    
     year     = request.args.get('year', type=int)
     stressor = request.args.get('stressor', "").lower() 
     sector   = request.args.get('sector', "").lower() 
 
-    #query = 'SELECT * FROM "{}_dcba" WHERE'.format(escape(region)) 
-    to_filter       = []
-    
-    region = region.lower()    
-    if not region:
-        return response(400, message="Bad request - Looks like you need to provide a stressor. Please check you have provided the correect two-letter code.")
-     
-    if year:
-        query += ' year=%s AND'
-        to_filter.append(year)
-    if stressor:
-        query += ' stressor=%s AND'
-        to_filter.append(stressor)
-    if sector:
-        query += ' sector=%s AND'
-        to_filter.append(sector)
-
-          
-    if not (year or stressor or sector):
-        return response(400, message="Bad request - Please check that you have at least provided a year(s), sector(s), or stressor(s).")
-    
-    query = query[:-4] + 'LIMIT 10;'
-    
+    key    = response_cache.key(queries.datasetVersion(), "dcba", lens, region.lower(), year, stressor, sector)
+    record = response_cache.get("dcba", key)
+    if record is not None:
+        return response(200, record)
+
     try:
-        con = Connection()
-        con.cur.execute(query, to_filter)
+        if cubes is not None:
+            record = cubes.emissions(lens, region, year, stressor, sector, limit=10)
+        else:
+            loadDimensions()
+            query, to_filter = queries.buildEmissionsQuery(lens, region, year, stressor, sector, limit=10)
+            with ConnectionPool().cursor() as cur:
+                cur.executePrepared(query, to_filter)
+                record = [dict(row) for row in cur.fetchall()]
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
     except Exception as e:
         return resource_500(str(e))
     
-        
-    record = con.cur.fetchall() 
-    record = [dict(row) for row in record]
-    
     if not record:
         return response(400, message="Bad request - Please check that your  query is correctly entered.")
     
+    response_cache.set(key, record)
     return response(200, record)
 
 
+#%%
+# Stream rows as they arrive from a server-side cursor
+
+stream_types = {"ndjson": "application/x-ndjson",
+                "csv":    "text/csv"}
+
+def formatRows(batches, fmt):
+    ''' Generator yielding batches of rows as NDJSON or CSV, one chunk per
+    batch. '''
+
+    header = fmt == "csv"
+    for rows in batches:
+        if fmt == "csv":
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            if header:
+                writer.writerow(rows[0].keys())
+                header = False
+            writer.writerows(row.values() for row in rows)
+            yield buf.getvalue()
+        else:
+            yield encoding.ndjsonLines(rows)
+
+
+def streamRows(query, to_filter, fmt):
+    ''' Generator yielding the rows of query as NDJSON or CSV, one chunk per
+    batch fetched from the server-side cursor, so memory stays flat however
+    many rows match. '''
+
+    with ConnectionPool().cursor(name="stream_{}".format(uuid.uuid4().hex)) as cur:
+        cur.itersize = stream_batch_size
+        cur.execute(query, to_filter)
+
+        yield from formatRows(iter(lambda: cur.fetchmany(stream_batch_size), []), fmt)
+
 #%%
 # Get DPBA data
 @app.route('/v1/production/<region>')
 def dpba(region): 
+    ''' Production-based emissions, one page at a time. Pass the next_cursor
+    of a page as ?cursor= to get the following one, or ?stream=ndjson|csv to
+    stream every matching row. '''
         
     year     = request.args.get('year', type=int)
     stressor = request.args.get('stressor', "").lower() 
     sector   = request.args.get('sector', "").lower() 
+    stream   = request.args.get('stream', "").lower()
+    token    = request.args.get('cursor', "")
+
+    if cubes is None:
+        try:
+            loadDimensions()
+        except Exception as e:
+            return resource_500(str(e))
+
+    try:
+        if stream:
+            if stream not in stream_types:
+                raise queries.QueryError("Bad request - stream must be one of: {}.".format(", ".join(stream_types)))
+            if cubes is not None:
+                rows = cubes.emissions("production", region, year, stressor, sector)
+                return Response(formatRows(cube.batched(rows, stream_batch_size), stream), mimetype=stream_types[stream])
+            query, to_filter = queries.buildEmissionsQuery("production", region, year, stressor, sector)
+            return Response(streamRows(query, to_filter, stream), mimetype=stream_types[stream])
+
+        limit = queries.pageSize(request.args.get('limit', type=int))
+        after = queries.decodeCursor(token)
+        if cubes is None:
+            query, to_filter = queries.buildEmissionsQuery("production", region, year, stressor, sector,
+                                                           limit=limit + 1, after=after, ordered=True)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+
+    key    = response_cache.key(queries.datasetVersion(), "dpba", region.lower(), year, stressor, sector, limit, token)
+    cached = response_cache.get("dpba", key)
+    if cached is not None:
+        record, next_cursor = cached
+        return response(200, record, next_cursor=next_cursor)
 
-    query = 'SELECT * FROM "{}_dpba" WHERE'.format(escape(region)) 
-    to_filter       = []
-    
-    region = region.lower()    
-    if not region:
-        return response(400, message="Bad request - Looks like you need to provide a stressor. Please check you have provided the correect two-letter code.")
-     
-    if year:
-        query += ' year=%s AND'
-        to_filter.append(year)
-    if stressor:
-        query += ' stressor=%s AND'
-        to_filter.append(stressor)
-    if sector:
-        query += ' sector=%s AND'
-        to_filter.append(sector)
-
-          
-    if not (year or stressor or sector):
-        return response(400, message="Bad request - Please check that you have at least provided a year(s), sector(s), or stressor(s).")
-    
-    query = query[:-4] + ';'
-    
     try:
-        con = Connection()
-        con.cur.execute(query, to_filter)
+        if cubes is not None:
+            record = cubes.emissions("production", region, year, stressor, sector,
+                                     limit=limit + 1, after=after, ordered=True)
+        else:
+            with ConnectionPool().cursor() as cur:
+                cur.executePrepared(query, to_filter)
+                record = [dict(row) for row in cur.fetchall()]
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
     except Exception as e:
         return resource_500(str(e))
     
-        
-    record = con.cur.fetchall() 
-    record = [dict(row) for row in record]
-    
     if not record:
         return response(400, message="Bad request - Please check that your  query is correctly entered.") 
     
+    record, next_cursor = queries.splitPage(record, limit)
+
+    response_cache.set(key, (record, next_cursor))
+    return response(200, record, next_cursor=next_cursor)
+
+
+#%%
+# Columnar export of a region
+
+def exportTable(query, to_filter):
+    ''' Read the rows of query into an Arrow table. Postgres writes them as
+    CSV with COPY and Arrow parses the CSV in bulk, so no Python object is
+    made per row. '''
+
+    with ConnectionPool().cursor() as cur:
+        sql = cur.mogrify(query.rstrip(';'), to_filter).decode("utf-8")
+        buf = io.BytesIO()
+        cur.copy_expert("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)".format(sql), buf)
+
+    with metrics.phase("fetch"):
+        return queries.readExportCSV(buf.getvalue())
+
+
+@app.route('/v1/<lens>/<region>/export')
+def export(lens, region):
+    ''' Whole region (or region-year) as a compressed Parquet or Arrow file.
+    Region-years pre-built by data_download.py are served from disk. '''
+
+    fmt  = request.args.get('format', "parquet").lower()
+    year = request.args.get('year', type=int)
+
+    if pyarrow is None:
+        return response(501, message="Not implemented - pyarrow is not installed on this server.")
+    if fmt not in queries.export_types:
+        return response(400, message="Bad request - format must be one of: {}.".format(", ".join(queries.export_types)))
+
+    try:
+        tblext = queries.tableExtension(lens)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+
+    filename = "{}_{}{}.{}".format(region.lower(), lens, "_{}".format(year) if year else "", queries.export_formats[fmt])
+
+    if year:
+        path = queries.exportPath(queries.currentDOI(), tblext, region, year, fmt)
+        if os.path.exists(path):
+            return send_file(path, mimetype=queries.export_types[fmt], as_attachment=True, download_name=filename)
+
+    try:
+        loadDimensions()
+        query, to_filter = queries.buildExportQuery(lens, region, year)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+    except Exception as e:
+        return resource_500(str(e))
+
+    try:
+        table = exportTable(query, to_filter)
+    except Exception as e:
+        return resource_500(str(e))
+
+    if table.num_rows == 0:
+        return response(400, message="Bad request - Please check that your  query is correctly entered.")
+
+    metrics.addRows(table.num_rows)
+    with metrics.phase("encode"):
+        data = queries.exportBytes(table, fmt)
+
+    return send_file(io.BytesIO(data), mimetype=queries.export_types[fmt],
+                     as_attachment=True, download_name=filename)
+
+#%%
+# Totals and shares from the materialised views
+
+@app.route('/v1/<lens>/aggregate/<by>')
+def aggregate(lens, by):
+    ''' Totals of a stressor summed over sectors (by=region), over regions
+    (by=sector) or over region groups such as EU27 vs rest of world
+    (by=group), each with its share of the overall total. Filter with
+    ?stressor=, ?year= and ?member= (one region, sector or group). '''
+
+    year     = request.args.get('year', type=int)
+    stressor = request.args.get('stressor', "").lower()
+    member   = request.args.get('member', "").lower()
+
+    try:
+        loadDimensions()
+        query, to_filter = queries.buildAggregateQuery(lens, by, stressor, year, member)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+    except Exception as e:
+        return resource_500(str(e))
+
+    key    = response_cache.key(queries.datasetVersion(), "aggregate", lens, by, year, stressor, member)
+    record = response_cache.get("aggregate", key)
+    if record is not None:
+        return response(200, record)
+
+    try:
+        with ConnectionPool().cursor() as cur:
+            cur.execute(query, to_filter)
+            record = cur.fetchall()
+    except Exception as e:
+        return resource_500(str(e))
+
+    record = [dict(row) for row in record]
+
+    if not record:
+        return response(400, message="Bad request - Please check that your  query is correctly entered.")
+
+    response_cache.set(key, record)
     return response(200, record)
 
+#%%
+# Many regions, lenses and filters in one request
+
+@app.route('/v1/batch', methods=['POST'])
+def batch():
+    ''' Answer a whole comparison in one request and one SQL round-trip. The
+    JSON body lists lenses, regions, years, stressors and sectors (see
+    queries.parseBatch()). Rows are grouped by lens and region, and at most
+    config.batch_row_cap rows are returned. '''
+
+    if cubes is None:
+        try:
+            loadDimensions()
+        except Exception as e:
+            return resource_500(str(e))
+
+    try:
+        body = queries.parseBatch(request.get_json(silent=True))
+        if cubes is None:
+            query, to_filter = queries.buildBatchQuery(body, limit=queries.batch_row_cap + 1)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+
+    key    = response_cache.key(queries.datasetVersion(), "batch", json.dumps(body, sort_keys=True))
+    cached = response_cache.get("batch", key)
+    if cached is not None:
+        grouped, truncated = cached
+        return response(200, grouped, truncated=truncated)
+
+    try:
+        if cubes is not None:
+            record = cubes.batch(body, limit=queries.batch_row_cap + 1)
+        else:
+            with ConnectionPool().cursor() as cur:
+                cur.execute(query, to_filter)
+                record = [dict(row) for row in cur.fetchall()]
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+    except Exception as e:
+        return resource_500(str(e))
+
+    grouped, truncated = queries.groupBatch(body, record)
+
+    response_cache.set(key, (grouped, truncated))
+    return response(200, grouped, truncated=truncated)
+
+#%%
+# Response cache hit/miss counters
+@app.route('/v1/cache')
+def cachestats():
+    return response(200, {"version": queries.datasetVersion(),
+                          "routes":  response_cache.stats()})
+
+#%%
+# Prometheus metrics of this worker and of the last ingest
+@app.route('/metrics')
+def prometheus():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 
 #%% Run file
 if __name__ == "__main__":
@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:21:35 2026
+
+@author: alyabolowich
+
+Asynchronous serving mode of the API. Exposes the same /v1 routes as
+app.py, with the same JSON envelopes, but runs on asyncio with an async
+Postgres pool, so one process can have hundreds of queries in flight. The
+SQL is built by queries.py, shared with the Flask app.
+
+Run with an ASGI server, e.g.:
+
+    hypercorn asgi:app
+"""
+
+import os
+import io
+import csv
+import json
+import uuid
+import asyncio
+from quart import Quart, request, jsonify, render_template, Response, send_file, g
+import psycopg.errors
+from psycopg import AsyncConnection
+from psycopg.rows import dict_row
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+import config
+import queries
+import caching
+import cube
+import metrics
+import encoding
+
+app = Quart(__name__)
+
+app.json = encoding.FastJSONProvider(app)
+
+stream_batch_size = getattr(config, "stream_batch_size", 2000)
+
+# Response cache, per worker or shared (see caching.responseCache())
+response_cache = caching.responseCache(app)
+
+# Memory-mapped emissions cube, when config.api_backend is "cube"
+cubes = cube.CubeStore() if cube.api_backend == "cube" else None
+
+#%% Async connection pool
+
+pool_config = getattr(config, "async_pool", {})
+
+class PreparingConnection(AsyncConnection):
+    ''' Connection remembering the dataset version its prepared statements
+    were prepared for, see fetchall(). '''
+    version = None
+
+pool = AsyncConnectionPool(make_conninfo(dbname   = config.db_connection["database"],
+                                         user     = config.db_connection["user"],
+                                         password = config.db_connection["password"],
+                                         host     = config.db_connection["host"],
+                                         port     = config.db_connection.get("port", 5432),
+                                         options  = queries.connectionOptions()),
+                           min_size = pool_config.get("min_size", 1),
+                           max_size = pool_config.get("max_size", 50),
+                           kwargs   = {"row_factory": dict_row},
+                           connection_class = PreparingConnection,
+                           check    = AsyncConnectionPool.check_connection,
+                           open     = False)
+
+@app.before_serving
+async def openPool():
+    await pool.open()
+    # Validation sets are loaded at startup, or on the first request when
+    # the database is not reachable yet
+    if cubes is None:
+        try:
+            await loadDimensions()
+        except Exception as e:
+            print("Dimensions not loaded at startup: {}".format(e))
+
+@app.after_serving
+async def closePool():
+    await pool.close()
+
+
+async def fetchall(query, to_filter, prepare=None):
+    ''' Run query on a pooled connection and return all rows as dicts.
+
+    With prepare=True the query (from queries.buildEmissionsQuery()) is
+    prepared on the server the first time the connection runs it, and only
+    executed afterwards. psycopg keeps the statements per connection; they
+    are deallocated when a new dataset is loaded. '''
+    async with pool.connection() as con:
+        if prepare and con.version != queries.datasetVersion():
+            # psycopg forgets its own statements on DEALLOCATE ALL too
+            await con.execute("DEALLOCATE ALL;")
+            con.version = queries.datasetVersion()
+        async with con.cursor() as cur:
+            with metrics.phase("execute"):
+                await cur.execute(query, to_filter, prepare=prepare)
+            with metrics.phase("fetch"):
+                return await cur.fetchall()
+
+
+async def loadDimensions():
+    ''' Async counterpart of app.loadDimensions(). '''
+    if not queries.dimensions.loaded():
+        version = queries.datasetVersion()
+        keys = {}
+        try:
+            for dim, table in queries.Dimensions.tables.items():
+                rows = await fetchall("SELECT name, id FROM {};".format(table), [])
+                keys[dim] = {row["name"]: row["id"] for row in rows}
+        except psycopg.errors.UndefinedTable:
+            if queries.storage_layout == "partitioned":
+                raise
+            # Regional tables loaded before the dimension tables existed,
+            # requests are not validated
+            keys = None
+        queries.dimensions.update(keys, version)
+
+#%% Envelope and errors
+
+def response(status, data=None, message="OK", **extra):
+    if status != 200:
+        g.no_store = True
+    metrics.addRows(metrics.countRows(data))
+    with metrics.phase("encode"):
+        if encoding.wantsColumnar(request.args):
+            data = encoding.columnar(data)
+        return jsonify(queries.envelope(status, data, message, **extra))
+
+@app.before_request
+async def startTiming():
+    metrics.startRequest()
+
+@app.after_request
+async def finishTiming(resp):
+    # All requests share the event loop thread, so profiler samples of a
+    # slow request may include others running at the same time
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.finishRequest(route, resp.status_code, resp.content_length)
+    return resp
+
+@app.errorhandler(404)
+async def resource_404(e):
+    g.no_store = True
+    return jsonify({"status": 404, "result": None, "message": "Not found. The URL is not valid, please verify the URL is correct."})
+
+def resource_500(e):
+    g.no_store = True
+    return jsonify({"status": 500, "result": None, "message": e})
+
+#%% Compression, see app.compressBody()
+
+@app.after_request
+async def compressBody(resp):
+    # Only bodies held in memory, not files or streams
+    if (resp.status_code not in (200, 304) or not isinstance(resp.response, resp.data_body_class)
+            or "Content-Encoding" in resp.headers):
+        return resp
+
+    coding = encoding.negotiate(request.headers.get("Accept-Encoding"))
+    if resp.status_code == 304:
+        # Same validator and Vary as the 200 the client holds
+        if "ETag" in resp.headers:
+            resp.headers["ETag"] = encoding.revalidatedETag(resp.headers["ETag"],
+                                                            request.headers.get("If-None-Match"), coding)
+        resp.vary.add("Accept-Encoding")
+        return resp
+    if not encoding.compressible(resp.mimetype, resp.content_length):
+        return resp
+
+    resp.vary.add("Accept-Encoding")
+    if coding is None:
+        return resp
+
+    data = await resp.get_data()
+    with metrics.phase("encode"):
+        # Large bodies are compressed off the event loop
+        if len(data) > 1 << 20:
+            data = await asyncio.to_thread(encoding.compress, data, coding)
+        else:
+            data = encoding.compress(data, coding)
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = coding
+    if "ETag" in resp.headers:
+        resp.headers["ETag"] = encoding.variantETag(resp.headers["ETag"], coding)
+    return resp
+
+#%% Conditional requests, see app.notModified() and app.cacheHeaders()
+
+@app.before_request
+async def notModified():
+    if not queries.cacheable(request.method, request.path):
+        return None
+
+    g.validators = queries.validators(request.path, request.args.items(multi=True))
+    if queries.notModified(*g.validators, request.headers.get("If-None-Match"),
+                           request.headers.get("If-Modified-Since")):
+        return Response("", status=304)
+
+@app.after_request
+async def cacheHeaders(resp):
+    validators = g.get("validators")
+    if validators is None:
+        return resp
+
+    if resp.status_code == 304 or (resp.status_code == 200 and not g.get("no_store")):
+        etag, last_modified = validators
+        resp.headers["ETag"] = etag
+        if last_modified:
+            resp.headers["Last-Modified"] = last_modified
+        resp.headers["Cache-Control"] = queries.cache_control
+    else:
+        resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+#%%
+@app.route('/')
+async def index():
+    return "My page"
+
+@app.route('/v1', methods=['GET'])
+async def home():
+    return await render_template("index.html")
+
+#%%
+# Show all sectors and regions
+@app.route('/v1/sectors')
+async def allsectors():
+    try:
+        record = await fetchall('SELECT * from sectors;', [])
+    except Exception as e:
+        return resource_500(str(e))
+    return response(200, record)
+
+@app.route('/v1/regions')
+async def allregions():
+    try:
+        record = await fetchall('SELECT * from regions;', [])
+    except Exception as e:
+        return resource_500(str(e))
+    return response(200, record)
+
+#%%
+# Get DCBA data
+@app.route('/v1/<lens>/<region>')
+async def dcba(lens, region):
+
+    year     = request.args.get('year', type=int)
+    stressor = request.args.get('stressor', "").lower()
+    sector   = request.args.get('sector', "").lower()
+
+    key    = response_cache.key(queries.datasetVersion(), "dcba", lens, region.lower(), year, stressor, sector)
+    record = response_cache.get("dcba", key)
+    if record is not None:
+        return response(200, record)
+
+    try:
+        if cubes is not None:
+            record = cubes.emissions(lens, region, year, stressor, sector, limit=10)
+        else:
+            await loadDimensions()
+            query, to_filter = queries.buildEmissionsQuery(lens, region, year, stressor, sector, limit=10)
+            record = await fetchall(query, to_filter, prepare=True)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+    except Exception as e:
+        return resource_500(str(e))
+
+    if not record:
+        return response(400, message="Bad request - Please check that your  query is correctly entered.")
+
+    response_cache.set(key, record)
+    return response(200, record)
+
+#%%
+# Stream rows as they arrive from a server-side cursor
+
+stream_types = {"ndjson": "application/x-ndjson",
+                "csv":    "text/csv"}
+
+def formatBatch(rows, fmt, header):
+    ''' One batch of rows as NDJSON or CSV, see app.formatRows(). '''
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if header:
+            writer.writerow(rows[0].keys())
+        writer.writerows(row.values() for row in rows)
+        return buf.getvalue()
+    return encoding.ndjsonLines(rows)
+
+
+async def streamRows(query, to_filter, fmt):
+    ''' Async counterpart of app.streamRows(). '''
+    async with pool.connection() as con:
+        async with con.cursor(name="stream_{}".format(uuid.uuid4().hex)) as cur:
+            await cur.execute(query, to_filter)
+
+            header = fmt == "csv"
+            while True:
+                rows = await cur.fetchmany(stream_batch_size)
+                if not rows:
+                    break
+                yield formatBatch(rows, fmt, header)
+                header = False
+
+
+async def streamCube(rows, fmt):
+    ''' Stream rows of the cube, giving the event loop a turn between
+    batches. '''
+    header = fmt == "csv"
+    for batch in cube.batched(rows, stream_batch_size):
+        yield formatBatch(batch, fmt, header)
+        header = False
+        await asyncio.sleep(0)
+
+#%%
+# Get DPBA data
+@app.route('/v1/production/<region>')
+async def dpba(region):
+
+    year     = request.args.get('year', type=int)
+    stressor = request.args.get('stressor', "").lower()
+    sector   = request.args.get('sector', "").lower()
+    stream   = request.args.get('stream', "").lower()
+    token    = request.args.get('cursor', "")
+
+    if cubes is None:
+        try:
+            await loadDimensions()
+        except Exception as e:
+            return resource_500(str(e))
+
+    try:
+        if stream:
+            if stream not in stream_types:
+                raise queries.QueryError("Bad request - stream must be one of: {}.".format(", ".join(stream_types)))
+            if cubes is not None:
+                rows = cubes.emissions("production", region, year, stressor, sector)
+                return Response(streamCube(rows, stream), mimetype=stream_types[stream])
+            query, to_filter = queries.buildEmissionsQuery("production", region, year, stressor, sector)
+            return Response(streamRows(query, to_filter, stream), mimetype=stream_types[stream])
+
+        limit = queries.pageSize(request.args.get('limit', type=int))
+        after = queries.decodeCursor(token)
+        if cubes is None:
+            query, to_filter = queries.buildEmissionsQuery("production", region, year, stressor, sector,
+                                                           limit=limit + 1, after=after, ordered=True)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+
+    key    = response_cache.key(queries.datasetVersion(), "dpba", region.lower(), year, stressor, sector, limit, token)
+    cached = response_cache.get("dpba", key)
+    if cached is not None:
+        record, next_cursor = cached
+        return response(200, record, next_cursor=next_cursor)
+
+    try:
+        if cubes is not None:
+            record = cubes.emissions("production", region, year, stressor, sector,
+                                     limit=limit + 1, after=after, ordered=True)
+        else:
+            record = await fetchall(query, to_filter, prepare=True)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+    except Exception as e:
+        return resource_500(str(e))
+
+    if not record:
+        return response(400, message="Bad request - Please check that your  query is correctly entered.")
+
+    record, next_cursor = queries.splitPage(record, limit)
+
+    response_cache.set(key, (record, next_cursor))
+    return response(200, record, next_cursor=next_cursor)
+
+#%%
+# Columnar export of a region
+@app.route('/v1/<lens>/<region>/export')
+async def export(lens, region):
+
+    fmt  = request.args.get('format', "parquet").lower()
+    year = request.args.get('year', type=int)
+
+    if pyarrow is None:
+        return response(501, message="Not implemented - pyarrow is not installed on this server.")
+    if fmt not in queries.export_types:
+        return response(400, message="Bad request - format must be one of: {}.".format(", ".join(queries.export_types)))
+
+    try:
+        tblext = queries.tableExtension(lens)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+
+    filename = "{}_{}{}.{}".format(region.lower(), lens, "_{}".format(year) if year else "", queries.export_formats[fmt])
+
+    if year:
+        path = queries.exportPath(queries.currentDOI(), tblext, region, year, fmt)
+        if os.path.exists(path):
+            return await send_file(path, mimetype=queries.export_types[fmt], as_attachment=True, attachment_filename=filename)
+
+    try:
+        await loadDimensions()
+        query, to_filter = queries.buildExportQuery(lens, region, year)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+    except Exception as e:
+        return resource_500(str(e))
+
+    try:
+        buf = bytearray()
+        async with pool.connection() as con:
+            async with con.cursor() as cur:
+                sql = "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)".format(query.rstrip(';'))
+                with metrics.phase("execute"):
+                    async with cur.copy(sql, to_filter) as copy:
+                        async for data in copy:
+                            buf += data
+        # Arrow work is CPU-bound, keep it off the event loop
+        with metrics.phase("fetch"):
+            table = await asyncio.to_thread(queries.readExportCSV, bytes(buf))
+        with metrics.phase("encode"):
+            data  = await asyncio.to_thread(queries.exportBytes, table, fmt)
+        metrics.addRows(table.num_rows)
+    except Exception as e:
+        return resource_500(str(e))
+
+    if table.num_rows == 0:
+        return response(400, message="Bad request - Please check that your  query is correctly entered.")
+
+    return await send_file(io.BytesIO(data), mimetype=queries.export_types[fmt],
+                           as_attachment=True, attachment_filename=filename)
+
+#%%
+# Totals and shares from the materialised views
+@app.route('/v1/<lens>/aggregate/<by>')
+async def aggregate(lens, by):
+
+    year     = request.args.get('year', type=int)
+    stressor = request.args.get('stressor', "").lower()
+    member   = request.args.get('member', "").lower()
+
+    try:
+        await loadDimensions()
+        query, to_filter = queries.buildAggregateQuery(lens, by, stressor, year, member)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+    except Exception as e:
+        return resource_500(str(e))
+
+    key    = response_cache.key(queries.datasetVersion(), "aggregate", lens, by, year, stressor, member)
+    record = response_cache.get("aggregate", key)
+    if record is not None:
+        return response(200, record)
+
+    try:
+        record = await fetchall(query, to_filter)
+    except Exception as e:
+        return resource_500(str(e))
+
+    if not record:
+        return response(400, message="Bad request - Please check that your  query is correctly entered.")
+
+    response_cache.set(key, record)
+    return response(200, record)
+
+#%%
+# Many regions, lenses and filters in one request
+@app.route('/v1/batch', methods=['POST'])
+async def batch():
+
+    if cubes is None:
+        try:
+            await loadDimensions()
+        except Exception as e:
+            return resource_500(str(e))
+
+    try:
+        body = queries.parseBatch(await request.get_json(silent=True))
+        if cubes is None:
+            query, to_filter = queries.buildBatchQuery(body, limit=queries.batch_row_cap + 1)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+
+    key    = response_cache.key(queries.datasetVersion(), "batch", json.dumps(body, sort_keys=True))
+    cached = response_cache.get("batch", key)
+    if cached is not None:
+        grouped, truncated = cached
+        return response(200, grouped, truncated=truncated)
+
+    try:
+        if cubes is not None:
+            record = cubes.batch(body, limit=queries.batch_row_cap + 1)
+        else:
+            record = await fetchall(query, to_filter)
+    except queries.QueryError as e:
+        return response(e.status, message=e.message)
+    except Exception as e:
+        return resource_500(str(e))
+
+    grouped, truncated = queries.groupBatch(body, record)
+
+    response_cache.set(key, (grouped, truncated))
+    return response(200, grouped, truncated=truncated)
+
+#%%
+# Response cache hit/miss counters
+@app.route('/v1/cache')
+async def cachestats():
+    return response(200, {"version": queries.datasetVersion(),
+                          "routes":  response_cache.stats()})
+
+#%%
+# Prometheus metrics of this worker and of the last ingest
+@app.route('/metrics')
+async def prometheus():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+#%% Run file
+if __name__ == "__main__":
+    app.run()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:10:44 2026
+
+@author: alyabolowich
+
+Benchmark of the ingest and the API on synthetic EXIOBASE-shaped data, so
+nothing has to be downloaded from Zenodo.
+
+A D_cba/D_pba pair with the given number of regions, sectors and stressors
+is written into an IOT_<year>_ixi.zip in a temporary folder. Then these are
+timed, with their peak Python memory (tracemalloc):
+
+    readFiles           parse both matrices out of the zip
+    formatData          reshape into an EmissionsMatrix
+    uploadToPostgres    COPY every region, once per COPY format
+    app.dcba/app.dpba   requests through the Flask test client, cache cleared
+
+Without --postgres, uploads go to a stand-in cursor that consumes the COPY
+stream (measuring the encoding), and the routes are answered by the cube
+backend (cube.py). With --postgres, the data is loaded into a "benchmark"
+schema of the database in config.py, which is dropped afterwards.
+
+Results are printed, or written with --output, as JSON, so runs on
+different commits can be compared:
+
+    python benchmark.py --regions 49 --sectors 163 --stressors 1113 --output before.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import contextlib
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import functions as f
+import queries
+import cube
+
+#%% Synthetic data
+
+def syntheticMatrix(regions, sectors, stressors, density=0.4, seed=0):
+    ''' D_cba/D_pba-shaped dataframe: stressors as rows, (region, sector)
+    columns, and lognormal values of which a (1 - density) fraction are
+    zero, like the many stressor/sector pairs EXIOBASE leaves empty. '''
+
+    rng = np.random.default_rng(seed)
+
+    region_names   = ["R{}".format(i) for i in range(regions)]
+    sector_names   = ["Sector {}".format(i) for i in range(sectors)]
+    stressor_names = ["Stressor {}".format(i) for i in range(stressors)]
+
+    values = rng.lognormal(mean=0.0, sigma=2.0, size=(stressors, regions * sectors))
+    values[rng.random(values.shape) >= density] = 0.0
+
+    columns = pd.MultiIndex.from_product([region_names, sector_names], names=["region", "sector"])
+    index   = pd.Index(stressor_names, name="stressor")
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+def writeSyntheticZip(directory, year, regions, sectors, stressors, density=0.4, seed=0):
+    ''' Write IOT_<year>_ixi.zip with satellite/D_cba.txt and D_pba.txt, laid
+    out like the EXIOBASE archive. Returns the path of the zip. '''
+
+    path = os.path.join(directory, "IOT_{}_ixi.zip".format(year))
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for offset, name in enumerate(("D_cba.txt", "D_pba.txt")):
+            df = syntheticMatrix(regions, sectors, stressors, density, seed + offset)
+            archive.writestr("IOT_{}_ixi/satellite/{}".format(year, name), df.to_csv(sep="\t"))
+    return path
+
+#%% Measurement
+
+def measure(function, *args, repeat=1, **kwargs):
+    ''' Run function repeat times. Returns its last result and the timings:
+    best and median seconds, and the peak traced memory in MB. '''
+
+    seconds = []
+    peak    = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return result, {"seconds_min":    min(seconds),
+                    "seconds_median": statistics.median(seconds),
+                    "peak_mb":        peak / 2**20,
+                    "repeat":         repeat}
+
+
+def latencies(seconds):
+    ''' Summary of per-request latencies, in milliseconds. '''
+    ms = sorted(s * 1000 for s in seconds)
+    return {"requests":          len(ms),
+            "ms_mean":           statistics.fmean(ms),
+            "ms_p50":            ms[len(ms) // 2],
+            "ms_p95":            ms[min(len(ms) - 1, int(len(ms) * 0.95))],
+            "requests_per_s":    len(ms) / (sum(ms) / 1000) if sum(ms) else None}
+
+#%% Postgres stand-in
+
+class NullCursor:
+    ''' Cursor that reads the COPY stream to the end and discards it, so
+    the upload can be timed without a database. '''
+
+    def __init__(self):
+        self.bytes = 0
+
+    def copy_expert(self, query, stream, size=8192):
+        while True:
+            data = stream.read(size)
+            if not data:
+                break
+            self.bytes += len(data)
+
+    def execute(self, query, params=None):
+        pass
+
+
+class NullConnection:
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+#%% Stages
+
+def benchmarkIngest(args, year, results):
+    ''' Time readFiles, formatData and uploadToPostgres. Returns the
+    formatted matrices. '''
+
+    dfs, results["readFiles"] = measure(f.readFiles, year, repeat=args.repeat)
+    dcba_df, dpba_df, regions = dfs
+
+    dcba_dict, results["formatData"] = measure(f.formatData, dcba_df, year, repeat=args.repeat)
+    dpba_dict = f.formatData(dpba_df, year)
+    results["formatData"]["rows"] = dcba_dict.cube.size
+
+    for fmt in ("csv", "binary"):
+        if args.postgres:
+            con, cur = f.connection(args.schema)
+            upload = lambda: (f.dropTable(dcba_dict, con, cur, "dcba"),
+                              f.uploadToPostgres(dcba_dict, con, cur, "dcba", fmt=fmt))
+        else:
+            con, cur = NullConnection(), NullCursor()
+            upload = lambda: f.uploadToPostgres(dcba_dict, con, cur, "dcba", fmt=fmt)
+
+        _, timing = measure(upload, repeat=args.repeat)
+        timing["rows"]       = dcba_dict.cube.size
+        timing["rows_per_s"] = dcba_dict.cube.size / timing["seconds_min"]
+        if not args.postgres:
+            timing["bytes"] = cur.bytes // args.repeat
+        results["uploadToPostgres_" + fmt] = timing
+
+        if args.postgres:
+            con.close()
+
+    return dcba_dict, dpba_dict
+
+
+def benchmarkRoutes(args, dcba_dict, dpba_dict, results):
+    ''' Time /v1/consumption/<region> and /v1/production/<region> requests
+    with random filters, clearing the response cache before each one. '''
+
+    if args.postgres:
+        # Load the production lens and the dimensions requests are validated
+        # against too, and point the API at the schema before it connects
+        con, cur = f.connection(args.schema)
+        f.dropTable(dpba_dict, con, cur, "dpba")
+        f.uploadToPostgres(dpba_dict, con, cur, "dpba")
+        f.updateDimensions([dcba_dict, dpba_dict], con, cur)
+        con.close()
+        queries.live_schema = args.schema
+
+    import app
+
+    if args.postgres:
+        app.cubes = None
+    else:
+        app.cubes = cube.CubeStore(os.path.join(args.workdir, "cube"))
+
+    client = app.app.test_client()
+    rng    = np.random.default_rng(args.seed)
+
+    routes = {"app.dcba": ("/v1/consumption/{}", dcba_dict),
+              "app.dpba": ("/v1/production/{}", dpba_dict)}
+
+    for name, (route, matrix) in routes.items():
+        seconds = []
+        for _ in range(args.requests):
+            params = {"year":     matrix.year,
+                      "stressor": matrix.stressors[rng.integers(len(matrix.stressors))]}
+            if rng.random() < 0.5:
+                params["sector"] = matrix.sectors[rng.integers(len(matrix.sectors))]
+            url = route.format(matrix.regions[rng.integers(len(matrix.regions))])
+
+            app.response_cache.backend.clear()
+            start = time.perf_counter()
+            reply = client.get(url, query_string=params)
+            seconds.append(time.perf_counter() - start)
+
+            if reply.status_code != 200 or reply.get_json()["status"] != 200:
+                raise RuntimeError("{} {} failed: {}".format(url, params, reply.get_data(as_text=True)))
+
+        results[name] = latencies(seconds)
+
+#%% Run
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ingest and the API on synthetic EXIOBASE-shaped data.")
+    parser.add_argument("--regions",   type=int, default=49)
+    parser.add_argument("--sectors",   type=int, default=163)
+    parser.add_argument("--stressors", type=int, default=1113)
+    parser.add_argument("--density",   type=float, default=0.4, help="fraction of non-zero values")
+    parser.add_argument("--year",      type=int, default=2022)
+    parser.add_argument("--seed",      type=int, default=0)
+    parser.add_argument("--repeat",    type=int, default=3, help="runs of each ingest stage")
+    parser.add_argument("--requests",  type=int, default=200, help="requests per API route")
+    parser.add_argument("--postgres",  action="store_true", help="load into the database in config.py")
+    parser.add_argument("--schema",    default="benchmark", help="schema used with --postgres")
+    parser.add_argument("--output",    help="write the JSON results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    args = parseArguments(argv)
+    args.workdir = tempfile.mkdtemp(prefix="benchmark_")
+
+    results = {}
+    report  = {"commit":     gitCommit(),
+               "started":    time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python":     platform.python_version(),
+               "numpy":      np.__version__,
+               "pandas":     pd.__version__,
+               "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "workdir")},
+               "results":    results}
+
+    # Progress printed by the timed functions goes to stderr, the JSON to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        runStages(args, results)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(output)
+    print(output)
+    return report
+
+
+def runStages(args, results):
+
+    cwd = os.getcwd()
+    try:
+        # functions.py finds exiostorage/ in the working directory
+        os.chdir(args.workdir)
+        os.mkdir("exiostorage")
+        start = time.perf_counter()
+        path  = writeSyntheticZip("exiostorage", args.year, args.regions, args.sectors,
+                                  args.stressors, args.density, args.seed)
+        results["generate"] = {"seconds": time.perf_counter() - start, "zip_mb": os.path.getsize(path) / 2**20}
+
+        if args.postgres:
+            con, cur = f.connection()
+            cur.execute("CREATE SCHEMA IF NOT EXISTS {};".format(args.schema))
+            con.commit()
+            con.close()
+        else:
+            # The stand-in cursor only understands the regional layout
+            f.storage_layout = "regional"
+
+        dcba_dict, dpba_dict = benchmarkIngest(args, args.year, results)
+
+        if not args.postgres:
+            writer = cube.CubeWriter(os.path.join(args.workdir, "cube"), doi="benchmark")
+            writer.write(dcba_dict, "dcba")
+            writer.write(dpba_dict, "dpba")
+            writer.publish()
+
+        benchmarkRoutes(args, dcba_dict, dpba_dict, results)
+
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(args.workdir, ignore_errors=True)
+        if args.postgres:
+            con, cur = f.connection()
+            cur.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(args.schema))
+            con.commit()
+            con.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 15:48:06 2026
+
+@author: alyabolowich
+"""
+
+import threading
+from collections import OrderedDict, defaultdict
+import config
+
+#%% Backends
+
+class LRUBackend:
+    ''' In-process cache holding at most maxsize entries. The least recently
+    used entry is evicted first. '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock    = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SharedBackend:
+    ''' Wraps a flask_caching Cache (e.g. RedisCache or FileSystemCache) so
+    several workers share one cache. Size bounds and eviction are left to the
+    cache server, e.g. Redis with maxmemory-policy allkeys-lru. '''
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=0)
+
+    def clear(self):
+        # Entries of old dataset versions are never read again, and expire
+        # through the server's eviction policy
+        pass
+
+#%% Response cache
+
+class ResponseCache:
+    ''' Cache of query results keyed on the dataset version and the
+    normalised request, with hit/miss counters per route.
+
+    Because the version is part of every key, loading a new dataset makes
+    all earlier entries unreachable at once. '''
+
+    def __init__(self, backend):
+        self.backend  = backend
+        self.version  = None
+        self.counters = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self.lock     = threading.Lock()
+
+    def key(self, version, route, *parts):
+        if version != self.version:
+            # New dataset, drop what the old one left behind
+            self.backend.clear()
+            self.version = version
+        return ":".join(str(part) for part in (version, route) + parts)
+
+    def get(self, route, key):
+        value = self.backend.get(key)
+        with self.lock:
+            self.counters[route]["hits" if value is not None else "misses"] += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def stats(self):
+        with self.lock:
+            return {route: dict(counts) for route, counts in self.counters.items()}
+
+
+def responseCache(app):
+    ''' ResponseCache of an app (Flask or Quart), from config.response_cache.
+    "lru" keeps a bounded in-process cache per worker, "shared" hands
+    cache_config to flask_caching (e.g. RedisCache) so workers share it. '''
+    settings = getattr(config, "response_cache", {})
+
+    if settings.get("backend") == "shared":
+        from flask_caching import Cache
+        cache = Cache(config=settings.get("cache_config", {'CACHE_TYPE': 'simple'}))
+        cache.init_app(app)
+        return ResponseCache(SharedBackend(cache))
+
+    return ResponseCache(LRUBackend(settings.get("maxsize", 1024)))
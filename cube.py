@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:02:17 2026
+
+@author: alyabolowich
+
+Memory-mapped copy of the D_cba/D_pba matrices, written at ingest and read
+by the API without a database.
+
+Each load is written to its own version folder, one (region, stressor,
+sector) float64 array per lens and year with a JSON file of its labels:
+
+    cube/
+        CURRENT                     name of the version being served
+        <doi>-<timestamp>/
+            dcba_2022.npy
+            dcba_2022.json          {"regions": [...], "stressors": [...], "sectors": [...]}
+            ...
+
+The arrays are opened with mmap, so every worker process shares the same
+pages of the OS page cache, and a lookup is plain array indexing.
+"""
+
+import os
+import json
+import time
+import shutil
+import itertools
+import threading
+import numpy as np
+import config
+import queries
+
+#%% Settings
+
+# "postgres" answers the emissions routes with SQL, "cube" from the
+# memory-mapped arrays
+api_backend = getattr(config, "api_backend", "postgres")
+
+# Write the arrays during data_download.py, on by default with the cube backend
+write_cube = getattr(config, "write_cube", api_backend == "cube")
+
+cube_directory = getattr(config, "cube_directory",
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), "cube"))
+
+# Version folders kept on disk, the current one included
+cube_versions = getattr(config, "cube_versions", 2)
+
+#%% Versions
+
+def currentVersion(directory=None):
+    ''' Name of the version being served, or None before the first load. '''
+    try:
+        with open(os.path.join(directory or cube_directory, "CURRENT")) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def setCurrentVersion(version, directory=None):
+    ''' Point CURRENT at version. The file is replaced in one rename, so
+    readers see either the old or the new version. '''
+    directory = directory or cube_directory
+    tmp = os.path.join(directory, "CURRENT.tmp")
+    with open(tmp, "w") as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(directory, "CURRENT"))
+
+
+def versions(directory=None):
+    ''' Version folders, newest first. '''
+    directory = directory or cube_directory
+    names = [name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name))]
+    return sorted(names, key=lambda name: os.path.getmtime(os.path.join(directory, name)), reverse=True)
+
+
+def rollback(directory=None):
+    ''' Serve the most recent version other than the current one. Returns
+    the version now served. '''
+    current  = currentVersion(directory)
+    previous = [version for version in versions(directory) if version != current]
+    if not previous:
+        raise ValueError("No previous cube version to roll back to.")
+    setCurrentVersion(previous[0], directory)
+    print("Cube rolled back to {}".format(previous[0]))
+    return previous[0]
+
+#%% Writer
+
+class CubeWriter:
+    ''' Writes the matrices of one load into a new version folder. Nothing
+    is served from it until publish() is called. '''
+
+    def __init__(self, directory=None, doi=None):
+        self.directory = directory or cube_directory
+        self.version   = "{}-{}".format(doi or queries.currentDOI(), time.strftime("%Y%m%dT%H%M%S"))
+        self.path      = os.path.join(self.directory, self.version)
+        self.written   = set()
+
+    def write(self, matrix, tblext):
+        ''' Write one EmissionsMatrix (one lens, one year). '''
+        os.makedirs(self.path, exist_ok=True)
+
+        name = "{}_{}".format(tblext, matrix.year)
+        np.save(os.path.join(self.path, name + ".npy"), matrix.cube)
+        with open(os.path.join(self.path, name + ".json"), "w") as f:
+            json.dump({"regions":   list(matrix.regions),
+                       "stressors": list(matrix.stressors),
+                       "sectors":   list(matrix.sectors)}, f)
+
+        self.written.add(name)
+        print("Wrote cube {}/{}".format(self.version, name))
+
+    def publish(self, carry_over=False):
+        ''' Serve this version. With carry_over, lens-years of the current
+        version that were not written by this load are linked in, so an
+        incremental refresh keeps serving the years it did not touch.
+        Versions beyond config.cube_versions are removed. '''
+
+        os.makedirs(self.path, exist_ok=True)
+
+        current = currentVersion(self.directory)
+        if carry_over and current:
+            previous = os.path.join(self.directory, current)
+            for filename in os.listdir(previous):
+                if os.path.splitext(filename)[0] in self.written:
+                    continue
+                try:
+                    os.link(os.path.join(previous, filename), os.path.join(self.path, filename))
+                except OSError:
+                    shutil.copy2(os.path.join(previous, filename), os.path.join(self.path, filename))
+
+        setCurrentVersion(self.version, self.directory)
+        print("Serving cube version {}".format(self.version))
+
+        # Readers still holding an old version keep their mapping open
+        for version in versions(self.directory)[cube_versions:]:
+            shutil.rmtree(os.path.join(self.directory, version), ignore_errors=True)
+
+#%% Reader
+
+class CubeSlab:
+    ''' One lens-year, mapped read-only, with label -> position lookups. '''
+
+    def __init__(self, path):
+        self.values = np.load(path + ".npy", mmap_mode="r")
+        with open(path + ".json") as f:
+            labels = json.load(f)
+
+        self.regions   = {name: i for i, name in enumerate(labels["regions"])}
+        self.stressors = labels["stressors"]
+        self.sectors   = labels["sectors"]
+        self.positions = {"stressor": {name: i for i, name in enumerate(self.stressors)},
+                          "sector":   {name: i for i, name in enumerate(self.sectors)}}
+        self.order     = {"stressor": sorted(range(len(self.stressors)), key=self.stressors.__getitem__),
+                          "sector":   sorted(range(len(self.sectors)), key=self.sectors.__getitem__)}
+
+    def select(self, dim, names, ordered):
+        ''' Positions of the given labels (all of them if names is empty),
+        in label order when ordered. Unknown labels are skipped. '''
+        if not names:
+            return self.order[dim] if ordered else range(len(self.order[dim]))
+        labels    = self.stressors if dim == "stressor" else self.sectors
+        positions = [self.positions[dim][name] for name in names if name in self.positions[dim]]
+        return sorted(positions, key=labels.__getitem__) if ordered else positions
+
+
+class CubeStore:
+    ''' Read side of the cube, used by the API with config.api_backend =
+    "cube". Answers the same filters as queries.buildEmissionsQuery(), and
+    returns rows shaped like the SQL ones. A new version is picked up on
+    the first request after CURRENT changes. '''
+
+    def __init__(self, directory=None):
+        self.directory = directory or cube_directory
+        self.version   = None
+        self.mtime     = None
+        self.slabs     = {}
+        self.lock      = threading.Lock()
+
+    def refresh(self):
+        ''' Re-open the arrays if another version was published. '''
+        try:
+            mtime = os.stat(os.path.join(self.directory, "CURRENT")).st_mtime_ns
+        except OSError:
+            raise queries.QueryError("Service unavailable - No emissions cube has been published yet.", status=503)
+        if mtime == self.mtime:
+            return
+
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            version = currentVersion(self.directory)
+            if version is None:
+                raise queries.QueryError("Service unavailable - No emissions cube has been published yet.", status=503)
+            path    = os.path.join(self.directory, version)
+
+            slabs = {}
+            for filename in os.listdir(path):
+                name, ext = os.path.splitext(filename)
+                if ext == ".npy":
+                    tblext, year = name.split("_")
+                    slabs.setdefault(tblext, {})[int(year)] = CubeSlab(os.path.join(path, name))
+
+            self.slabs, self.version, self.mtime = slabs, version, mtime
+
+    def iterRows(self, tblext, regions, years=None, stressors=None, sectors=None,
+                 after=None, ordered=False, lens=False):
+        ''' Generator of the rows of the given regions of one lens, filtered
+        on lists of years, stressors and sectors (empty lists match
+        everything). With ordered=True rows come sorted on (year, stressor,
+        sector) and after is the key of the last row already returned. With
+        lens=True, every row starts with a lens column, as in the batch
+        query. '''
+
+        self.refresh()
+        slabs = self.slabs.get(tblext, {})
+        chosen = [year for year in (years or slabs) if year in slabs]
+        if ordered or after:
+            chosen.sort()
+        if after:
+            chosen = [year for year in chosen if year >= after[0]]
+
+        for region in regions:
+            for year in chosen:
+                slab = slabs[year]
+                r = slab.regions.get(region)
+                if r is None:
+                    continue
+
+                block         = slab.values[r]
+                sector_select = slab.select("sector", sectors, ordered or after)
+                for s in slab.select("stressor", stressors, ordered or after):
+                    stressor = slab.stressors[s]
+                    columns  = sector_select
+
+                    # Skip what the previous page already returned
+                    if after and year == after[0]:
+                        if stressor < after[1]:
+                            continue
+                        if stressor == after[1]:
+                            columns = [c for c in columns if slab.sectors[c] > after[2]]
+
+                    columns = list(columns)
+                    for c, value in zip(columns, block[s, columns].tolist()):
+                        row = {"stressor": stressor, "sector": slab.sectors[c], "region": region,
+                               "value": value, "year": year}
+                        yield dict(lens=tblext, **row) if lens else row
+
+    def emissions(self, lens, region, year=None, stressor=None, sector=None, limit=None,
+                  after=None, ordered=False, require_filter=True):
+        ''' Cube counterpart of running queries.buildEmissionsQuery(). '''
+        tblext, region = queries.checkEmissionsFilter(lens, region, year, stressor, sector, require_filter)
+        self.refresh()
+        rows = self.iterRows(tblext, [region], [year] if year else None, [stressor] if stressor else None,
+                             [sector] if sector else None, after=after, ordered=ordered)
+        return list(itertools.islice(rows, limit)) if limit else rows
+
+    def batch(self, batch, limit=None):
+        ''' Cube counterpart of running queries.buildBatchQuery(). Rows come
+        in the query's order (lens, region, year, stressor, sector), so a
+        capped batch holds the same rows with either backend. '''
+        tblexts = sorted(queries.tableExtension(lens) for lens in batch["lenses"])
+        rows = itertools.chain.from_iterable(
+                   self.iterRows(tblext, sorted(batch["regions"]), batch["years"],
+                                 batch["stressors"], batch["sectors"], ordered=True, lens=True)
+                   for tblext in tblexts)
+        return list(itertools.islice(rows, limit))
+
+
+def batched(rows, size):
+    ''' Split an iterator of rows into lists of at most size rows. '''
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
@@ -6,71 +6,218 @@ Created on Tue Apr 26 13:34:41 2022
 @author: alyabolowich
 """
 
+import sys
+import atexit
+import collections
+from concurrent.futures import ProcessPoolExecutor
 import functions as f
+import cube
+import metrics
+import download
 
 
 #%%
-def main():
+def main(force=False):
     ''' Program will find the most recent version of EXIOBASE. If a new
-    version exists, it will create a new folder called 'exiostorage' and proceed
-    to download the IOT_year_ixi.zip files from Zenodo to this folder. A function
-    will then unzip these files to be used by the next program (data_processing_and_upload)
+    version exists (or with force), it will create a new folder called
+    'exiostorage' and proceed to download the IOT_year_ixi.zip files from
+    Zenodo to this folder. The satellite matrices are then read directly
+    from the zip files. If the version is unchanged, nothing is done.
+
+    The ingest runs as a pipeline:
+        - years are downloaded in parallel (config.download_workers), or
+          taken from the download cache (see download.py)
+        - each downloaded year is read and formatted in a worker process
+          (config.parse_workers), overlapping the next download, with at
+          most config.parse_workers years in memory before upload
+        - regions are uploaded by a bounded pool of writer threads with one
+          connection each (config.db_writers), with at most
+          config.upload_queue_size regions waiting
+
+    Years are consumed in order, so the result does not depend on which
+    worker finishes first. Failed regions are reported at the end.
+
+    With config.refresh_mode = "incremental", tables are not emptied; each
+    region is diffed against what is already loaded and only the changed
+    rows are written (see functions.updateValuesInDatabase()).
+
+    With config.live_schema set, a reload is built in a shadow schema while
+    the API keeps serving the live one, and swapped in once it is complete
+    (see functions.swapSchemas()). Run "python data_download.py rollback"
+    to go back to the previous generation.
     '''
 
-    #f.findMostRecentVersion()
-    #f.createExioStorageDirectory()
-    years = f.getYears()
-    for year in years:
-        
-        print("Downloading new data for year {}".format(year))
-        
-        # Download data
-        f.dataDownload(year)
-        f.unzipExioFiles(year)
-        print("Data downloaded, now processing.")
-        
-        # Read files
-        dcba_df, dpba_df, regions = f.readFiles(year)
-        print("Files read")
-        
-        # Format files
-        dcba_dict = f.formatData(dcba_df, year)
-        dpba_dict = f.formatData(dpba_df, year)
-        print("Files cleaned and processed.")
-        
-        del dcba_df, dpba_df
-        
-        # Connect to Postgres
-        con, cur = f.connection()
-        
-        # Variable to ensure that SQL tables are not deleted on each year
-        db_deleted = True
-    
-        while db_deleted:
-                
-            # Need to first drop the existing tables (regardless of year)
-            # to re-upload new ones
-            f.dropTable(dcba_dict, con, cur, tblext="dcba")
-            f.dropTable(dpba_dict, con, cur, tblext="dpba")
-            
-            # Change the counter to false
-            db_deleted = False
-        
-        # Upload dcba
-        f.uploadToPostgres(dcba_dict, con, cur, tblext="dcba")
-        print("Uploaded all dcba for year {} to psql".format(year))
-        
-        del dcba_dict
-        
-        # Uplaod dpba
-        f.uploadToPostgres(dpba_dict, con, cur, tblext="dpba")
-        print("Uploaded dpba for year {} to psql".format(year))
-        
-        del dpba_dict
-        
-        # Delete the zipfile and folder from exiostorage
-        f.removeFilesFromExiostorage(year)
-        print("Files deleted from exiostorage directory.")
+    doi, changed = f.findMostRecentVersion()
+    if not changed and not force:
+        print("Run \"python data_download.py force\" to load it again.")
+        return
+
+    regions  = []
+    failures = {}
+
+    # Stage timings and upload counters, scraped through the API's /metrics
+    atexit.register(metrics.writeTextfile)
+
+    # Memory-mapped copy of the matrices for the API's cube backend
+    cubes = cube.CubeWriter(doi=doi) if cube.write_cube else None
+
+    with download.Downloads(doi, f.getExioStorageDirectory()) as downloads, \
+         ProcessPoolExecutor(max_workers=f.parse_workers) as parsers, \
+         f.RegionWriters(schema=f.loadSchema()) as writers:
+
+        years = downloads.available(f.getYears())
+        if not years:
+            sys.exit("EXIOBASE record {} has none of the years to update.".format(doi))
+
+        # Download all years at once, and hand each to the parsers as soon
+        # as it is there. The matrices are read straight from the zip
+        # file, so it is not extracted.
+        fetching = [(year, downloads.submit(year)) for year in years]
+
+        def parsedYears():
+            ''' Yield (year, future of readAndFormat()) in year order. At most
+            config.parse_workers years are parsed or waiting to be uploaded
+            at once, so memory does not grow with the number of years. '''
+            pending = collections.deque()
+            for year, fetched in fetching:
+                while len(pending) >= f.parse_workers:
+                    yield pending.popleft()
+
+                print("Downloading new data for year {}".format(year))
+                try:
+                    with metrics.stage("download", year=year):
+                        fetched.result()
+                except Exception as e:
+                    failures[("download", year, None)] = e
+                    print("Downloading year {} failed: {}".format(year, e))
+                    continue
+                print("Data downloaded, now processing.")
+
+                pending.append((year, parsers.submit(f.readAndFormat, year)))
+            while pending:
+                yield pending.popleft()
+
+        # Connect to Postgres, in the schema being loaded when config.live_schema is set
+        con, cur = f.connection(f.loadSchema())
+        f.prepareSchema(con, cur)
+
+        # Tables are emptied once per run, not once per year
+        tables_reset = False
+
+        for year, future in parsedYears():
+            try:
+                dcba_dict, dpba_dict, regions, stages = future.result()
+            except Exception as e:
+                failures[("read", year, None)] = e
+                print("Reading and formatting year {} failed: {}".format(year, e))
+                continue
+            print("Files for year {} cleaned and processed.".format(year))
+
+            # The read and format stages ran in a parser process
+            for record in stages:
+                metrics.recordStage(record)
+
+            # Delete the zipfile and folder from exiostorage
+            f.removeFilesFromExiostorage(year)
+            print("Files deleted from exiostorage directory.")
+
+            # Columnar files for the export endpoint
+            if f.prebuild_exports:
+                with metrics.stage("export", year=year):
+                    f.exportRegions(dcba_dict, "dcba", doi=doi)
+                    f.exportRegions(dpba_dict, "dpba", doi=doi)
+
+            if cubes is not None:
+                with metrics.stage("cube", year=year):
+                    cubes.write(dcba_dict, "dcba")
+                    cubes.write(dpba_dict, "dpba")
+
+            # Stressor, sector and region dictionaries, shared by both lenses
+            with metrics.stage("dimensions", year=year):
+                f.updateDimensions([dcba_dict, dpba_dict], con, cur)
+
+            if f.refresh_mode == "incremental":
+                # Tables are kept, only missing ones are created
+                f.createTables(dcba_dict, con, cur, tblext="dcba")
+                f.createTables(dpba_dict, con, cur, tblext="dpba")
+            elif not tables_reset:
+                # Empty the existing tables to re-upload them, the aggregate
+                # views that read them are kept
+                f.dropTable(dcba_dict, con, cur, tblext="dcba")
+                f.dropTable(dpba_dict, con, cur, tblext="dpba")
+                tables_reset = True
+
+            # Queue the regions of both lenses, this blocks while the
+            # writers are behind
+            writers.upload(dcba_dict, "dcba")
+            writers.upload(dpba_dict, "dpba")
+            print("Queued all regions for year {}".format(year))
+
+            # The future holds the parsed year too
+            del dcba_dict, dpba_dict, future
+
+        # Uploads overlap the parsing above, this is the wait for the rest
+        with metrics.stage("upload"):
+            failures.update(writers.wait())
+
+    if failures:
+        sys.exit("Ingest failed for {} year(s)/region(s): {}".format(
+                     len(failures), ", ".join("{} {} {}".format(*key) for key in failures)))
+
+    if cubes is not None:
+        cubes.publish(carry_over=f.refresh_mode == "incremental")
+
+    if f.refresh_mode == "incremental":
+        print("Incremental refresh: {inserted} rows inserted, {updated} updated, {deleted} deleted".format(
+                  **writers.changes))
+        if not any(writers.changes.values()):
+            # Nothing changed, the aggregates and the API's cache are still valid
+            print("No changes, aggregates and cache left as they are.")
+            f.updateCurrentDOI(doi)
+            download.pruneCache()
+            return
+
+    # Totals served by the aggregate endpoints
+    with metrics.stage("aggregates"):
+        f.refreshAggregates(con, cur, regions)
+
+    # Put the new generation live in one short transaction
+    if f.loadSchema() not in (None, f.live_schema):
+        with metrics.stage("swap"):
+            f.swapSchemas(con, cur)
+
+    # New data is in, let the API drop its cached responses. The DOI is
+    # only recorded now, so a failed run is retried by the next one.
+    f.updateCurrentDOI(doi)
+    f.markDatasetLoaded()
+
+    # Archives of versions older than config.download_cache_dois are removed
+    download.pruneCache()
     return
-    
-main()
\ No newline at end of file
+
+def rollback():
+    ''' Swap the previous generation of tables (with config.live_schema set)
+    and of the cube (with config.write_cube set) back in. '''
+
+    if f.live_schema is None and not cube.write_cube:
+        sys.exit("Nothing to roll back: set config.live_schema to keep a previous generation of tables, "
+                 "or config.write_cube for the cube.")
+
+    if f.live_schema is not None:
+        con, cur = f.connection()
+        f.rollbackSwap(con, cur)
+        con.close()
+    else:
+        print("config.live_schema is not set, tables have no previous generation and are left as they are.")
+
+    if cube.write_cube:
+        cube.rollback()
+
+    # The data served changed, let the API drop its cached responses
+    f.markDatasetLoaded()
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["rollback"]:
+        rollback()
+    else:
+        main(force=sys.argv[1:] == ["force"])
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:20:35 2026
+
+@author: alyabolowich
+
+Download manager for the EXIOBASE archives on Zenodo, used by
+data_download.py in place of pymrio.download_exiobase3().
+
+The file manifest of a record (names, sizes, checksums and links) is
+fetched once from the Zenodo API and kept with the cache. Archives are
+stored by checksum, so a file that is already in the cache is never
+downloaded again, whichever record it came from:
+
+    download_cache/
+        <doi>/manifest.json
+        objects/md5/ab/ab12...      verified archives
+        partial/ab12....part        downloads in progress
+
+Years are downloaded in parallel (config.download_workers). An interrupted
+download is resumed with an HTTP Range request, and the file only enters
+the cache once its checksum matches the manifest.
+
+config.zenodo_url points the manager at another server, e.g. a local
+stand-in serving the same /api/records/ routes.
+"""
+
+import os
+import json
+import time
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import config
+
+#%% Settings
+
+zenodo_url = getattr(config, "zenodo_url", "https://zenodo.org").rstrip("/")
+
+# Record of all EXIOBASE 3 versions, each version has its own DOI
+exiobase_concept = str(getattr(config, "exiobase_concept", "3583070"))
+
+download_cache      = getattr(config, "download_cache",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "download_cache"))
+download_workers    = getattr(config, "download_workers", 3)
+download_retries    = getattr(config, "download_retries", 5)
+download_timeout    = getattr(config, "download_timeout", 60)
+download_chunk_size = getattr(config, "download_chunk_size", 1 << 20)
+
+# Records whose files are kept in the cache, the current one included
+download_cache_dois = getattr(config, "download_cache_dois", 2)
+
+#%% Zenodo API
+
+def getJSON(url):
+    reply = requests.get(url, timeout=download_timeout, headers={"Accept": "application/json"})
+    reply.raise_for_status()
+    return reply.json()
+
+
+def latestRecord():
+    ''' DOI (the Zenodo record id) of the most recent EXIOBASE version. '''
+    record = getJSON("{}/api/records/{}/versions/latest".format(zenodo_url, exiobase_concept))
+    return str(record["id"])
+
+
+def parseManifest(record):
+    ''' {filename: {"size", "checksum", "url"}} from a Zenodo record. Both
+    the current ("key", links.self) and the legacy ("filename", links.download)
+    file entries are understood. '''
+
+    files = record["files"]
+    if isinstance(files, dict):
+        files = files.get("entries", [])
+        files = files.values() if isinstance(files, dict) else files
+
+    manifest = {}
+    for entry in files:
+        name  = entry.get("key") or entry.get("filename")
+        links = entry.get("links", {})
+        url   = links.get("content") or links.get("self") or links.get("download")
+        manifest[name] = {"size":     entry.get("size") or entry.get("filesize"),
+                          "checksum": entry["checksum"] if ":" in entry["checksum"] else "md5:" + entry["checksum"],
+                          "url":      url}
+    return manifest
+
+
+def manifest(doi):
+    ''' File manifest of a record. Fetched from Zenodo the first time, read
+    from the cache afterwards (a published record does not change). '''
+
+    path = os.path.join(download_cache, str(doi), "manifest.json")
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    files = parseManifest(getJSON("{}/api/records/{}".format(zenodo_url, doi)))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(files, f, indent=1)
+    os.replace(path + ".tmp", path)
+    return files
+
+
+def archiveName(year):
+    return "IOT_{}_ixi.zip".format(year)
+
+#%% Content-addressed cache
+
+def objectPath(checksum):
+    ''' Where the verified file with this "algorithm:digest" is stored. '''
+    algorithm, digest = checksum.split(":", 1)
+    return os.path.join(download_cache, "objects", algorithm, digest[:2], digest)
+
+
+def linkInto(source, destination):
+    ''' Make destination a hard link to source, or a copy across devices. '''
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def pruneCache(keep=None):
+    ''' Remove all but the keep most recently used records, and the objects
+    no remaining manifest refers to. '''
+
+    keep = keep or download_cache_dois
+    records = [name for name in os.listdir(download_cache)
+               if os.path.isfile(os.path.join(download_cache, name, "manifest.json"))]
+    records.sort(key=lambda name: os.path.getmtime(os.path.join(download_cache, name)), reverse=True)
+
+    for name in records[keep:]:
+        shutil.rmtree(os.path.join(download_cache, name), ignore_errors=True)
+
+    referenced = set()
+    for name in records[:keep]:
+        with open(os.path.join(download_cache, name, "manifest.json")) as f:
+            referenced.update(objectPath(entry["checksum"]) for entry in json.load(f).values())
+
+    for root, _, filenames in os.walk(os.path.join(download_cache, "objects")):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if path not in referenced:
+                os.remove(path)
+                print("Removed {} from the download cache.".format(filename))
+
+#%% Downloads
+
+class ChecksumError(Exception):
+    pass
+
+
+def fetch(entry, name=None):
+    ''' Download one manifest entry into the cache, unless it is there
+    already. A partial download left by an earlier attempt or run is
+    resumed from where it stopped. Returns the path of the cached file. '''
+
+    target = objectPath(entry["checksum"])
+    if os.path.exists(target):
+        print("{} found in the download cache.".format(name or target))
+        return target
+
+    algorithm, digest = entry["checksum"].split(":", 1)
+    partial = os.path.join(download_cache, "partial", digest + ".part")
+    os.makedirs(os.path.dirname(partial), exist_ok=True)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    for attempt in range(download_retries):
+        try:
+            fetchPartial(entry["url"], partial)
+            if verify(partial, algorithm) != digest:
+                os.remove(partial)
+                raise ChecksumError("Checksum of {} does not match the manifest.".format(name or entry["url"]))
+            os.replace(partial, target)
+            return target
+        except (requests.RequestException, ChecksumError) as e:
+            if attempt == download_retries - 1:
+                raise
+            wait = min(60, 2 ** attempt)
+            print("Download of {} failed ({}), retrying in {}s.".format(name or entry["url"], e, wait))
+            time.sleep(wait)
+
+
+def fetchPartial(url, partial):
+    ''' Append the rest of url to partial. The server may ignore the Range
+    header, in which case the download starts over. '''
+
+    offset  = os.path.getsize(partial) if os.path.exists(partial) else 0
+    headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+
+    with requests.get(url, headers=headers, stream=True, timeout=download_timeout) as reply:
+        if reply.status_code == 416:
+            # Nothing left to send, the file is complete
+            return
+        reply.raise_for_status()
+        mode = "ab" if offset and reply.status_code == 206 else "wb"
+        with open(partial, mode) as out:
+            for chunk in reply.iter_content(chunk_size=download_chunk_size):
+                out.write(chunk)
+
+
+def verify(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(download_chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Downloads:
+    ''' Downloads of the archives of one record, several at a time.
+    submit() returns a future of the path of the archive, linked into
+    destination. '''
+
+    def __init__(self, doi, destination, workers=None):
+        self.doi         = str(doi)
+        self.destination = destination
+        self.files       = manifest(self.doi)
+        self.executor    = ThreadPoolExecutor(max_workers=workers or download_workers, thread_name_prefix="download")
+
+        # Mark the record as used, for pruneCache()
+        os.utime(os.path.join(download_cache, self.doi))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=True)
+
+    def available(self, years):
+        ''' The years of which the record has an archive. '''
+        missing = [year for year in years if archiveName(year) not in self.files]
+        if missing:
+            print("Record {} has no archive for year(s) {}.".format(self.doi, ", ".join(map(str, missing))))
+        return [year for year in years if year not in missing]
+
+    def submit(self, year):
+        return self.executor.submit(self.download, year)
+
+    def download(self, year):
+        name  = archiveName(year)
+        entry = self.files[name]
+
+        fetch(entry, name)
+
+        os.makedirs(self.destination, exist_ok=True)
+        path = os.path.join(self.destination, name)
+        linkInto(objectPath(entry["checksum"]), path)
+        print("Download of year {} complete.".format(year))
+        return path
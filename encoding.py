@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:12:09 2026
+
+@author: alyabolowich
+
+Response encoding shared by app.py and asgi.py:
+
+    - a JSON provider backed by orjson when it is installed, compact unless
+      config.pretty_json is set
+    - the columnar layout (?layout=columnar), which sends rows as parallel
+      arrays and lists columns holding a single value once
+    - NDJSON lines for the streamed responses, encoded like the JSON ones
+    - gzip/brotli compression negotiated from Accept-Encoding
+"""
+
+import re
+import json
+import math
+import gzip
+from flask.json.provider import DefaultJSONProvider
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+import config
+
+#%% Settings
+
+pretty_json = getattr(config, "pretty_json", False)
+
+# Bodies smaller than this are sent as they are
+compress_min_size = getattr(config, "compress_min_size", 1024)
+gzip_level        = getattr(config, "gzip_level", 6)
+brotli_quality    = getattr(config, "brotli_quality", 4)
+
+compressible_types = ("application/json", "application/x-ndjson", "text/csv", "text/plain")
+
+#%% JSON
+
+class FastJSONProvider(DefaultJSONProvider):
+    ''' JSON provider encoding with orjson, straight to bytes. Types orjson
+    does not know (e.g. Decimal) go through Flask's default(). Without
+    orjson, Flask's own encoder is used. '''
+
+    sort_keys = False
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.compact = not pretty_json
+        self.options = orjson.OPT_INDENT_2 if orjson is not None and pretty_json else 0
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options).decode("utf-8")
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self.options),
+                                        mimetype=self.mimetype)
+
+#%% Streams
+
+def finite(value):
+    ''' None in place of NaN and infinities, as orjson writes them. '''
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def ndjsonLines(rows):
+    ''' Rows as NDJSON, one line each. Encoded like the JSON responses, so
+    NaN is written as null rather than the NaN literal json.dumps() gives,
+    which is not valid JSON. Types such as Decimal go through the
+    provider's default(), as in FastJSONProvider. '''
+    default = FastJSONProvider.default
+    if orjson is not None:
+        return b"".join(orjson.dumps(dict(row), default=default) + b"\n" for row in rows).decode("utf-8")
+    return "".join(json.dumps({key: finite(value) for key, value in dict(row).items()}, default=default) + "\n"
+                   for row in rows)
+
+#%% Columnar layout
+
+def wantsColumnar(args):
+    ''' Whether the client asked for ?layout=columnar. '''
+    return args.get("layout", "").lower() == "columnar"
+
+
+def columnar(data):
+    ''' Turn a list of rows into
+
+        {"rows": n,
+         "constants": {"region": "at", "year": 2022},
+         "columns":   {"stressor": [...], "sector": [...], "value": [...]}}
+
+    where columns holding the same value on every row are given once in
+    constants. Dictionaries are converted value by value, so a batch
+    response keeps its lens/region grouping. Anything else is returned as
+    it is. '''
+
+    if isinstance(data, dict):
+        return {key: columnar(value) for key, value in data.items()}
+    if not isinstance(data, list) or not data or not isinstance(data[0], dict):
+        return data
+
+    names     = list(data[0])
+    columns   = {name: [row[name] for row in data] for name in names}
+    constants = {}
+    if len(data) > 1:
+        for name, values in columns.items():
+            first = values[0]
+            if all(value == first for value in values):
+                constants[name] = first
+
+    return {"rows":      len(data),
+            "constants": constants,
+            "columns":   {name: values for name, values in columns.items() if name not in constants}}
+
+#%% Compression
+
+def negotiate(accept_encoding):
+    ''' Content coding to use for a client's Accept-Encoding: "br" when
+    brotli is installed and accepted, else "gzip", else None. '''
+
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+def compressible(mimetype, length):
+    ''' Whether a body of this type and length is worth compressing. '''
+    return mimetype in compressible_types and (length is None or length >= compress_min_size)
+
+
+def compress(data, coding):
+    if coding == "br":
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level)
+
+
+def variantETag(etag, coding):
+    ''' ETag of the compressed variant of a response. A strong ETag names
+    exact bytes, so each coding gets its own (see queries.notModified()). '''
+    if not etag or not etag.endswith('"'):
+        return etag
+    return '{}-{}"'.format(etag[:-1], coding)
+
+
+def revalidatedETag(etag, if_none_match, coding):
+    ''' ETag of a 304, which must be the ETag of the 200 it stands for. The
+    304 is answered before the body is built, so whether that 200 was
+    compressed is read from the tag the client revalidated with: the
+    variant of the negotiated coding, else the plain or another variant
+    the client holds, else the plain ETag. '''
+    if not etag:
+        return etag
+
+    tags = [tag.strip() for tag in (if_none_match or "").split(",")]
+    tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+    candidates = ([variantETag(etag, coding)] if coding else []) + [etag] + \
+                 [variantETag(etag, other) for other in ("br", "gzip")]
+    for candidate in candidates:
+        if candidate in tags:
+            return candidate
+    return etag
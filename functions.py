@@ -7,17 +7,21 @@ Created on Tue Apr 26 13:28:14 2022
 """
 
 #%% Import packages
-import pymrio
 import pandas as pd
+import numpy as np
 import psycopg2
 import psycopg2.extras
-import requests
-import re
 import zipfile
 import os
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 import config
+import queries
+import metrics
+import download
 import shutil
 
 #%% Get path
@@ -64,42 +68,36 @@ def updateCurrentDOI(retrieved_DOI):
         else:
             print("Error updating DOI in the current_DOI.txt file.")
 
-#%% Find most recent version of Exiobase
+#%% Mark dataset as loaded
 
-def findMostRecentVersion():
-    ''' Check that the most recent EXIOBASE version is being used. '''
+def markDatasetLoaded():
+    ''' Touch current_doi.txt once a load has finished. The API uses the
+    file's mtime as the load timestamp, so this invalidates its response
+    cache. '''
 
-    current_DOI = getCurrentDOI()
+    os.utime(getPath() + "/current_doi.txt")
+    print("Marked dataset as loaded in current_doi.txt.")
 
-    # DOI 3583070 gives access to the most recent EXOIBASE version 
-    # by default, but each version has its own DOI.
-    main_url = "https://doi.org/10.5281/zenodo.3583070"
+#%% Find most recent version of Exiobase
 
-    # Establish connection
-    req = requests.get(main_url)
+def findMostRecentVersion():
+    ''' Check that the most recent EXIOBASE version is being used. Returns
+    the DOI of the most recent version and whether it differs from the one
+    in current_doi.txt. current_doi.txt is only updated once the new
+    version is loaded (see data_download.py). '''
 
-    # This will yield the url that holds the most recent Zenodo version
-    retrieved_url = req.url
+    current_DOI = getCurrentDOI().strip()
 
-    # Extract only the DOI integer from the URL
-    retrieved_DOI = re.findall("\d+", retrieved_url)
-    retrieved_DOI = retrieved_DOI[0]
+    # The Zenodo API resolves the record of all EXIOBASE versions to the
+    # most recent one, each version has its own DOI
+    retrieved_DOI = download.latestRecord()
 
-    # Perform action based on whether the retrieved_URL matches the current_URL.
     if current_DOI == retrieved_DOI:
         print("Version is the same, no need to update API.")
-        #exit() # NEED TO UNCOMMENT
-        #return retrieved_DOI #this will need to move to the else statement later
-
-    elif current_DOI != retrieved_DOI:
-        print(type(current_DOI), type(retrieved_DOI))
-        updateCurrentDOI(retrieved_DOI)
-        print("DOIs did not match. New DOI updated in current_DOI.txt file.")
-        print("Running fundMostRecentVersion() again to get latest version")
-        findMostRecentVersion()
-
     else:
-        print("Error finding most recent version of EXIOBASE.")
+        print("New EXIOBASE version found: {} (currently {}).".format(retrieved_DOI, current_DOI))
+
+    return retrieved_DOI, current_DOI != retrieved_DOI
 
 
 #%% Create a storage directory for EXIOBASE files that will be updated.
@@ -182,39 +180,64 @@ def getYears():
 
 #%% Download from Zenodo
 
-def dataDownload(year):
+def dataDownload(year, doi=None):
+    ''' Download IOT_<year>_ixi.zip of the given version (by default the
+    one in current_doi.txt) into the exiostorage folder. Archives already
+    in the download cache are not downloaded again (see download.py). '''
 
-    exio_storage = getExioStorageDirectory()
-    
-    exio_meta = pymrio.download_exiobase3(
-        storage_folder = exio_storage,
-        system = "ixi",
-        years = year
-    )
-    print("Download of year {} complete.".format(year))
+    with download.Downloads(doi or getCurrentDOI().strip(), getExioStorageDirectory(), workers=1) as downloads:
+        path = downloads.download(year)
 
-    print("Downloaded successfully", exio_meta)
+    print("Downloaded successfully", path)
+    return path
 
 #%% Read csv files as dataframes
 
+# Parse D_cba and D_pba at the same time, overridable in config.py
+parallel_read = getattr(config, "parallel_read", True)
+
+def readMatrix(path, member):
+    ''' Parse one satellite matrix straight out of the zip archive. The
+    member is decompressed as it is read, nothing is written to disk. '''
+
+    with zipfile.ZipFile(path) as archive:
+        # The archive's top folder is named after the file (IOT_<year>_ixi/)
+        names = [name for name in archive.namelist() if name.endswith("satellite/" + member)]
+        if not names:
+            raise FileNotFoundError("No satellite/{} in {}".format(member, path))
+
+        with archive.open(names[0]) as stream:
+            return pd.read_csv(stream,
+                               delimiter="\t",
+                               header=[0,1],
+                               index_col=0)
+
+
 def readFiles(year):
-    ''' Read the files from the exiostorage directory. Store as dataframes with 
-    one vector of values. 
-    
+    ''' Read the files from the exiostorage directory. Store as dataframes with
+    one vector of values.
+
+    D_cba and D_pba are streamed out of IOT_<year>_ixi.zip, so the archive
+    does not need to be extracted first. With config.parallel_read, both
+    are parsed at the same time.
+
     Matrices extracted and returned as dataframes:
-        D_cba, D_pba, industries, Z'''
+        D_cba, D_pba'''
+
+    path = os.path.join(getExioStorageDirectory(), "IOT_{}_ixi.zip".format(year))
+
+    if not zipfile.is_zipfile(path):
+        raise ValueError("{} is not a valid zip file.".format(path))
 
     # Read in the files as dataframes
-    dcba = pd.read_csv(getPath() + "/exiostorage" +
-                       "/IOT_{}_ixi/satellite/D_cba.txt".format(year),
-                       delimiter="\t",
-                       header=[0,1],
-                       index_col=0)
-    dpba = pd.read_csv(getPath() + "/exiostorage" +
-                       "/IOT_{}_ixi/satellite/D_pba.txt".format(year),
-                       delimiter="\t",
-                       header=[0,1],
-                       index_col=0)
+    if parallel_read:
+        with ThreadPoolExecutor(max_workers=2) as readers:
+            dcba = readers.submit(readMatrix, path, "D_cba.txt")
+            dpba = readers.submit(readMatrix, path, "D_pba.txt")
+            dcba, dpba = dcba.result(), dpba.result()
+    else:
+        dcba = readMatrix(path, "D_cba.txt")
+        dpba = readMatrix(path, "D_pba.txt")
 
     # Get regions based on DCBA (assume is same for DPBA)
     regions = dcba.columns.levels[0].tolist()
@@ -223,48 +246,233 @@ def readFiles(year):
 
 #%% Format data
 
+class RegionEmissions:
+    ''' The rows of one region of an EmissionsMatrix. Nothing is copied:
+    values is a view into the matrix and the stressor and sector codes are
+    shared by every region. '''
+
+    def __init__(self, matrix, position):
+        self.matrix   = matrix
+        self.region   = matrix.regions[position]
+        self.year     = matrix.year
+        self.values   = matrix.cube[position].ravel()
+
+    def __len__(self):
+        return len(self.values)
+
+    def columns(self):
+        ''' Columns in the layout expected by copyColumns(). '''
+        n = len(self.values)
+        return [("stressor", self.matrix.stressor_codes, self.matrix.stressors),
+                ("sector",   self.matrix.sector_codes,   self.matrix.sectors),
+                ("region",   np.broadcast_to(np.int16(0), n), np.array([self.region], dtype=object)),
+                ("year",     np.broadcast_to(np.int16(self.year), n), None),
+                ("value",    self.values, None)]
+
+    def keyColumns(self):
+        ''' Dictionary-encoded columns for the partitioned fact table, where
+        stressor, sector and region are stored as their smallint keys. '''
+        if self.matrix.region_keys is None:
+            raise ValueError("Dimension keys are not set, run updateDimensions() first.")
+
+        n = len(self.values)
+        region_key = self.matrix.region_keys[self.matrix.positions[self.region]]
+        return [("region_id",   np.broadcast_to(np.int16(region_key), n), None),
+                ("stressor_id", self.matrix.stressor_key_column, None),
+                ("sector_id",   self.matrix.sector_key_column, None),
+                ("year",        np.broadcast_to(np.int16(self.year), n), None),
+                ("value",       self.values, None)]
+
+    def toDataFrame(self):
+        ''' Long dataframe (stressor | sector | region | year | value) for
+        callers that still want one. '''
+        return pd.DataFrame({name: values if categories is None
+                                   else pd.Categorical.from_codes(values, categories)
+                             for name, values, categories in self.columns()})
+
+
+class EmissionsMatrix:
+    ''' Columnar form of a D_cba/D_pba matrix.
+
+    The stressor, sector and region labels are stored once, and the values
+    are rearranged into a (region, stressor, sector) cube so that each region
+    is a contiguous block. A row is identified by its stressor and sector
+    codes, which are the same for every region.
+
+    Behaves like a read-only dictionary of RegionEmissions keyed by region. '''
+
+    def __init__(self, df, year):
+
+        if df.columns.nlevels != 2:
+            raise ValueError("Expected region/sector column levels, found {}.".format(df.columns.nlevels))
+
+        region_labels = df.columns.get_level_values('region')
+        sector_labels = df.columns.get_level_values('sector')
+        regions = region_labels.unique()
+        sectors = sector_labels.unique()
+
+        # Columns must form a full region x sector grid
+        grid = pd.MultiIndex.from_product([regions, sectors], names=['region', 'sector'])
+        if len(df.columns) != len(grid) or df.columns.has_duplicates:
+            raise ValueError("Matrix has {} columns, which is not {} regions x {} sectors.".format(
+                                 len(df.columns), len(regions), len(sectors)))
+        if not df.columns.equals(grid):
+            df = df.reindex(columns=grid)
+
+        self.year      = year
+        self.stressors = np.asarray(df.index.str.replace(' ','_').str.lower(), dtype=object)
+        self.sectors   = np.asarray(sectors.str.replace(' ','_').str.lower(), dtype=object)
+        self.regions   = np.asarray(regions.str.lower(), dtype=object)
+
+        num_stressors, num_regions, num_sectors = len(self.stressors), len(self.regions), len(self.sectors)
+
+        # One copy into region-major order; every region is then a slice
+        self.cube = np.ascontiguousarray(
+                        df.to_numpy(dtype=np.float64)
+                          .reshape(num_stressors, num_regions, num_sectors)
+                          .transpose(1, 0, 2))
+
+        # Row codes of a region block, shared by all regions
+        self.stressor_codes = np.repeat(np.arange(num_stressors, dtype=np.int16), num_sectors)
+        self.sector_codes   = np.tile(np.arange(num_sectors, dtype=np.int16), num_stressors)
+
+        self.positions = {region: r for r, region in enumerate(self.regions)}
+
+        # Surrogate keys of the labels, set by updateDimensions()
+        self.stressor_keys = None
+        self.sector_keys   = None
+        self.region_keys   = None
+
+    def setKeys(self, stressor_keys, sector_keys, region_keys):
+        ''' Attach the dimension keys of the stressor, sector and region
+        labels, and expand them once into the key columns shared by every
+        region. '''
+        self.stressor_keys = stressor_keys
+        self.sector_keys   = sector_keys
+        self.region_keys   = region_keys
+
+        self.stressor_key_column = stressor_keys[self.stressor_codes]
+        self.sector_key_column   = sector_keys[self.sector_codes]
+
+    def keys(self):
+        return list(self.regions)
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __contains__(self, region):
+        return region in self.positions
+
+    def __getitem__(self, region):
+        return RegionEmissions(self, self.positions[region])
+
+
 def formatData(df, year):
-    '''The returned dataframe will be stacked to allow for one column of 
-    values. This formatting will be used in PostgreSQL.
-    
+    '''Reshape a D_cba/D_pba matrix into columnar form for PostgreSQL.
+    The dimensions are read from the matrix itself, so a change in the size
+    of the EXIOBASE classifications is picked up rather than silently
+    misaligning the values.
+
     Args:
         1) dataframe from the ouput of readFiles()
         2) year - required to append to "year" column
-    
-    The resulting format for the dataframe (D_cba/D_pba matrices) is as follows:
-        stressor | region | sector | value | year
-                
-    Returns a dictionary.'''
 
-    num_sectors = 163
-    num_stressors = 1113
+    Each region holds the rows:
+        stressor | sector | region | year | value
 
-    # Replace all values from 
-    stressors_ordered = df.index.str.replace(' ','_').str.lower()
-    sectors_ordered   = df.columns.to_frame()['sector'].str.replace(' ','_').str.lower().unique()
-    regions_ordered   = df.columns.to_frame()['region'].str.lower().unique()
-    
-    data = df.values.ravel()
-    df_dict = dict()
-
-    # Need to make columns for the dataframe that will be stored in the dictionary
-    for r,region in enumerate(regions_ordered):
-        
-        index_stack = pd.MultiIndex.from_product([stressors_ordered,
-                                                  sectors_ordered,
-                                                  [region],
-                                                  [year]],
-                                                 names=['stressor','sector','region','year'])
-
-        df_clean = pd.DataFrame(data[r*num_sectors*num_stressors:(r+1)*num_sectors*num_stressors],
-                                index=index_stack,
-                                columns=['value'])
-
-        df_clean.reset_index(inplace=True)
-        
-        df_dict[region] = df_clean
+    Returns an EmissionsMatrix, which behaves like a dictionary keyed by
+    region.'''
 
-    return df_dict
+    return EmissionsMatrix(df, year)
+
+#%% Read and format one year
+
+def readAndFormat(year):
+    ''' Read and format the D_cba and D_pba matrices of one year. Runs in a
+    worker process of the ingest pipeline in data_download.py.
+
+    Returns (dcba_dict, dpba_dict, regions, stages), where stages are the
+    timings of the read and format stages, for metrics.recordStage() in the
+    main process. '''
+
+    with metrics.stage("read", defer=True, year=year) as read:
+        dcba_df, dpba_df, regions = readFiles(year)
+    with metrics.stage("format", defer=True, year=year) as fmt:
+        dcba_dict = formatData(dcba_df, year)
+        dpba_dict = formatData(dpba_df, year)
+    return dcba_dict, dpba_dict, regions, [read, fmt]
+
+#%% Columnar exports
+
+# Write Parquet/Arrow files of every region-year during the ingest, so the
+# export endpoint can serve them straight from disk
+prebuild_exports = getattr(config, "prebuild_exports", False)
+export_formats   = getattr(config, "export_formats", ["parquet"])
+
+def regionToArrow(region_data):
+    ''' Arrow table of one RegionEmissions, in queries.exportSchema() so the
+    pre-built files match the exports built from the database. Stressor,
+    sector and region are dictionary arrays built directly from the shared
+    codes and labels, and the values are not copied. '''
+    import pyarrow as pa
+
+    schema  = queries.exportSchema()
+    columns = {name: (values, categories) for name, values, categories in region_data.columns()}
+
+    arrays = []
+    for field in schema:
+        values, categories = columns[field.name]
+        if categories is not None:
+            arrays.append(pa.DictionaryArray.from_arrays(np.ascontiguousarray(values, dtype=np.int16),
+                                                         pa.array(categories, type=pa.string())))
+        else:
+            arrays.append(pa.array(np.ascontiguousarray(values), type=field.type))
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def writeArrow(table, path, fmt):
+    ''' Write an Arrow table as a compressed Parquet or Arrow IPC file. '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt == "parquet":
+        pq.write_table(table, path, compression="zstd", use_dictionary=True)
+    elif fmt == "arrow":
+        options = pa.ipc.IpcWriteOptions(compression="zstd")
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+    else:
+        raise ValueError("Unknown export format {}.".format(fmt))
+
+
+def exportRegions(dictionary, tblext, doi=None, formats=None):
+    ''' Write the columnar export of every region of a formatted matrix to
+    the export directory, one file per region, lens, year and format.
+
+    Args:
+        - dictionary is the output of formatData()
+        - tblext is 'dcba' or 'dpba'
+        - doi of the data, defaults to the one in current_doi.txt '''
+
+    doi     = doi or getCurrentDOI().strip()
+    formats = formats or export_formats
+
+    os.makedirs(os.path.join(queries.export_directory, doi), exist_ok=True)
+
+    for name in dictionary.keys():
+        table = regionToArrow(dictionary[name])
+        for fmt in formats:
+            path = queries.exportPath(doi, tblext, name, dictionary.year, fmt)
+            # Write then rename, so the API never serves a partial file
+            writeArrow(table, path + ".tmp", fmt)
+            os.replace(path + ".tmp", path)
+
+    print("Exported {} regions of {} for year {}".format(len(dictionary), tblext, dictionary.year))
 
 #%% Separate each region into a separate df
 
@@ -285,127 +493,766 @@ def separateDfByRegion(df):
 
 #%%
 
-def connection():
+def connection(schema=None):
+    ''' Connect to Postgres. With a schema, unqualified table names are
+    created and looked up in that schema only (see loadSchema()). '''
     con = psycopg2.connect(database = config.db_connection["database"],
                            user     = config.db_connection["user"],
                            password = config.db_connection["password"],
                            host     = config.db_connection["host"],
-                           port     = config.db_connection["port"])
+                           port     = config.db_connection["port"],
+                           options  = "-c search_path={}".format(schema) if schema else None)
 
     cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
     return con, cur
 
+#%% Stream data into Postgres with COPY
+
+# Settings for the COPY loader, overridable in config.py
+copy_batch_size = getattr(config, "copy_batch_size", 100000)
+copy_format     = getattr(config, "copy_format", "csv")
+
+# Postgres binary COPY expects each numeric field in the exact width of its
+# column type, big-endian. Text columns are sent as UTF-8 bytes.
+copy_binary_types = {"value":       ">f8",
+                     "val":         ">f8",
+                     "year":        ">i2",
+                     "region_id":   ">i2",
+                     "stressor_id": ">i2",
+                     "sector_id":   ">i2"}
+
+def frameToColumns(df):
+    ''' Split a dataframe into the columns consumed by the COPY encoders.
+    Text columns are dictionary-encoded once, so each distinct stressor or
+    sector label is only encoded a single time per table.
+
+    Returns a list of (name, values, categories) tuples. For numeric columns
+    values is the NumPy array and categories is None; for text columns values
+    are integer codes into the categories array. '''
+
+    columns = []
+    for name in df.columns:
+        if pd.api.types.is_numeric_dtype(df[name]):
+            columns.append((name, df[name].to_numpy(), None))
+        else:
+            codes, categories = pd.factorize(df[name])
+            columns.append((name, codes, np.asarray(categories, dtype=object)))
+
+    return columns
+
+
+def putFixedWidth(buf, offsets, values):
+    ''' Write one fixed-width value per row into buf at the given offsets. '''
+    values = np.ascontiguousarray(values)
+    width  = values.dtype.itemsize
+    buf[offsets[:, None] + np.arange(width)] = values.view(np.uint8).reshape(-1, width)
+
+
+def binaryChunks(columns, batch_size):
+    ''' Yield the rows of columns in Postgres binary COPY format, batch_size
+    rows at a time. Rows are assembled with NumPy index arithmetic directly
+    from the column buffers, without building a Python object per row. '''
+
+    # Encode the labels of each text column once
+    fields = []
+    for name, values, categories in columns:
+        if categories is None:
+            fields.append((values, np.dtype(copy_binary_types[name]), None, None, None))
+        else:
+            encoded = [str(c).encode("utf-8") for c in categories]
+            lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+            starts  = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+            blob    = np.frombuffer(b"".join(encoded) or b"\0", dtype=np.uint8)
+            fields.append((values, None, lengths, starts, blob))
+
+    num_fields = len(fields)
+    num_rows   = len(columns[0][1]) if columns else 0
+
+    yield b"PGCOPY\n\xff\r\n\x00" + b"\x00" * 8
+
+    for begin in range(0, num_rows, batch_size):
+        stop = min(begin + batch_size, num_rows)
+        n    = stop - begin
+
+        # Data length of every field in every row (-1 marks NULL)
+        field_lengths = []
+        for values, dtype, lengths, starts, blob in fields:
+            if dtype is not None:
+                field_lengths.append(np.full(n, dtype.itemsize, dtype=np.int64))
+            else:
+                codes = values[begin:stop]
+                field_lengths.append(np.where(codes < 0, -1, lengths[codes]))
+
+        row_lengths = 2 + 4 * num_fields + sum(np.maximum(l, 0) for l in field_lengths)
+        row_ends    = np.cumsum(row_lengths)
+        position    = row_ends - row_lengths
+
+        buf = np.empty(int(row_ends[-1]), dtype=np.uint8)
+        putFixedWidth(buf, position, np.full(n, num_fields, dtype=">i2"))
+        position = position + 2
+
+        for (values, dtype, lengths, starts, blob), field_length in zip(fields, field_lengths):
+            putFixedWidth(buf, position, field_length.astype(">i4"))
+            position = position + 4
+
+            if dtype is not None:
+                putFixedWidth(buf, position, values[begin:stop].astype(dtype))
+            else:
+                # Scatter the label bytes of every row into place at once
+                codes  = values[begin:stop]
+                size   = np.maximum(field_length, 0)
+                total  = int(size.sum())
+                if total:
+                    within = np.arange(total) - np.repeat(np.cumsum(size) - size, size)
+                    buf[np.repeat(position, size) + within] = blob[np.repeat(starts[np.maximum(codes, 0)], size) + within]
+
+            position = position + np.maximum(field_length, 0)
+
+        yield buf.tobytes()
+
+    yield b"\xff\xff"
+
+
+def csvChunks(columns, batch_size):
+    ''' Yield the rows of columns as CSV, batch_size rows at a time. Text
+    columns are rebuilt as categoricals over the shared labels, so pandas'
+    C writer formats each batch without per-row tuples. '''
+
+    num_rows = len(columns[0][1]) if columns else 0
+
+    for begin in range(0, num_rows, batch_size):
+        stop  = min(begin + batch_size, num_rows)
+        batch = {name: values[begin:stop] if categories is None
+                       else pd.Categorical.from_codes(values[begin:stop], categories)
+                 for name, values, categories in columns}
+        yield pd.DataFrame(batch, copy=False).to_csv(header=False, index=False).encode("utf-8")
+
+
+class CopyStream:
+    ''' File-like object handed to cursor.copy_expert(). Chunks are pulled
+    from the generator lazily, so only one batch is held in memory at a time
+    while Postgres consumes the stream. '''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk  = b""
+        self.offset = 0
+
+    def read(self, size=-1):
+        while self.offset >= len(self.chunk):
+            self.chunk  = next(self.chunks, None)
+            self.offset = 0
+            if self.chunk is None:
+                self.chunk = b""
+                return b""
+
+        if size is None or size < 0:
+            size = len(self.chunk) - self.offset
+
+        data = self.chunk[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+def copyColumns(cur, table, columns, fmt=None, batch_size=None):
+    ''' Stream columns (see frameToColumns()) into table with COPY FROM STDIN.
+
+    Args:
+        - cur is a cursor from connection()
+        - fmt is either "csv" or "binary" (defaults to config.copy_format)
+        - batch_size is the number of rows encoded per chunk
+
+    Returns the number of rows sent. '''
+
+    fmt        = fmt or copy_format
+    batch_size = batch_size or copy_batch_size
+
+    if fmt == "binary":
+        chunks = binaryChunks(columns, batch_size)
+    elif fmt == "csv":
+        chunks = csvChunks(columns, batch_size)
+    else:
+        raise ValueError("Unknown COPY format {}, use 'csv' or 'binary'.".format(fmt))
+
+    cols  = ", ".join('"{}"'.format(name) for name, values, categories in columns)
+    query = "COPY {} ({}) FROM STDIN WITH (FORMAT {})".format(table, cols, fmt)
+
+    cur.copy_expert(query, CopyStream(chunks), size=1 << 16)
+
+    return len(columns[0][1]) if columns else 0
+
 #%% Upload to Postgres tables
 
-def uploadToPostgres(dictionary, con, cur, tblext):
-    ''' Upload the dataframes stored in the dictionary to Postgres. This function
+def regionColumns(dictionary, name, tblext):
+    ''' Columns of one region, in the layout of its target table. '''
+
+    region_data = dictionary[name]
+    if storage_layout == "partitioned":
+        # Keys only, plus the lens as partition key
+        columns = region_data.keyColumns()
+        return [("lens", np.broadcast_to(np.int16(0), len(region_data)),
+                 np.array([tblext], dtype=object))] + columns
+    elif isinstance(region_data, RegionEmissions):
+        return region_data.columns()
+    return frameToColumns(region_data)
+
+
+def uploadRegion(dictionary, name, con, cur, tblext, batch_size=None, fmt=None):
+    ''' Upload one region of the dictionary and print how long it took.
+    See uploadToPostgres() for the arguments. '''
+
+    table = tableName(name, tblext)
+    start = time.perf_counter()
+
+    rows = copyColumns(cur, table, regionColumns(dictionary, name, tblext), fmt=fmt, batch_size=batch_size)
+    con.commit()
+
+    elapsed = time.perf_counter() - start
+    print("Uploaded {} to Postgres: {} rows in {:.2f}s ({:.0f} rows/s)".format(
+              table, rows, elapsed, rows / elapsed if elapsed else 0))
+
+    metrics.region_seconds.observe(elapsed, lens=tblext)
+    metrics.ingest_rows.inc(rows, lens=tblext)
+    metrics.log("upload", table=table, rows=rows, seconds=round(elapsed, 6))
+
+
+def uploadToPostgres(dictionary, con, cur, tblext, batch_size=None, fmt=None):
+    ''' Upload the regions stored in the dictionary to Postgres. This function
     should only be used when initially uploading the data to Postgres. For continual
-    updates, use updateValuesInDatabase().
+    updates, use updateValuesInDatabase() (config.refresh_mode = "incremental").
+
+    Rows are streamed with COPY FROM STDIN rather than built into INSERT
+    statements, and the time taken for each table is printed.
 
     Required inputs:
-        - Dcba or dpba dictionary
+        - Dcba or dpba dictionary (from formatData()) or a dictionary of dataframes
         - Postgres connection, con, and cursor, cur, from connection()
         - Table extension (either 'dcba' or 'dpba'')
 
-    Adapted from: https://naysan.ca/2020/05/09/pandas-to-postgresql-using-psycopg2-bulk-insert-performance-benchmark/. '''
+    Optional inputs:
+        - batch_size, number of rows encoded at a time (config.copy_batch_size)
+        - fmt, COPY format "csv" or "binary" (config.copy_format) '''
+
+    for name in dictionary.keys():
+        uploadRegion(dictionary, name, con, cur, tblext, batch_size=batch_size, fmt=fmt)
+
+#%% Parallel upload
+
+# Workers of the ingest pipeline in data_download.py, overridable in config.py
+parse_workers     = getattr(config, "parse_workers", 2)
+db_writers        = getattr(config, "db_writers", 4)
+upload_queue_size = getattr(config, "upload_queue_size", 16)
+
+class RegionWriters:
+    ''' Bounded pool of database writer threads, each with its own
+    connection, uploading one region per task.
+
+    At most queue_size regions wait for a writer; upload() blocks until one
+    is free, which keeps the producer (and the matrices it holds) from
+    running ahead of the database. Failures are collected per region and
+    returned by wait() rather than stopping the other uploads.
+
+    With config.refresh_mode = "incremental", regions are refreshed with
+    updateValuesInDatabase() instead, and the rows inserted, updated and
+    deleted are summed in changes. '''
+
+    def __init__(self, workers=None, queue_size=None, schema=None):
+        self.schema      = schema
+        self.executor    = ThreadPoolExecutor(max_workers=workers or db_writers, thread_name_prefix="writer")
+        self.slots       = threading.BoundedSemaphore(queue_size or upload_queue_size)
+        self.local       = threading.local()
+        self.connections = []
+        self.lock        = threading.Lock()
+        self.futures     = []
+        self.changes     = {"inserted": 0, "updated": 0, "deleted": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connection(self):
+        ''' Connection of the calling writer thread, opened on first use. '''
+        if getattr(self.local, "con", None) is None:
+            self.local.con, self.local.cur = connection(self.schema)
+            with self.lock:
+                self.connections.append(self.local.con)
+        return self.local.con, self.local.cur
+
+    def write(self, dictionary, name, tblext):
+        try:
+            con, cur = self.connection()
+            try:
+                if refresh_mode == "incremental":
+                    changes = updateValuesInDatabase(dictionary, name, con, cur, tblext)
+                    with self.lock:
+                        for kind, count in changes.items():
+                            self.changes[kind] += count
+                else:
+                    uploadRegion(dictionary, name, con, cur, tblext)
+            except Exception:
+                try:
+                    con.rollback()
+                except psycopg2.Error:
+                    # Connection is gone, the next task opens a new one
+                    self.local.con = None
+                raise
+        finally:
+            self.slots.release()
+
+    def upload(self, dictionary, tblext):
+        ''' Queue every region of a formatted matrix for upload. '''
+        for name in dictionary.keys():
+            self.slots.acquire()
+            future = self.executor.submit(self.write, dictionary, name, tblext)
+            self.futures.append(((tblext, dictionary.year, name), future))
+
+    def wait(self):
+        ''' Wait for all queued uploads. Returns {(tblext, year, region): error}
+        for the regions that failed. '''
+        failures = {}
+        for key, future in self.futures:
+            error = future.exception()
+            if error is not None:
+                failures[key] = error
+                print("Upload of {} {} {} failed: {}".format(*key, error))
+        self.futures = []
+        return failures
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for con in self.connections:
+            con.close()
+
+#%% Storage layout
+
+# "regional" keeps one unindexed <region>_dcba/<region>_dpba table per region.
+# "partitioned" loads everything into a single emissions table of dimension
+# keys, partitioned by lens and then region, with a composite
+# (year, stressor, sector) index.
+storage_layout = getattr(config, "storage_layout", "regional")
+
+def tableName(region, tblext):
+    ''' Name of the table that holds one region of one lens. '''
+    if storage_layout == "partitioned":
+        return "emissions_{}_{}".format(tblext, region.lower())
+    return "{}_{}".format(region.lower(), tblext)
+
+
+def createEmissionsTable(con, cur, tblext):
+    ''' Create the partitioned emissions table and the partition for one lens
+    if they do not exist yet. Region partitions are added by createTable().
+
+        emissions                    PARTITION BY LIST (lens)
+          emissions_dcba             PARTITION BY LIST (region_id)
+            emissions_dcba_at
+            ...
+
+    Stressor, sector and region are stored as smallint keys into the
+    dimension tables (see updateDimensions()). The index is declared on the
+    parent, so Postgres creates it on every region partition as it is
+    attached. '''
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS emissions ("lens" VARCHAR(4) NOT NULL,
+                                                        "region_id" SMALLINT NOT NULL,
+                                                        "stressor_id" SMALLINT NOT NULL,
+                                                        "sector_id" SMALLINT NOT NULL,
+                                                        "year" SMALLINT NOT NULL,
+                                                        "value" DOUBLE PRECISION)
+                   PARTITION BY LIST (lens);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS emissions_year_stressor_sector_idx
+                   ON emissions (year, stressor_id, sector_id);""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS emissions_{0} PARTITION OF emissions
+                   FOR VALUES IN ('{0}') PARTITION BY LIST (region_id);""".format(tblext))
+    con.commit()
 
-    # Create table
-    # Make list of region names to be used in the names of the tables
-    names = list(dictionary.keys())
+#%% Dimension tables
 
-    for name in names:
-        name.lower()
-
-        # Make table name
-        table = "{}_".format(name) + tblext
-
-# =============================================================================
-#         # Drop if exists
-#         cur.execute("DROP TABLE IF EXISTS {}".format(table))
-#         cur.execute("COMMIT")
-# 
-#         # Create table
-#         cur.execute("""CREATE TABLE {} ("stressor" VARCHAR(255),
-#                                         "sector" VARCHAR(255),
-#                                         "region" VARCHAR(3),
-#                                         "value" DOUBLE PRECISION,
-#                                         "year" SMALLINT);""".format(table))
-#         cur.execute("ROLLBACK")
-# =============================================================================
-
-        # Create a list of tuples from the dataframe values
-        df_to_upload = dictionary[name]
-        tuples = [tuple(x) for x in df_to_upload.to_numpy()]
-
-        # Comma-separated dataframe columns
-        cols = ','.join(list(df_to_upload.columns))
-        cols = ', '.join([f'"{word}"' for word in cols.split(',')])
-
-        query  = "INSERT INTO %s(%s) VALUES %%s" % (table, cols)
-
-        psycopg2.extras.execute_values(cur, query, tuples)
-        con.commit()
+# Dimension -> (table, EmissionsMatrix attribute holding its labels)
+dimension_tables = {"stressor": ("dim_stressor", "stressors"),
+                    "sector":   ("dim_sector",   "sectors"),
+                    "region":   ("dim_region",   "regions")}
+
+def updateDimensions(matrices, con, cur):
+    ''' Build the stressor, sector and region dictionaries once per ingest.
+
+    Each dimension table maps a smallint id to a label. Labels already in
+    the database keep their id and new labels are appended, so keys stay
+    stable between loads. The keys are then attached to every matrix with
+    EmissionsMatrix.setKeys().
+
+    Args:
+        - matrices is a list of EmissionsMatrix (e.g. [dcba_dict, dpba_dict])
+        - Postgres connection, con, and cursor, cur, from connection() '''
+
+    keys = {}
+
+    for dim, (table, attribute) in dimension_tables.items():
+
+        cur.execute("""CREATE TABLE IF NOT EXISTS {} ("id" SMALLINT PRIMARY KEY,
+                                                     "name" VARCHAR(255) UNIQUE NOT NULL);""".format(table))
+        cur.execute("SELECT id, name FROM {};".format(table))
+        existing = {row[1]: row[0] for row in cur.fetchall()}
+
+        # Labels of all matrices, in order of first appearance
+        labels = dict.fromkeys(label for matrix in matrices for label in getattr(matrix, attribute))
+        new    = [label for label in labels if label not in existing]
+
+        next_id = max(existing.values(), default=0) + 1
+        if next_id + len(new) > np.iinfo(np.int16).max:
+            raise ValueError("Too many {} labels for a smallint key.".format(dim))
+
+        if new:
+            rows = [(next_id + i, label) for i, label in enumerate(new)]
+            psycopg2.extras.execute_values(cur, "INSERT INTO {} (id, name) VALUES %s".format(table), rows)
+            existing.update({label: key for key, label in rows})
+            print("Added {} new labels to {}".format(len(new), table))
+
+        keys[dim] = existing
+
+    con.commit()
+
+    for matrix in matrices:
+        matrix.setKeys(np.array([keys["stressor"][label] for label in matrix.stressors], dtype=np.int16),
+                       np.array([keys["sector"][label] for label in matrix.sectors], dtype=np.int16),
+                       np.array([keys["region"][label] for label in matrix.regions], dtype=np.int16))
+
+    return keys
+
+#%% Create and drop tables
+
+def createTable(dictionary, name, cur, tblext):
+    ''' Create the table of one region if it does not exist yet. With the
+    partitioned layout, this is a partition of emissions_<tblext>. '''
+
+    table = tableName(name, tblext)
+
+    if storage_layout == "partitioned":
+        region_key = dictionary.region_keys[dictionary.positions[name]]
+        cur.execute("""CREATE TABLE IF NOT EXISTS {} PARTITION OF emissions_{}
+                       FOR VALUES IN (%s);""".format(table, tblext), [int(region_key)])
+    else:
+        cur.execute("""CREATE TABLE IF NOT EXISTS {} ("stressor" VARCHAR(255),
+                                                      "sector" VARCHAR(255),
+                                                      "region" VARCHAR(3),
+                                                      "value" DOUBLE PRECISION,
+                                                      "year" SMALLINT);""".format(table))
+
+
+def createTables(dictionary, con, cur, tblext):
+    ''' Create the missing tables of the regions in the dictionary, keeping
+    the ones that exist. Used by the incremental refresh. '''
+
+    if storage_layout == "partitioned":
+        createEmissionsTable(con, cur, tblext)
+
+    for name in dictionary.keys():
+        createTable(dictionary, name, cur, tblext)
+    con.commit()
 
-        print("Uploaded {} to Postgres".format(name))
 
-#%% Drop old table
 def dropTable(dictionary, con, cur, tblext):
-    
+    ''' Empty the table of every region in the dictionary before a reload,
+    creating the ones that do not exist yet. With the partitioned layout,
+    this empties the region partitions of the lens.
+
+    The tables are truncated, not dropped, so the aggregate views that read
+    them stay in place and keep serving the previous totals until
+    refreshAggregates() refreshes them concurrently. '''
+
     names = list(dictionary.keys())
 
+    if storage_layout == "partitioned":
+        createEmissionsTable(con, cur, tblext)
+
     for name in names:
-        name.lower()
-
-        # Make table name
-        table = "{}_".format(name) + tblext
-
-        # Drop if exists
-        cur.execute("DROP TABLE IF EXISTS {}".format(table))
-        print("Dropped table {}".format(table))
-        cur.execute("COMMIT")
-
-        # Create table
-        cur.execute("""CREATE TABLE {} ("stressor" VARCHAR(255),
-                                        "sector" VARCHAR(255),
-                                        "region" VARCHAR(3),
-                                        "value" DOUBLE PRECISION,
-                                        "year" SMALLINT);""".format(table))
-        cur.execute("ROLLBACK")
+        createTable(dictionary, name, cur, tblext)
+
+    # One statement for all regions of the lens
+    tables = [tableName(name, tblext) for name in names]
+    if tables:
+        cur.execute("TRUNCATE TABLE {};".format(", ".join(tables)))
+        print("Truncated {} {} tables".format(len(tables), tblext))
+    con.commit()
+
+#%% Aggregates
+
+def emissionsSourceSQL(regions):
+    ''' SELECT returning every row of both lenses as
+    (lens, region, stressor, sector, year, value), whatever the layout. '''
+
+    if storage_layout == "partitioned":
+        return """SELECT e.lens, r.name AS region, s.name AS stressor, c.name AS sector, e.year, e.value
+                  FROM emissions e
+                  JOIN dim_stressor s ON s.id = e.stressor_id
+                  JOIN dim_sector c ON c.id = e.sector_id
+                  JOIN dim_region r ON r.id = e.region_id"""
+
+    parts = []
+    for tblext in ("dcba", "dpba"):
+        for region in regions:
+            parts.append("SELECT '{}' AS lens, region, stressor, sector, year, value FROM {}".format(
+                             tblext, tableName(region, tblext)))
+    return " UNION ALL ".join(parts)
+
+
+def refreshAggregates(con, cur, regions):
+    ''' Create or refresh the materialised views behind the aggregate
+    endpoints, once all regions have been uploaded:
+
+        agg_region_totals   sum over sectors     (lens, region, stressor, year)
+        agg_sector_totals   sum over regions     (lens, sector, stressor, year)
+        agg_group_totals    sum over groups      (lens, region_group, stressor, year)
+
+    Groups come from queries.region_groups and are stored in the
+    region_groups table. Regions outside every group are summed as "row".
+    Each view has a unique index, so an existing view is refreshed
+    CONCURRENTLY and readers are not blocked. '''
+
+    start  = time.perf_counter()
+    source = emissionsSourceSQL(regions)
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS region_groups ("region_group" VARCHAR(32),
+                                                             "region" VARCHAR(3) PRIMARY KEY);""")
+    cur.execute("DELETE FROM region_groups;")
+    rows = [(group, region.lower()) for group, members in queries.region_groups.items() for region in members]
+    if rows:
+        psycopg2.extras.execute_values(cur, "INSERT INTO region_groups (region_group, region) VALUES %s", rows)
+
+    views = {"agg_region_totals": ("region",
+                                   "SELECT lens, region, stressor, year, SUM(value) AS total FROM ({}) src GROUP BY 1, 2, 3, 4"),
+             "agg_sector_totals": ("sector",
+                                   "SELECT lens, sector, stressor, year, SUM(value) AS total FROM ({}) src GROUP BY 1, 2, 3, 4"),
+             "agg_group_totals":  ("region_group",
+                                   """SELECT lens, COALESCE(g.region_group, 'row') AS region_group, stressor, year, SUM(value) AS total
+                                      FROM ({}) src LEFT JOIN region_groups g ON g.region = src.region GROUP BY 1, 2, 3, 4""")}
+
+    for view, (column, definition) in views.items():
+        cur.execute("SELECT to_regclass(%s);", [view])
+        if cur.fetchone()[0] is None:
+            cur.execute("CREATE MATERIALIZED VIEW {} AS {};".format(view, definition.format(source)))
+            cur.execute("CREATE UNIQUE INDEX {0}_idx ON {0} (lens, stressor, year, {1});".format(view, column))
+        else:
+            cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY {};".format(view))
+        con.commit()
+        print("Refreshed {}".format(view))
+
+    print("Aggregates refreshed in {:.2f}s".format(time.perf_counter() - start))
+
+#%% Blue/green generations
+
+# With config.live_schema set, a reload is built in <live>_shadow, analysed
+# and optionally pre-warmed, then swapped in by renaming schemas in one short
+# transaction. The generation it replaces is kept as <live>_previous, so it
+# can be swapped back with rollbackSwap().
+live_schema       = queries.live_schema
+prewarm           = getattr(config, "prewarm", False)
+swap_lock_timeout = getattr(config, "swap_lock_timeout", "5s")
+
+def generationSchemas():
+    ''' Names of the (live, shadow, previous) schemas. '''
+    if live_schema is None:
+        raise ValueError("config.live_schema is not set, tables are loaded without shadow and previous generations.")
+    return live_schema, live_schema + "_shadow", live_schema + "_previous"
+
+
+def loadSchema():
+    ''' Schema the loader writes to, or None for the default search_path.
+    An incremental refresh updates the live schema in place, a reload
+    builds the shadow schema. '''
+    if live_schema is None:
+        return None
+    if refresh_mode == "incremental":
+        return live_schema
+    return generationSchemas()[1]
+
+
+def schemaExists(cur, schema):
+    cur.execute("SELECT 1 FROM pg_namespace WHERE nspname = %s;", [schema])
+    return cur.fetchone() is not None
+
+
+def prepareSchema(con, cur):
+    ''' Create the schema returned by loadSchema(). The shadow schema is
+    always created empty, apart from the dimension tables, which are copied
+    from the live generation so that their keys stay stable. '''
+
+    schema = loadSchema()
+    if schema is None:
+        return
+
+    live, shadow, previous = generationSchemas()
+
+    if schema == live:
+        cur.execute("CREATE SCHEMA IF NOT EXISTS {};".format(live))
+        con.commit()
+        return
+
+    cur.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(shadow))
+    cur.execute("CREATE SCHEMA {};".format(shadow))
+
+    for dim, (table, attribute) in dimension_tables.items():
+        cur.execute("SELECT to_regclass(%s);", ["{}.{}".format(live, table)])
+        if cur.fetchone()[0] is not None:
+            cur.execute("CREATE TABLE {0}.{1} (LIKE {2}.{1} INCLUDING ALL);".format(shadow, table, live))
+            cur.execute("INSERT INTO {0}.{1} SELECT * FROM {2}.{1};".format(shadow, table, live))
+
+    con.commit()
+    print("Created schema {}".format(shadow))
+
+
+def analyzeSchema(con, cur, schema):
+    ''' ANALYZE every table and materialised view of the schema, so the
+    planner has statistics before the first query reaches it. '''
+
+    cur.execute("""SELECT c.oid::regclass::text FROM pg_class c
+                   JOIN pg_namespace n ON n.oid = c.relnamespace
+                   WHERE n.nspname = %s AND c.relkind IN ('r', 'm');""", [schema])
+    for (table,) in cur.fetchall():
+        cur.execute("ANALYZE {};".format(table))
+    con.commit()
+    print("Analysed schema {}".format(schema))
+
+
+def prewarmSchema(con, cur, schema):
+    ''' Load the tables, views and indexes of the schema into shared
+    buffers with pg_prewarm. Skipped if the extension is not available. '''
+
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm WITH SCHEMA public;")
+        cur.execute("""SELECT SUM(public.pg_prewarm(c.oid)) FROM pg_class c
+                       JOIN pg_namespace n ON n.oid = c.relnamespace
+                       WHERE n.nspname = %s AND c.relkind IN ('r', 'm', 'i');""", [schema])
+        blocks = cur.fetchone()[0]
+        con.commit()
+        print("Pre-warmed schema {}: {} blocks".format(schema, blocks))
+    except psycopg2.Error as e:
+        con.rollback()
+        print("Pre-warm of {} skipped: {}".format(schema, e))
+
+
+def renameSchemas(con, cur, renames):
+    ''' Rename schemas in one transaction. Queries already running keep
+    the tables they resolved; the next query sees the new names. '''
+    cur.execute("SET LOCAL lock_timeout = %s;", [swap_lock_timeout])
+    for old, new in renames:
+        cur.execute("ALTER SCHEMA {} RENAME TO {};".format(old, new))
+    con.commit()
+
+
+def swapSchemas(con, cur):
+    ''' Put the shadow generation live once it is fully loaded. The live
+    generation becomes the previous one, and the one before is dropped. '''
+
+    live, shadow, previous = generationSchemas()
+
+    analyzeSchema(con, cur, shadow)
+    if prewarm:
+        prewarmSchema(con, cur, shadow)
+
+    cur.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(previous))
+    con.commit()
+
+    renames = [(shadow, live)]
+    if schemaExists(cur, live):
+        renames.insert(0, (live, previous))
+
+    start = time.perf_counter()
+    renameSchemas(con, cur, renames)
+    print("Swapped {} in as {} in {:.3f}s".format(shadow, live, time.perf_counter() - start))
+
+
+def rollbackSwap(con, cur):
+    ''' Swap the previous generation back in. The generation it replaces
+    becomes the previous one, so a rollback can itself be undone. '''
+
+    live, shadow, previous = generationSchemas()
+
+    if not schemaExists(cur, previous):
+        raise ValueError("No previous generation in schema {}.".format(previous))
+
+    cur.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(shadow))
+    con.commit()
+
+    renameSchemas(con, cur, [(live, shadow), (previous, live), (shadow, previous)])
+    print("Rolled {} back to the previous generation".format(live))
+
 #%% Update values in DB
-def updateValuesInDatabase(cur, con, df, table):
-    ''' Update values in each Postgres table.
+
+# "reload" empties every table and uploads it again. "incremental" loads each
+# region into a staging table and only applies the rows that changed.
+refresh_mode = getattr(config, "refresh_mode", "reload")
+
+def updateValuesInDatabase(dictionary, name, con, cur, tblext, batch_size=None, fmt=None):
+    ''' Incrementally refresh the table of one region.
+
+    The region is copied into a temporary staging table, then compared with
+    the live table on (stressor, sector, region, year) (their keys in the
+    partitioned layout), and only the differences are applied with three
+    set-based statements:
+
+        - rows of the loaded year(s) no longer in the new data are deleted
+        - rows whose value changed are updated
+        - new rows are inserted
+
+    Unchanged rows are not touched, so a run that changes nothing writes
+    (almost) nothing to the table or the WAL. Other years in the table are
+    left as they are.
 
     Inputs:
-        - dataframe (df) that will be updated (from dcba_dict or dpba_dict)
-        - table name (e.g. AT_dcba, BG_dpba)
-
-    '''
-    # Create a tuple of the values that need to be updated. In this case, the 
-    # values need to be updated according to the year. How the sectors and 
-    # stressors are arranged in the df is assumed to remain the same.
-    rows = zip(df.value, df.year)
-
-    # Create a temporary table to store the data that will be uploaded
-    cur.execute("""CREATE TEMP TABLE testtemp (value INTEGER, year INTEGER) ON COMMIT DROP""")
-    cur.executemany("""INSERT INTO testtemp (value, year) VALUES(%s, %s)""", rows)
-
-    cur.execute("""
-        UPDATE {}
-        SET value = testtemp.value
-        FROM testtemp
-        WHERE testtemp.year = {}.year;
-        """.format(table, table))
-
-    cur.rowcount
+        - dcba or dpba dictionary (from formatData())
+        - region name (e.g. "at")
+        - Postgres connection, con, and cursor, cur, from connection()
+        - table extension (either 'dcba' or 'dpba')
+
+    Returns {"inserted": n, "updated": n, "deleted": n}. '''
+
+    table   = tableName(name, tblext)
+    columns = regionColumns(dictionary, name, tblext)
+    keys    = [column for column, values, categories in columns if column != "value"]
+    match   = " AND ".join('t."{0}" = s."{0}"'.format(key) for key in keys)
+    cols    = ", ".join('"{}"'.format(column) for column, values, categories in columns)
+    start   = time.perf_counter()
+
+    # Temporary tables are not WAL-logged and are dropped at the commit
+    cur.execute("CREATE TEMP TABLE staging (LIKE {}) ON COMMIT DROP;".format(table))
+    copyColumns(cur, "staging", columns, fmt=fmt, batch_size=batch_size)
+    cur.execute("ANALYZE staging;")
+
+    cur.execute("""DELETE FROM {0} t
+                   WHERE t.year IN (SELECT DISTINCT year FROM staging)
+                   AND NOT EXISTS (SELECT 1 FROM staging s WHERE {1});""".format(table, match))
+    deleted = cur.rowcount
+
+    cur.execute("""UPDATE {0} t SET value = s.value
+                   FROM staging s
+                   WHERE {1} AND t.value IS DISTINCT FROM s.value;""".format(table, match))
+    updated = cur.rowcount
+
+    cur.execute("""INSERT INTO {0} ({2})
+                   SELECT {3} FROM staging s
+                   WHERE NOT EXISTS (SELECT 1 FROM {0} t WHERE {1});""".format(
+                       table, match, cols, ", ".join("s." + col for col in cols.split(", "))))
+    inserted = cur.rowcount
+
     con.commit()
-    cur.close()
-    con.close()
+
+    elapsed = time.perf_counter() - start
+    changes = {"inserted": inserted, "updated": updated, "deleted": deleted}
+    print("Refreshed {} in {:.2f}s: {inserted} inserted, {updated} updated, {deleted} deleted".format(
+              table, elapsed, **changes))
+
+    metrics.region_seconds.observe(elapsed, lens=tblext)
+    metrics.ingest_rows.inc(inserted + updated + deleted, lens=tblext)
+    metrics.log("refresh", table=table, seconds=round(elapsed, 6), **changes)
+    return changes
 
 #%% Remove file from exiostorage folder
 
 def removeFilesFromExiostorage(year):
-    # Remove folder
-    shutil.rmtree(getPath() + "/exiostorage" + "/IOT_{}_ixi".format(year))
+    # Remove folder, if the archive was ever extracted
+    shutil.rmtree(getPath() + "/exiostorage" + "/IOT_{}_ixi".format(year), ignore_errors=True)
     # Remove zip file
     os.remove(getPath() + "/exiostorage" + "/IOT_{}_ixi.zip".format(year))
 
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:05:52 2026
+
+@author: alyabolowich
+
+Instrumentation shared by the API (app.py, asgi.py) and the loader
+(functions.py, data_download.py):
+
+    - counters, gauges and histograms, rendered in the Prometheus text
+      format by the /metrics route
+    - a structured log, one JSON object per line, per request and per
+      ingest stage
+    - an opt-in sampling profiler that logs the hottest stacks of slow
+      requests (config.profile_slow_requests)
+
+Metrics live in the memory of each process. The loader writes its own to
+a text file once it finishes (config.metrics_textfile), which /metrics
+appends, so the last ingest can be scraped from the API.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+from collections import defaultdict, Counter as Tally
+from contextlib import contextmanager
+import config
+
+#%% Settings
+
+# Structured log, written to stderr unless a file is given
+metrics_log = getattr(config, "metrics_log", None)
+
+# Where data_download.py writes the metrics of the last ingest
+metrics_textfile = getattr(config, "metrics_textfile",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingest.prom"))
+
+# e.g. {"threshold": 0.5, "interval": 0.005, "rate": 1.0}: sample the stack
+# of a share (rate) of requests every interval seconds, and log the stacks
+# of those slower than threshold seconds
+profile_slow_requests = getattr(config, "profile_slow_requests", None)
+
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#%% Metric types
+
+def formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for name, value in pairs]
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in escaped) + "}"
+
+
+class Metric:
+    ''' A named metric with one value per combination of label values. '''
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name          = name
+        self.documentation = documentation
+        self.labels        = tuple(labels)
+        self.values        = {}
+        self.lock          = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines += self.renderValue(key, value)
+        return lines
+
+    def renderValue(self, key, value):
+        return ["{}{} {}".format(self.name, formatLabels(self.labels, key), repr(float(value)))]
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=latency_buckets):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # [count per bucket, sum, count]
+            entry = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def renderValue(self, key, value):
+        counts, total, count = value
+        lines = ["{}_bucket{} {}".format(self.name, formatLabels(self.labels, key, [("le", repr(bound))]), n)
+                 for bound, n in zip(self.buckets, counts)]
+        lines.append("{}_bucket{} {}".format(self.name, formatLabels(self.labels, key, [("le", "+Inf")]), count))
+        lines.append("{}_sum{} {}".format(self.name, formatLabels(self.labels, key), repr(total)))
+        lines.append("{}_count{} {}".format(self.name, formatLabels(self.labels, key), count))
+        return lines
+
+
+class Registry:
+    ''' The metrics of this process, in the order they were created. '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(line for metric in self.metrics if metric.values for line in metric.render()) + "\n"
+
+registry = Registry()
+
+#%% Metrics
+
+request_seconds  = registry.add(Histogram("emissions_api_request_seconds",
+                                          "Time to answer a request, by route and HTTP status.",
+                                          ["route", "status"]))
+phase_seconds    = registry.add(Histogram("emissions_api_phase_seconds",
+                                          "Time spent per request in SQL execution, fetching rows and encoding the response.",
+                                          ["route", "phase"]))
+rows_returned    = registry.add(Counter("emissions_api_rows_total",
+                                        "Rows returned to clients, by route.", ["route"]))
+response_bytes   = registry.add(Counter("emissions_api_response_bytes_total",
+                                        "Bytes of response bodies, by route.", ["route"]))
+
+stage_seconds    = registry.add(Gauge("emissions_ingest_stage_seconds",
+                                      "Duration of the stages of the last ingest.", ["stage"]))
+stage_peak_bytes = registry.add(Gauge("emissions_ingest_stage_peak_rss_bytes",
+                                      "Peak resident memory of the process during each ingest stage.", ["stage"]))
+region_seconds   = registry.add(Histogram("emissions_ingest_region_seconds",
+                                          "Time to upload one region, by lens.", ["lens"],
+                                          buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)))
+ingest_rows      = registry.add(Counter("emissions_ingest_rows_total",
+                                        "Rows written to Postgres, by lens.", ["lens"]))
+
+
+def render():
+    ''' Metrics of this process plus those of the last ingest, in the
+    Prometheus text format. '''
+    text = registry.render()
+    try:
+        with open(metrics_textfile) as f:
+            text += f.read()
+    except OSError:
+        pass
+    return text
+
+
+def writeTextfile(path=None):
+    ''' Write the metrics of this process to path, replacing it in one
+    rename so a scrape never reads half a file. '''
+    path = path or metrics_textfile
+    tmp  = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(registry.render())
+    os.replace(tmp, path)
+
+#%% Structured log
+
+logger = logging.getLogger("emissiontracker")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.FileHandler(metrics_log) if metrics_log else logging.StreamHandler(sys.stderr))
+
+def log(event, **fields):
+    ''' Write one JSON line. '''
+    fields = dict(event=event, time=round(time.time(), 3), pid=os.getpid(), **fields)
+    logger.info(json.dumps(fields, default=str))
+
+#%% Sampling profiler
+
+class Sampler:
+    ''' One background thread sampling the Python stack of the threads that
+    registered with start(), every interval seconds. Stacks are collapsed
+    to "file:function:line;..." strings and counted per thread. '''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples  = {}
+        self.lock     = threading.Lock()
+        self.wake     = threading.Event()
+        threading.Thread(target=self.run, name="sampler", daemon=True).start()
+
+    def start(self):
+        with self.lock:
+            self.samples[threading.get_ident()] = Tally()
+        self.wake.set()
+
+    def stop(self):
+        with self.lock:
+            return self.samples.pop(threading.get_ident(), Tally())
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.samples:
+                    self.wake.clear()
+                    continue
+                for ident, tally in self.samples.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        tally[self.collapse(frame)] += 1
+
+    @staticmethod
+    def collapse(frame):
+        stack = []
+        while frame is not None:
+            stack.append("{}:{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+sampler = Sampler(profile_slow_requests.get("interval", 0.005)) if profile_slow_requests else None
+
+#%% Requests
+
+_request = contextvars.ContextVar("request_timing", default=None)
+
+def startRequest():
+    ''' Start timing the current request. '''
+    timing = {"start": time.perf_counter(), "phases": defaultdict(float), "rows": 0,
+              "sampled": sampler is not None and random.random() < profile_slow_requests.get("rate", 1.0)}
+    _request.set(timing)
+    if timing["sampled"]:
+        sampler.start()
+
+
+@contextmanager
+def phase(name):
+    ''' Add the time spent in the block to a phase (execute, fetch, encode)
+    of the current request. '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing = _request.get()
+        if timing is not None:
+            timing["phases"][name] += time.perf_counter() - start
+
+
+def addRows(count):
+    ''' Count rows returned by the current request. '''
+    timing = _request.get()
+    if timing is not None:
+        timing["rows"] += count
+
+
+def countRows(data):
+    ''' Rows in a response payload: the length of a list, or the total of
+    the lists nested in a dictionary (e.g. a batch response). '''
+    if isinstance(data, list):
+        return len(data)
+    if isinstance(data, dict):
+        return sum(countRows(value) for value in data.values())
+    return 0
+
+
+def finishRequest(route, status, nbytes=None):
+    ''' Record and log the current request. '''
+    timing = _request.get()
+    if timing is None:
+        return
+    _request.set(None)
+
+    seconds = time.perf_counter() - timing["start"]
+    request_seconds.observe(seconds, route=route, status=status)
+    for name, spent in timing["phases"].items():
+        phase_seconds.observe(spent, route=route, phase=name)
+    rows_returned.inc(timing["rows"], route=route)
+    if nbytes:
+        response_bytes.inc(nbytes, route=route)
+
+    fields = dict(route=route, status=status, seconds=round(seconds, 6), rows=timing["rows"], bytes=nbytes,
+                  **{name: round(spent, 6) for name, spent in timing["phases"].items()})
+
+    if timing["sampled"]:
+        samples = sampler.stop()
+        if seconds >= profile_slow_requests.get("threshold", 0.5):
+            fields["profile"] = [{"stack": stack, "samples": count} for stack, count in samples.most_common(10)]
+            log("slow_request", **fields)
+            return
+
+    log("request", **fields)
+
+#%% Ingest stages
+
+def residentPeak():
+    ''' Peak resident memory of the process in bytes (VmHWM), or None. '''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+def resetPeak():
+    ''' Reset the peak resident memory, where Linux allows it, so the next
+    residentPeak() covers only what follows. '''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+@contextmanager
+def stage(name, defer=False, **fields):
+    ''' Time one ingest stage and measure the peak memory of the process
+    while it runs. Yields a dictionary, filled in when the stage ends. With
+    defer=True it is not recorded here, but left for recordStage() in
+    another process (e.g. the main process of the ingest). '''
+    record = dict(stage=name, **fields)
+    resetPeak()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"]  = round(time.perf_counter() - start, 6)
+        record["peak_rss"] = residentPeak()
+        if not defer:
+            recordStage(record)
+
+
+def recordStage(record):
+    ''' Record and log a finished stage (see stage()). '''
+    label = record["stage"] if "year" not in record else "{}_{}".format(record["stage"], record["year"])
+    stage_seconds.set(record["seconds"], stage=label)
+    if record.get("peak_rss") is not None:
+        stage_peak_bytes.set(record["peak_rss"], stage=label)
+    log("stage", **record)
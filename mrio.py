@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:04:51 2026
+
+@author: alyabolowich
+
+Persisted input-output computations for project.py, in place of running
+pymrio's calc_all() on every run.
+
+The inputs of an EXIOBASE year (Z, Y, x and the satellite F) are parsed
+once and stored with what is derived from them:
+
+    A = Z diag(x)^-1        technical coefficients
+    L = (I - A)^-1          Leontief inverse
+    S = F diag(x)^-1        stressors per unit of output
+    M = S L                 multipliers (stressors per unit of final demand)
+
+Every array is a .npy file named after a hash of what it was computed
+from, and opened with mmap:
+
+    mrio/
+        <doi>/<year>/<aggregation>.json     labels and the keys of the inputs
+        objects/<key>.npy
+
+So a result is only computed when one of its inputs changed. A version
+whose satellite accounts changed but whose Z and x did not reuses the
+Leontief inverse of the previous one and only computes S and M. Objects
+no saved system refers to any more are removed by pruneStore().
+
+Aggregations (e.g. EU28 + RoW and 11 sectors) are derived from the cached
+full-resolution results with matrix products, without inverting again.
+"""
+
+import os
+import json
+import glob
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+import config
+
+#%% Settings
+
+mrio_directory = getattr(config, "mrio_directory",
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), "mrio"))
+
+# Largest block of embodied flows computed at once by stressorFlows()
+flow_batch_bytes = getattr(config, "flow_batch_bytes", 1 << 28)
+
+# Versions whose systems are kept in the store, the current one included
+mrio_cache_dois = getattr(config, "mrio_cache_dois", 2)
+
+#%% Object store
+
+def fingerprint(*parts):
+    ''' Key of an array: a hash of arrays, strings or other keys. '''
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(str((part.shape, part.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(part).data)
+        else:
+            digest.update(str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def objectPath(key):
+    return os.path.join(mrio_directory, "objects", key + ".npy")
+
+
+def loadObject(key):
+    ''' The stored array with this key, mapped read-only, or None. '''
+    try:
+        return np.load(objectPath(key), mmap_mode="r")
+    except OSError:
+        return None
+
+
+def saveObject(key, array):
+    ''' Store an array under key and return it mapped read-only. '''
+    path = objectPath(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, np.ascontiguousarray(array, dtype=np.float64))
+    os.replace(path + ".tmp", path)
+    return np.load(path, mmap_mode="r")
+
+#%% Computations
+
+def inverse(x):
+    ''' 1/x, with 0 where x is 0 (sectors without output). '''
+    x = np.asarray(x, dtype=np.float64)
+    out = np.zeros_like(x)
+    np.divide(1.0, x, out=out, where=x != 0)
+    return out
+
+
+def coefficients(Z, x):
+    return np.asarray(Z) * inverse(x)[None, :]
+
+
+def leontief(A):
+    n = A.shape[0]
+    return np.linalg.inv(np.eye(n) - A)
+
+
+def multipliers(S, L):
+    return np.asarray(S) @ np.asarray(L)
+
+#%% Systems
+
+def weightedAverage(B, G, x, x_agg):
+    ''' B diag(x) G' diag(x_agg)^-1: the columns of B averaged over each
+    group of G, weighted by output. '''
+    return (np.asarray(B) * np.asarray(x)[None, :]) @ G.T * inverse(x_agg)[None, :]
+
+# name -> (function, arguments). Arguments are arrays of the same system,
+# or of the system it aggregates when prefixed with "^".
+full_recipes = {"A": (coefficients, ("Z", "x")),
+                "L": (leontief,     ("A",)),
+                "S": (coefficients, ("F", "x")),
+                "M": (multipliers,  ("S", "L"))}
+
+aggregate_recipes = {"Z": (lambda G, Z: G @ np.asarray(Z) @ G.T,       ("G", "^Z")),
+                     "Y": (lambda G, K, Y: G @ np.asarray(Y) @ K.T,    ("G", "K", "^Y")),
+                     "x": (lambda G, x: G @ np.asarray(x),             ("G", "^x")),
+                     "F": (lambda G, F: np.asarray(F) @ G.T,           ("G", "^F")),
+                     "A": (coefficients,                               ("Z", "x")),
+                     "S": (coefficients,                               ("F", "x")),
+                     "L": (lambda G, L, x_full, x: weightedAverage(G @ np.asarray(L), G, x_full, x),
+                                                                       ("G", "^L", "^x", "x")),
+                     "M": (lambda G, M, x_full, x: weightedAverage(M, G, x_full, x),
+                                                                       ("G", "^M", "^x", "x"))}
+
+class MRIO:
+    ''' One year of EXIOBASE at one aggregation. Arrays are computed on
+    first use, or mapped from the store when they were computed before.
+
+    Attributes:
+        - regions, sectors, stressors, categories (of final demand) are
+          lists of labels
+        - Z, Y, x, F, A, L, S, M are labelled dataframes over the mapped
+          arrays
+
+    Only the keys of the inputs are saved. The keys of results are derived
+    from them on every run, so a changed input can never be paired with a
+    stale result. '''
+
+    def __init__(self, path, labels, inputs, recipes=None, parent=None):
+        self.path       = path
+        self.regions    = labels["regions"]
+        self.sectors    = labels["sectors"]
+        self.stressors  = labels["stressors"]
+        self.categories = labels["categories"]
+        self.inputs     = dict(inputs)
+        self.recipes    = recipes or full_recipes
+        self.parent     = parent
+        self.keys       = dict(inputs)
+        self.arrays     = {}
+        self.nonzero    = None
+
+    @classmethod
+    def open(cls, path):
+        ''' The full-resolution system saved at path (see save()), or None. '''
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls(path, saved["labels"], saved["inputs"])
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"labels": {"regions":    self.regions,    "sectors":    self.sectors,
+                                  "stressors":  self.stressors,  "categories": self.categories},
+                       "inputs": self.inputs}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def source(self, name):
+        ''' The system and name an argument of a recipe refers to. '''
+        return (self.parent, name[1:]) if name.startswith("^") else (self, name)
+
+    def key(self, name):
+        ''' Key of an array, from the keys of what it is computed from. '''
+        if name.startswith("^"):
+            system, name = self.source(name)
+            return system.key(name)
+        if name not in self.keys:
+            function, arguments = self.recipes[name]
+            self.keys[name] = fingerprint(name, *(self.key(argument) for argument in arguments))
+        return self.keys[name]
+
+    def array(self, name):
+        ''' An array, from memory, the store, or computed and stored. '''
+        system, name = self.source(name)
+        if system is not self:
+            return system.array(name)
+        if name in self.arrays:
+            return self.arrays[name]
+
+        key   = self.key(name)
+        array = loadObject(key)
+        if array is None:
+            if name not in self.recipes:
+                raise FileNotFoundError("Input {} of {} is missing from the store, parse the year again.".format(name, self.path))
+            function, arguments = self.recipes[name]
+            print("Computing {} ({}).".format(name, os.path.relpath(self.path, mrio_directory)))
+            array = saveObject(key, function(*(self.array(argument) for argument in arguments)))
+
+        self.arrays[name] = array
+        return array
+
+    def calcAll(self):
+        ''' Make sure every result is computed and stored. '''
+        for name in self.recipes:
+            self.array(name)
+        return self
+
+    # Labelled views
+
+    def index(self):
+        return pd.MultiIndex.from_product([self.regions, self.sectors], names=["region", "sector"])
+
+    def frame(self, name):
+        index     = self.index()
+        stressors = pd.Index(self.stressors, name="stressor")
+        final     = pd.MultiIndex.from_product([self.regions, self.categories], names=["region", "category"])
+        rows, columns = {"Z": (index, index), "A": (index, index), "L": (index, index),
+                         "Y": (index, final), "F": (stressors, index), "S": (stressors, index),
+                         "M": (stressors, index)}[name]
+        return pd.DataFrame(self.array(name), index=rows, columns=columns, copy=False)
+
+    Z = property(lambda self: self.frame("Z"))
+    Y = property(lambda self: self.frame("Y"))
+    A = property(lambda self: self.frame("A"))
+    L = property(lambda self: self.frame("L"))
+    F = property(lambda self: self.frame("F"))
+    S = property(lambda self: self.frame("S"))
+    M = property(lambda self: self.frame("M"))
+
+    @property
+    def x(self):
+        return pd.Series(self.array("x"), index=self.index(), name="indout")
+
+    # Flow tables
+
+    def nonzeroZ(self, block_rows=512):
+        ''' (row, column, value) of the non-zero entries of Z, found a block
+        of rows at a time, so the mapped matrix is never copied whole. '''
+        if self.nonzero is None:
+            Z = self.array("Z")
+            rows, columns, values = [], [], []
+            for begin in range(0, Z.shape[0], block_rows):
+                block = np.asarray(Z[begin:begin + block_rows])
+                r, c  = np.nonzero(block)
+                rows.append(r + begin)
+                columns.append(c)
+                values.append(block[r, c])
+            self.nonzero = (np.concatenate(rows), np.concatenate(columns), np.concatenate(values))
+        return self.nonzero
+
+    def flows(self, stressor=None, clip_negative=False):
+        ''' Inter-sector flows Z, or with a stressor diag(S[stressor]) Z (the
+        stressor embodied in each flow), as Flows over index(). With
+        clip_negative, negative flows in Z (e.g. stock changes) are dropped
+        first. '''
+        if stressor is not None:
+            return next(self.stressorFlows([stressor], clip_negative))[1]
+
+        row, col, value = self.nonzeroZ()
+        keep = value > 0 if clip_negative else slice(None)
+        size = len(self.regions) * len(self.sectors)
+        return Flows(row[keep], col[keep], value[keep], (size, size))
+
+    def stressorFlows(self, stressors, clip_negative=False, batch_bytes=None):
+        ''' Yield (stressor, Flows) with diag(S[stressor]) Z for each of the
+        given stressors.
+
+        The intensities of a batch of stressors are broadcast over the
+        non-zero entries of Z in one operation, giving a (stressors x
+        non-zeros) array, so memory follows the number of non-zeros rather
+        than the square of the number of region-sectors. Batches hold at
+        most batch_bytes (config.flow_batch_bytes) of results. '''
+
+        row, col, value = self.nonzeroZ()
+        if clip_negative:
+            keep = value > 0
+            row, col, value = row[keep], col[keep], value[keep]
+
+        positions = [self.stressors.index(stressor) for stressor in stressors]
+        size      = len(self.regions) * len(self.sectors)
+        per_batch = max(1, (batch_bytes or flow_batch_bytes) // max(1, 8 * len(value)))
+        S         = self.array("S")
+
+        for begin in range(0, len(positions), per_batch):
+            batch    = positions[begin:begin + per_batch]
+            embodied = np.asarray(S[batch])[:, row] * value[None, :]
+            for stressor, values in zip(stressors[begin:begin + per_batch], embodied):
+                keep = values != 0
+                yield stressor, Flows(row[keep], col[keep], values[keep], (size, size))
+
+    def flowColumns(self, flows, unit, year):
+        ''' The non-zero triples of flows() as columns for
+        functions.copyColumns(): region and sector of both ends, value,
+        unit and year. Labels are dictionary-encoded, each written once. '''
+        n = flows.nnz
+        regions = np.asarray(self.regions, dtype=object)
+        sectors = np.asarray(self.sectors, dtype=object)
+        size    = len(self.sectors)
+        return [("region_from", flows.row // size, regions),
+                ("sector_from", flows.row % size,  sectors),
+                ("region_to",   flows.col // size, regions),
+                ("sector_to",   flows.col % size,  sectors),
+                ("val",         flows.data,        None),
+                ("unit",        np.broadcast_to(np.int16(0), n), np.array([unit], dtype=object)),
+                ("year",        np.broadcast_to(np.int16(year), n), None)]
+
+    def aggregate(self, region_agg=None, sector_agg=None, sector_names=None):
+        ''' This system aggregated by regions and/or sectors, as in
+        pymrio's aggregate():
+
+            - region_agg is a list with the new region of each region, or
+              an aggregation matrix (new regions x regions)
+            - sector_agg is an aggregation matrix (new sectors x sectors),
+              or a list with the new sector of each sector
+            - sector_names name the rows of a sector matrix
+
+        With G the aggregation matrix of region-sectors and R that of
+        regions, the arrays are
+
+            Z = G Z G'    Y = G Y (R x I)'    x = G x    F = F G'
+            A = Z diag(x)^-1                  S = F diag(x)^-1
+            L = G L diag(x) G' diag(Gx)^-1    M = M diag(x) G' diag(Gx)^-1
+
+        A and S are those of the aggregated system. L and M are the full-
+        resolution ones, averaged over each group weighted by output, so
+        they carry no aggregation bias and need no new inverse (pymrio
+        instead inverts I - A of the aggregated system). '''
+
+        regions, R = aggregationMatrix(region_agg, self.regions)
+        sectors, P = aggregationMatrix(sector_agg, self.sectors, sector_names)
+
+        inputs = {}
+        for name, array in (("G", np.kron(R, P)), ("K", np.kron(R, np.eye(len(self.categories))))):
+            inputs[name] = fingerprint(name, array)
+            if loadObject(inputs[name]) is None:
+                saveObject(inputs[name], array)
+
+        name = "agg-" + fingerprint(inputs["G"], regions, sectors)[:12]
+        agg  = MRIO(os.path.join(os.path.dirname(self.path), name + ".json"),
+                    {"regions": regions, "sectors": sectors,
+                     "stressors": self.stressors, "categories": self.categories},
+                    inputs, recipes=aggregate_recipes, parent=self)
+        agg.save()
+        return agg
+
+
+def aggregationMatrix(agg, names, agg_names=None):
+    ''' (new names, matrix of new x old) from a list of new names per old
+    name (in order of first appearance), a matrix, or None (no
+    aggregation). '''
+
+    if agg is None:
+        return list(names), np.eye(len(names))
+
+    agg = np.asarray(agg)
+    if agg.ndim == 1:
+        new_names = list(dict.fromkeys(agg.tolist()))
+        matrix    = np.zeros((len(new_names), len(names)))
+        matrix[[new_names.index(name) for name in agg.tolist()], np.arange(len(names))] = 1.0
+        return new_names, matrix
+
+    if agg.shape[1] != len(names):
+        raise ValueError("Aggregation matrix has {} columns for {} labels.".format(agg.shape[1], len(names)))
+    new_names = list(agg_names) if agg_names is not None else ["{}".format(i) for i in range(agg.shape[0])]
+    return new_names, agg.astype(np.float64)
+
+#%% Flows
+
+class Flows:
+    ''' Sparse matrix in coordinate (COO) form: the row, column and value
+    of each non-zero entry. '''
+
+    def __init__(self, row, col, data, shape):
+        self.row   = row
+        self.col   = col
+        self.data  = data
+        self.shape = shape
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def toarray(self):
+        dense = np.zeros(self.shape)
+        np.add.at(dense, (self.row, self.col), self.data)
+        return dense
+
+    def tocoo(self):
+        ''' As a scipy.sparse matrix, if scipy is installed. '''
+        from scipy.sparse import coo_matrix
+        return coo_matrix((self.data, (self.row, self.col)), shape=self.shape)
+
+#%% Store pruning
+
+def savedSystems(directory):
+    ''' The systems saved in one <doi>/<year> directory: the full one and
+    the aggregations of it. '''
+    full = MRIO.open(os.path.join(directory, "full.json"))
+    if full is None:
+        return []
+
+    systems = [full]
+    for path in sorted(glob.glob(os.path.join(directory, "agg-*.json"))):
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            continue
+        systems.append(MRIO(path, saved["labels"], saved["inputs"], recipes=aggregate_recipes, parent=full))
+    return systems
+
+
+def pruneStore(keep=None):
+    ''' Remove the systems of all but the keep most recently used versions,
+    and the objects no remaining system refers to, inputs or results. '''
+
+    keep = keep or mrio_cache_dois
+    if not os.path.isdir(mrio_directory):
+        return
+
+    versions = [name for name in os.listdir(mrio_directory)
+                if name != "objects" and os.path.isdir(os.path.join(mrio_directory, name))]
+    versions.sort(key=lambda name: os.path.getmtime(os.path.join(mrio_directory, name)), reverse=True)
+
+    for name in versions[keep:]:
+        shutil.rmtree(os.path.join(mrio_directory, name), ignore_errors=True)
+
+    # Keys of results follow from the keys of the inputs, whether they have
+    # been computed yet or not
+    referenced = set()
+    for name in versions[:keep]:
+        for directory in glob.glob(os.path.join(mrio_directory, name, "*")):
+            for system in savedSystems(directory):
+                referenced.update(objectPath(system.key(array)) for array in set(system.inputs) | set(system.recipes))
+
+    for path in glob.glob(os.path.join(mrio_directory, "objects", "*")):
+        if path not in referenced:
+            os.remove(path)
+            print("Removed {} from the mrio store.".format(os.path.basename(path)))
+
+#%% Load
+
+def systemPath(doi, year, name="full"):
+    return os.path.join(mrio_directory, str(doi), str(year), name + ".json")
+
+
+def load(doi, year, path=None, refresh=False):
+    ''' The full-resolution system of one EXIOBASE year. Parsed with pymrio
+    from the zip at path the first time (or with refresh, e.g. after a
+    pymrio upgrade), read from the store afterwards. path may be a function
+    returning it, e.g. a download, which is then only called when the year
+    has to be parsed. Results whose inputs
+    are unchanged are kept either way, and the store is pruned after a
+    parse (see pruneStore()). '''
+
+    system = None if refresh else MRIO.open(systemPath(doi, year))
+    if system is not None:
+        # Mark the version as used, for pruneStore()
+        os.utime(os.path.join(mrio_directory, str(doi)))
+        return system
+    if path is None:
+        raise ValueError("EXIOBASE {} {} is not in the store, give the path of its zip file.".format(doi, year))
+    if callable(path):
+        path = path()
+
+    import pymrio
+    print("Parsing {}".format(path))
+    exio = pymrio.parse_exiobase3(path=path)
+
+    inputs = {"Z": exio.Z.values, "Y": exio.Y.values, "x": exio.x.values.ravel(),
+              "F": exio.satellite.F.values}
+    labels = {"regions":    list(exio.get_regions()),
+              "sectors":    list(exio.get_sectors()),
+              "stressors":  list(exio.satellite.F.index),
+              "categories": list(exio.get_Y_categories())}
+
+    keys = {}
+    for name, array in inputs.items():
+        array = np.asarray(array, dtype=np.float64)
+        keys[name] = fingerprint(name, array)
+        if loadObject(keys[name]) is None:
+            saveObject(keys[name], array)
+
+    system = MRIO(systemPath(doi, year), labels, keys)
+    system.save()
+    os.utime(os.path.join(mrio_directory, str(doi)))
+
+    # Objects of older versions, and of this year's previous parse
+    pruneStore()
+    return system
@@ -0,0 +1,605 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 10:12:41 2026
+
+@author: alyabolowich
+"""
+
+import os
+import re
+import json
+import base64
+import binascii
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
+import threading
+from markupsafe import escape
+import config
+
+#%% Settings
+
+# "regional" reads one <region>_dcba/<region>_dpba table per region.
+# "partitioned" reads the single emissions table written by the loader when
+# config.storage_layout is "partitioned" (see functions.createEmissionsTable).
+storage_layout = getattr(config, "storage_layout", "regional")
+
+# API lens name -> table extension used by the loader
+lens_tables = {"consumption": "dcba",
+               "production":  "dpba"}
+
+# Page size of paginated responses, and the largest a client may ask for
+page_size     = getattr(config, "page_size", 1000)
+max_page_size = getattr(config, "max_page_size", 10000)
+
+# Batch endpoint: most rows returned, and most values per list
+batch_row_cap   = getattr(config, "batch_row_cap", 10000)
+batch_max_items = getattr(config, "batch_max_items", 100)
+
+# Region groups for the aggregate endpoints. Regions outside every group
+# are summed as "row" (rest of world).
+region_groups = getattr(config, "region_groups",
+                        {"eu27": ["at", "be", "bg", "cy", "cz", "de", "dk", "ee", "es",
+                                  "fi", "fr", "gr", "hr", "hu", "ie", "it", "lt", "lu",
+                                  "lv", "mt", "nl", "pl", "pt", "ro", "se", "si", "sk"]})
+
+# Aggregate -> (materialised view, column of the aggregated member). The
+# views are refreshed by data_download.py, see functions.refreshAggregates().
+aggregate_views = {"region": ("agg_region_totals", "region"),
+                   "sector": ("agg_sector_totals", "sector"),
+                   "group":  ("agg_group_totals",  "region_group")}
+
+# Schema holding the generation of tables being served. When set, the API
+# reads through search_path = <live_schema>, public and data_download.py
+# builds each reload in <live_schema>_shadow before swapping it in (see
+# functions.swapSchemas()).
+live_schema = getattr(config, "live_schema", None)
+
+def connectionOptions():
+    ''' libpq options for API connections, None without live_schema. '''
+    if live_schema is None:
+        return None
+    return "-c search_path={},public".format(live_schema)
+
+# File holding the DOI of the loaded EXIOBASE version. data_download.py
+# touches it after every load, so its mtime is the load timestamp.
+doi_file = getattr(config, "doi_file",
+                   os.path.join(os.path.dirname(os.path.abspath(__file__)), "current_doi.txt"))
+
+# Columnar exports pre-built at ingest, see functions.exportRegions()
+export_directory = getattr(config, "export_directory",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "exports"))
+
+# Cache-Control of cacheable /v1 responses, see validators()
+cache_control = getattr(config, "cache_control", "public, max-age=300, stale-while-revalidate=86400")
+
+# Export format -> file extension, and mimetype
+export_formats = {"parquet": "parquet",
+                  "arrow":   "arrow"}
+export_types   = {"parquet": "application/vnd.apache.parquet",
+                  "arrow":   "application/vnd.apache.arrow.file"}
+
+#%% Dataset version
+
+_version = {"mtime": None, "version": None, "doi": None}
+
+def datasetVersion():
+    ''' Version of the data currently served, as "<doi>-<load timestamp>".
+    The file is only re-read when its mtime changes. '''
+
+    try:
+        mtime = os.stat(doi_file).st_mtime
+    except OSError:
+        return "unknown"
+
+    if mtime != _version["mtime"]:
+        with open(doi_file) as f:
+            doi = f.read().strip()
+        _version["version"] = "{}-{}".format(doi, int(mtime))
+        _version["doi"]     = doi
+        _version["mtime"]   = mtime
+
+    return _version["version"]
+
+
+def currentDOI():
+    ''' DOI of the EXIOBASE version currently served. '''
+    datasetVersion()
+    return _version["doi"] or "unknown"
+
+def loadTime():
+    ''' Time the current dataset was loaded, as a Unix timestamp, or None. '''
+    datasetVersion()
+    return int(_version["mtime"]) if _version["mtime"] is not None else None
+
+#%% Conditional requests
+
+def validators(path, args):
+    ''' ETag and Last-Modified of a GET request. The strong ETag hashes the
+    dataset version with the path and the sorted query arguments, so it
+    changes when a new dataset is loaded or the request is different.
+    Returns (etag, last_modified) as header values. '''
+
+    normalised = "&".join("{}={}".format(key, value) for key, value in sorted(args) if value != "")
+    digest     = hashlib.sha1("{}|{}?{}".format(datasetVersion(), path, normalised).encode("utf-8")).hexdigest()
+
+    modified = loadTime()
+    return '"{}"'.format(digest[:32]), formatdate(modified, usegmt=True) if modified is not None else None
+
+
+def notModified(etag, last_modified, if_none_match, if_modified_since):
+    ''' Whether the client's copy is current, following RFC 7232: with
+    If-None-Match only the ETags are compared (weakly), otherwise
+    If-Modified-Since is compared with Last-Modified. '''
+
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # Compressed variants end in -gzip/-br (see encoding.variantETag())
+        tags = [re.sub(r'-(gzip|br)"$', '"', tag[2:] if tag.startswith("W/") else tag) for tag in tags]
+        return "*" in tags or etag in tags
+
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(last_modified)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+def cacheable(method, path):
+    ''' Requests answered from the dataset alone, which can carry
+    validators. The cache statistics change on every request. '''
+    return method in ("GET", "HEAD") and path.startswith("/v1") and path != "/v1/cache"
+
+#%% Export files
+
+def exportPath(doi, tblext, region, year, fmt):
+    ''' Location of the pre-built export of one region-year of one lens. '''
+    return os.path.join(export_directory, str(doi),
+                        "{}_{}_{}.{}".format(region.lower(), tblext, year, export_formats[fmt]))
+
+#%% Response envelope
+
+def envelope(status, data=None, message="OK", **extra):
+    ''' Body shared by every API response, in both serving modes. '''
+    return {"status": status, "result": data, "message": message, **extra}
+
+def exportSchema():
+    ''' Arrow schema of every export, whether pre-built by
+    functions.regionToArrow() or read from the database by readExportCSV(). '''
+    import pyarrow
+
+    labels = pyarrow.dictionary(pyarrow.int16(), pyarrow.string())
+    return pyarrow.schema([("stressor", labels),
+                           ("sector",   labels),
+                           ("region",   labels),
+                           ("year",     pyarrow.int16()),
+                           ("value",    pyarrow.float64())])
+
+
+def buildExportQuery(lens, region, year=None):
+    ''' Query for the export of a whole region (or region-year), selecting
+    the columns of exportSchema() in its order in both layouts. Returns a
+    (query, params) tuple. '''
+    query, params = buildEmissionsQuery(lens, region, year, require_filter=False)
+    columns = ", ".join(quoteIdentifier(field.name) for field in exportSchema())
+    return 'SELECT {} FROM ({}) e;'.format(columns, query.rstrip(';')), params
+
+
+def readExportCSV(data):
+    ''' Parse the CSV written by COPY ... TO STDOUT (FORMAT csv, HEADER) into
+    an Arrow table of exportSchema(). '''
+    import pyarrow
+    import pyarrow.csv
+
+    schema  = exportSchema()
+    # The CSV reader only dictionary-encodes with int32 indices, the cast
+    # narrows them to the export's
+    column_types = {field.name: pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+                                if pyarrow.types.is_dictionary(field.type) else field.type
+                    for field in schema}
+    convert = pyarrow.csv.ConvertOptions(column_types=column_types, include_columns=schema.names)
+    return pyarrow.csv.read_csv(pyarrow.BufferReader(data), convert_options=convert).cast(schema)
+
+
+def exportBytes(table, fmt):
+    ''' Serialise an Arrow table as a zstd-compressed Parquet or Arrow file. '''
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    buf = pyarrow.BufferOutputStream()
+    if fmt == "parquet":
+        pyarrow.parquet.write_table(table, buf, compression="zstd", use_dictionary=True)
+    else:
+        options = pyarrow.ipc.IpcWriteOptions(compression="zstd")
+        with pyarrow.ipc.new_file(buf, table.schema, options=options) as writer:
+            writer.write_table(table)
+    return buf.getvalue().to_pybytes()
+
+#%% Errors
+
+class QueryError(Exception):
+    ''' Raised when a request cannot be turned into a query. The message is
+    returned to the client as is. '''
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status  = status
+
+#%% Dimension lookup
+
+class Dimensions:
+    ''' In-process map of stressor, sector and region names to the smallint
+    keys stored in the partitioned emissions table. Loaded from the dimension
+    tables written by functions.updateDimensions(), in both layouts: the
+    names are also the sets requests are validated against before anything
+    is sent to the database.
+
+    keys is None when the dimension tables do not exist (data loaded before
+    they were introduced), in which case names are not validated. '''
+
+    tables = {"stressor": "dim_stressor",
+              "sector":   "dim_sector",
+              "region":   "dim_region"}
+
+    def __init__(self):
+        self.keys    = None
+        self.version = None
+        self.lock    = threading.Lock()
+
+    def loaded(self):
+        ''' True when the lookup matches the dataset currently served. '''
+        return self.version is not None and self.version == datasetVersion()
+
+    def load(self, cur):
+        version = datasetVersion()
+        keys = {}
+        for dim, table in self.tables.items():
+            cur.execute("SELECT name, id FROM {};".format(table))
+            keys[dim] = {row[0]: row[1] for row in cur.fetchall()}
+        self.update(keys, version)
+
+    def update(self, keys, version):
+        ''' Replace the lookup with keys ({dim: {name: id}}) read for the
+        given dataset version. '''
+        with self.lock:
+            self.keys    = keys
+            self.version = version
+
+    def key(self, dim, name):
+        ''' Key of a name, rejecting unknown names without a database
+        round-trip. '''
+        if self.keys is None:
+            raise QueryError("Service unavailable - The dimension tables have not been loaded.", status=503)
+        try:
+            return self.keys[dim][name]
+        except KeyError:
+            raise QueryError("Bad request - Unknown {} '{}'.".format(dim, escape(name)))
+
+    def check(self, dim, name):
+        ''' Reject a name that is not in the dataset, when the names are
+        known. '''
+        if self.keys is not None and name not in self.keys[dim]:
+            raise QueryError("Bad request - Unknown {} '{}'.".format(dim, escape(name)))
+
+dimensions = Dimensions()
+
+#%% Build emissions query
+
+def quoteIdentifier(name):
+    ''' Quote a table or column name for SQL, doubling any double quote in
+    it, as Postgres' quote_ident() does. '''
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+# Rows of the partitioned table, with keys joined back to their names so the
+# response has the same shape as in the regional layout
+emissions_from   = """FROM emissions e
+                      JOIN dim_stressor s ON s.id = e.stressor_id
+                      JOIN dim_sector c ON c.id = e.sector_id
+                      JOIN dim_region r ON r.id = e.region_id"""
+emissions_select = "SELECT s.name AS stressor, c.name AS sector, r.name AS region, e.value, e.year " + emissions_from
+
+def tableExtension(lens):
+    ''' Map an API lens (consumption/production) to its table extension. '''
+    try:
+        return lens_tables[lens]
+    except KeyError:
+        raise QueryError("Bad request - The lens must be one of: {}.".format(", ".join(lens_tables)))
+
+
+def checkEmissionsFilter(lens, region, year=None, stressor=None, sector=None, require_filter=True):
+    ''' Validate the lens, region and filters of an emissions request.
+    Returns the table extension and the lowercased region. '''
+
+    tblext = tableExtension(lens)
+
+    region = region.lower()
+    if not region:
+        raise QueryError("Bad request - Looks like you need to provide a region. Please check you have provided the correect two-letter code.")
+
+    if require_filter and not (year or stressor or sector):
+        raise QueryError("Bad request - Please check that you have at least provided a year(s), sector(s), or stressor(s).")
+
+    # Unknown names never reach the database
+    dimensions.check("region", region)
+    if stressor:
+        dimensions.check("stressor", stressor)
+    if sector:
+        dimensions.check("sector", sector)
+
+    return tblext, region
+
+
+def buildEmissionsQuery(lens, region, year=None, stressor=None, sector=None, limit=None,
+                        after=None, ordered=False, require_filter=True):
+    ''' Build the SQL for one region of one lens, filtered on any combination
+    of year, stressor and sector.
+
+    With ordered=True rows come sorted on (year, stressor, sector), and after
+    is the (year, stressor, sector) of the last row of the previous page (see
+    decodeCursor()), giving keyset pagination. require_filter=False allows a
+    query for the whole region.
+
+    Returns a (query, params) tuple ready for cursor.execute(). '''
+
+    tblext, region = checkEmissionsFilter(lens, region, year, stressor, sector, require_filter)
+
+    if storage_layout == "partitioned":
+        # Names are translated to keys in-process. Lens and region prune to
+        # a single partition, the rest of the filter is served by the
+        # (year, stressor, sector) index.
+        query      = emissions_select
+        conditions = ['e.lens=%s', 'e.region_id=%s']
+        params     = [tblext, dimensions.key("region", region)]
+        if year:
+            conditions.append('e.year=%s')
+            params.append(year)
+        if stressor:
+            conditions.append('e.stressor_id=%s')
+            params.append(dimensions.key("stressor", stressor))
+        if sector:
+            conditions.append('e.sector_id=%s')
+            params.append(dimensions.key("sector", sector))
+        if after:
+            conditions.append('(e.year, e.stressor_id, e.sector_id) > (%s, %s, %s)')
+            params += [after[0], dimensions.key("stressor", after[1]), dimensions.key("sector", after[2])]
+        order = ' ORDER BY e.year, e.stressor_id, e.sector_id'
+    else:
+        query      = 'SELECT * FROM ' + quoteIdentifier("{}_{}".format(region, tblext))
+        conditions = []
+        params     = []
+        if year:
+            conditions.append('year=%s')
+            params.append(year)
+        if stressor:
+            conditions.append('stressor=%s')
+            params.append(stressor)
+        if sector:
+            conditions.append('sector=%s')
+            params.append(sector)
+        if after:
+            conditions.append('(year, stressor, sector) > (%s, %s, %s)')
+            params += list(after)
+        order = ' ORDER BY year, stressor, sector'
+
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    if ordered or after:
+        query += order
+    if limit:
+        # A parameter, so pages of any size share one prepared statement
+        query += ' LIMIT %s'
+        params.append(int(limit))
+
+    return query + ';', params
+
+#%% Prepared statements
+
+def prepareStatement(query):
+    ''' Server-side prepared statement for a query from buildEmissionsQuery().
+    Returns (name, text): text has $1, $2, ... placeholders in place of %s,
+    and name is derived from it. Queries differ only by their filter
+    combination, layout and table, never by the values filtered on, so
+    there is one statement per combination, prepared once per connection
+    and reused by every request with the same shape. '''
+
+    parts = query.rstrip().rstrip(";").split("%s")
+    text  = parts[0] + "".join("${}{}".format(i, part) for i, part in enumerate(parts[1:], 1))
+    return "emissions_" + hashlib.sha1(text.encode("utf-8")).hexdigest()[:16], text
+
+#%% Batch query
+
+def batchList(body, field, kind, required=False):
+    ''' Validate one list of a batch request body. '''
+    values = body.get(field) or []
+    if not isinstance(values, list) or not all(isinstance(v, kind) and not isinstance(v, bool) for v in values):
+        raise QueryError("Bad request - {} must be a list of {}.".format(field, "integers" if kind is int else "strings"))
+    if required and not values:
+        raise QueryError("Bad request - Please provide at least one value in {}.".format(field))
+    if len(values) > batch_max_items:
+        raise QueryError("Bad request - {} can hold at most {} values.".format(field, batch_max_items))
+    if kind is str:
+        values = [v.lower() for v in values]
+    # Drop duplicates, keep order
+    return list(dict.fromkeys(values))
+
+
+def parseBatch(body):
+    ''' Validate and normalise the JSON body of a batch request:
+
+        {"lenses": ["consumption", ...], "regions": ["at", ...],
+         "years": [2022, ...], "stressors": [...], "sectors": [...]}
+
+    Lenses and regions are required, and at least one of years, stressors
+    or sectors must be given. Returns a dictionary of normalised lists. '''
+
+    if not isinstance(body, dict):
+        raise QueryError("Bad request - The request body must be a JSON object.")
+
+    batch = {"lenses":    batchList(body, "lenses", str, required=True),
+             "regions":   batchList(body, "regions", str, required=True),
+             "years":     batchList(body, "years", int),
+             "stressors": batchList(body, "stressors", str),
+             "sectors":   batchList(body, "sectors", str)}
+
+    for lens in batch["lenses"]:
+        tableExtension(lens)
+    if not (batch["years"] or batch["stressors"] or batch["sectors"]):
+        raise QueryError("Bad request - Please check that you have at least provided a year(s), sector(s), or stressor(s).")
+
+    # Names were lowercased by batchList(). Unknown ones never reach the
+    # database, where a missing regional table would fail the whole batch.
+    for region in batch["regions"]:
+        dimensions.check("region", region)
+    for stressor in batch["stressors"]:
+        dimensions.check("stressor", stressor)
+    for sector in batch["sectors"]:
+        dimensions.check("sector", sector)
+
+    return batch
+
+
+def buildBatchQuery(batch, limit=None):
+    ''' Plan a whole batch (see parseBatch()) as one SQL statement, instead
+    of one query per lens, region and filter value. Each list becomes an
+    = ANY(%s) array filter. The regional layout reads the tables of all
+    lens/region pairs in one UNION ALL.
+
+    Rows carry a lens column (dcba/dpba) for grouping. Returns a
+    (query, params) tuple. '''
+
+    tblexts = [tableExtension(lens) for lens in batch["lenses"]]
+
+    if storage_layout == "partitioned":
+        conditions = ['e.lens = ANY(%s)', 'e.region_id = ANY(%s)']
+        params     = [tblexts, [dimensions.key("region", region) for region in batch["regions"]]]
+        if batch["years"]:
+            conditions.append('e.year = ANY(%s)')
+            params.append(batch["years"])
+        if batch["stressors"]:
+            conditions.append('e.stressor_id = ANY(%s)')
+            params.append([dimensions.key("stressor", name) for name in batch["stressors"]])
+        if batch["sectors"]:
+            conditions.append('e.sector_id = ANY(%s)')
+            params.append([dimensions.key("sector", name) for name in batch["sectors"]])
+
+        query = ("SELECT e.lens, s.name AS stressor, c.name AS sector, r.name AS region, e.value, e.year "
+                 + emissions_from + ' WHERE ' + ' AND '.join(conditions))
+    else:
+        conditions = []
+        filters    = []
+        for column, field in (("year", "years"), ("stressor", "stressors"), ("sector", "sectors")):
+            if batch[field]:
+                conditions.append('{} = ANY(%s)'.format(column))
+                filters.append(batch[field])
+
+        parts  = []
+        params = []
+        for tblext in tblexts:
+            for region in batch["regions"]:
+                parts.append("""(SELECT '{0}' AS lens, stressor, sector, region, value, year FROM {1} WHERE {2})""".format(
+                                 tblext, quoteIdentifier("{}_{}".format(region, tblext)), ' AND '.join(conditions)))
+                params += filters
+        query = ' UNION ALL '.join(parts)
+
+    if limit:
+        # Ordered, so a capped batch returns the same rows every time
+        query += ' ORDER BY lens, region, year, stressor, sector LIMIT {:d}'.format(limit)
+
+    return query + ';', params
+
+def groupBatch(batch, record):
+    ''' Group the rows of a batch query by lens and region, keeping at most
+    batch_row_cap rows. Returns (grouped, truncated). '''
+
+    truncated = len(record) > batch_row_cap
+    record    = record[:batch_row_cap]
+
+    lens_names = {tblext: lens for lens, tblext in lens_tables.items()}
+    grouped = {lens: {region: [] for region in batch["regions"]} for lens in batch["lenses"]}
+    for row in record:
+        grouped[lens_names[row.pop("lens")]][row["region"]].append(row)
+
+    return grouped, truncated
+
+#%% Aggregate query
+
+def buildAggregateQuery(lens, by, stressor, year=None, member=None):
+    ''' Totals of one stressor summed over sectors (by="region"), over
+    regions (by="sector") or over region groups (by="group"), with each
+    total's share of the sum over all members. Served from the materialised
+    views, so the cost does not depend on how many rows were summed.
+
+    member restricts the result to one region, sector or group. Returns a
+    (query, params) tuple. '''
+
+    tblext = tableExtension(lens)
+
+    if by not in aggregate_views:
+        raise QueryError("Bad request - Aggregates are available by: {}.".format(", ".join(aggregate_views)))
+    if not stressor:
+        raise QueryError("Bad request - Please provide the stressor to aggregate.")
+
+    # Unknown names never reach the database, as in checkEmissionsFilter()
+    dimensions.check("stressor", stressor)
+    if member and by in ("region", "sector"):
+        dimensions.check(by, member.lower())
+
+    view, column = aggregate_views[by]
+
+    conditions = ['lens=%s', 'stressor=%s']
+    params     = [tblext, stressor]
+    if year:
+        conditions.append('year=%s')
+        params.append(year)
+
+    # Shares are taken over every member before member is filtered
+    query = """SELECT {0} AS "{1}", stressor, year, total,
+                      total / NULLIF(SUM(total) OVER (PARTITION BY stressor, year), 0) AS share
+               FROM {2} WHERE {3}""".format(column, by, view, ' AND '.join(conditions))
+
+    if member:
+        query   = 'SELECT * FROM ({}) a WHERE "{}"=%s'.format(query, by)
+        params.append(member.lower())
+
+    return query + ' ORDER BY year, "{}";'.format(by), params
+
+#%% Pagination cursors
+
+def encodeCursor(row):
+    ''' Opaque token pointing just past row, for the next page. '''
+    key = json.dumps([row["year"], row["stressor"], row["sector"]])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decodeCursor(token):
+    ''' Turn a token from encodeCursor() back into (year, stressor, sector). '''
+    if not token:
+        return None
+    try:
+        year, stressor, sector = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return int(year), str(stressor), str(sector)
+    except (ValueError, TypeError, binascii.Error, UnicodeError):
+        raise QueryError("Bad request - The cursor is not valid, please use the next_cursor of the previous page.")
+
+
+def splitPage(record, limit):
+    ''' Pages are fetched with one extra row, to tell whether another page
+    follows. Returns the page and the cursor of the next one (or None). '''
+    if len(record) > limit:
+        record = record[:limit]
+        return record, encodeCursor(record[-1])
+    return record, None
+
+
+def pageSize(limit):
+    ''' Validate the page size requested by a client. '''
+    if limit is None:
+        return page_size
+    if not 1 <= limit <= max_page_size:
+        raise QueryError("Bad request - limit must be between 1 and {}.".format(max_page_size))
+    return limit
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared setup of the tests.
+
+The modules read their settings from config.py with getattr() defaults.
+The tests run against an empty config module, so every setting takes its
+default whatever the local config.py holds, and no database is needed.
+"""
+
+import os
+import sys
+import types
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.modules["config"] = types.ModuleType("config")
+
+
+@pytest.fixture
+def dimensions():
+    ''' A small set of known names for queries.dimensions, restored after
+    the test. '''
+    import queries
+
+    keys = {"region":   {"at": 1, "be": 2, "de": 3},
+            "stressor": {"co2_-_combustion_-_air": 1, "ch4_-_combustion_-_air": 2},
+            "sector":   {"cultivation_of_paddy_rice": 1, "cultivation_of_wheat": 2}}
+
+    saved = queries.dimensions.keys, queries.dimensions.version
+    queries.dimensions.update(keys, queries.datasetVersion())
+    yield keys
+    queries.dimensions.update(*saved)
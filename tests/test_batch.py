@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+POST /v1/batch: validation of the body, and the order and cap of the query.
+"""
+
+import pytest
+import queries
+
+
+def body(**fields):
+    base = {"lenses": ["consumption"], "regions": ["at"], "years": [2019]}
+    base.update(fields)
+    return base
+
+
+def test_batch_is_normalised(dimensions):
+    batch = queries.parseBatch(body(lenses=["production", "consumption"], regions=["AT", "be", "at"],
+                                    stressors=["CO2_-_combustion_-_air"]))
+    assert batch == {"lenses":    ["production", "consumption"],
+                     "regions":   ["at", "be"],
+                     "years":     [2019],
+                     "stressors": ["co2_-_combustion_-_air"],
+                     "sectors":   []}
+
+
+@pytest.mark.parametrize("fields", [{"regions": ["zz"]},
+                                    {"stressors": ["not_a_stressor"]},
+                                    {"sectors": ["not_a_sector"]},
+                                    {"lenses": ["neither"]},
+                                    {"regions": []},
+                                    {"regions": "at"},
+                                    {"years": [True]},
+                                    {"years": [], "stressors": [], "sectors": []}])
+def test_bad_batch_is_rejected(dimensions, fields):
+    with pytest.raises(queries.QueryError) as e:
+        queries.parseBatch(body(**fields))
+    assert e.value.status == 400
+
+
+def test_body_must_be_an_object():
+    with pytest.raises(queries.QueryError):
+        queries.parseBatch(["at"])
+
+
+def test_too_many_values(dimensions):
+    with pytest.raises(queries.QueryError):
+        queries.parseBatch(body(years=list(range(queries.batch_max_items + 1))))
+
+
+@pytest.mark.parametrize("layout", ["regional", "partitioned"])
+def test_capped_batch_is_ordered(dimensions, monkeypatch, layout):
+    monkeypatch.setattr(queries, "storage_layout", layout)
+    batch = queries.parseBatch(body(lenses=["consumption", "production"], regions=["be", "at"]))
+
+    query, params = queries.buildBatchQuery(batch, limit=queries.batch_row_cap + 1)
+
+    assert query.endswith(" ORDER BY lens, region, year, stressor, sector LIMIT {:d};".format(queries.batch_row_cap + 1))
+    assert query.count("%s") == len(params)
+
+
+def test_regional_batch_reads_every_lens_and_region(dimensions, monkeypatch):
+    monkeypatch.setattr(queries, "storage_layout", "regional")
+    batch = queries.parseBatch(body(lenses=["consumption", "production"], regions=["be", "at"]))
+
+    query, params = queries.buildBatchQuery(batch)
+
+    for table in ("be_dcba", "at_dcba", "be_dpba", "at_dpba"):
+        assert '"{}"'.format(table) in query
+    assert "LIMIT" not in query
+    assert params == [[2019]] * 4
+
+
+def test_group_batch_caps_rows():
+    batch = {"lenses": ["consumption"], "regions": ["at", "be"]}
+    record = [{"lens": "dcba", "region": "at" if i % 2 else "be", "value": i}
+              for i in range(queries.batch_row_cap + 1)]
+
+    grouped, truncated = queries.groupBatch(batch, record)
+
+    assert truncated
+    assert sum(len(rows) for rows in grouped["consumption"].values()) == queries.batch_row_cap
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Validators of conditional GETs (ETag, Last-Modified and 304s).
+"""
+
+import queries
+
+
+def test_etag_ignores_argument_order_and_empty_values():
+    first,  _ = queries.validators("/v1/consumption/at", [("year", "2019"), ("stressor", "co2")])
+    second, _ = queries.validators("/v1/consumption/at", [("stressor", "co2"), ("sector", ""), ("year", "2019")])
+    other,  _ = queries.validators("/v1/consumption/at", [("year", "2020"), ("stressor", "co2")])
+
+    assert first == second
+    assert first != other
+    assert first.startswith('"') and first.endswith('"')
+
+
+def test_if_none_match():
+    etag = '"abc"'
+    assert queries.notModified(etag, None, '"abc"', None)
+    assert queries.notModified(etag, None, 'W/"abc"', None)
+    assert queries.notModified(etag, None, '"x", "abc"', None)
+    assert queries.notModified(etag, None, "*", None)
+    assert not queries.notModified(etag, None, '"abd"', None)
+
+
+def test_if_none_match_accepts_compressed_variants():
+    assert queries.notModified('"abc"', None, '"abc-gzip"', None)
+    assert queries.notModified('"abc"', None, 'W/"abc-br"', None)
+
+
+def test_if_none_match_takes_precedence_over_if_modified_since():
+    last_modified = "Sun, 18 Oct 2026 12:00:00 GMT"
+    assert not queries.notModified('"abc"', last_modified, '"old"', last_modified)
+
+
+def test_if_modified_since():
+    last_modified = "Sun, 18 Oct 2026 12:00:00 GMT"
+    assert queries.notModified('"abc"', last_modified, None, last_modified)
+    assert queries.notModified('"abc"', last_modified, None, "Mon, 19 Oct 2026 12:00:00 GMT")
+    assert not queries.notModified('"abc"', last_modified, None, "Sat, 17 Oct 2026 12:00:00 GMT")
+    assert not queries.notModified('"abc"', last_modified, None, "not a date")
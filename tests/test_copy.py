@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+COPY encoders of functions.py: the binary rows must decode to the columns
+they were built from.
+"""
+
+import struct
+import numpy as np
+import pandas as pd
+import functions as f
+
+
+def decodeBinary(data, types):
+    ''' Rows of a Postgres binary COPY stream, with the fields given as
+    struct formats (None for text). '''
+    assert data[:11] == b"PGCOPY\n\xff\r\n\x00"
+    position = 19
+    rows = []
+    while True:
+        (num_fields,) = struct.unpack_from(">h", data, position)
+        position += 2
+        if num_fields == -1:
+            break
+        assert num_fields == len(types)
+        row = []
+        for fmt in types:
+            (length,) = struct.unpack_from(">i", data, position)
+            position += 4
+            if length == -1:
+                row.append(None)
+                continue
+            field = data[position:position + length]
+            position += length
+            row.append(field.decode("utf-8") if fmt is None else struct.unpack(fmt, field)[0])
+        rows.append(tuple(row))
+    assert position == len(data)
+    return rows
+
+
+def test_binary_rows_match_the_columns():
+    df = pd.DataFrame({"stressor": ["co2", "ch4", "co2", "n2o_é"],
+                       "sector":   ["rice", "rice", "wheat", "wheat"],
+                       "value":    [1.5, -2.0, 0.0, 1e300],
+                       "year":     np.array([2019, 2019, 2020, 2020], dtype=np.int16)})
+
+    columns = f.frameToColumns(df)
+    data    = b"".join(f.binaryChunks(columns, batch_size=3))
+
+    assert decodeBinary(data, [None, None, ">d", ">h"]) == list(df.itertuples(index=False, name=None))
+
+
+def test_binary_batches_do_not_change_the_stream():
+    df = pd.DataFrame({"stressor": ["a", "bb", "ccc"] * 5,
+                       "value":    np.arange(15, dtype=np.float64)})
+    columns = f.frameToColumns(df)
+
+    whole   = b"".join(f.binaryChunks(columns, batch_size=100))
+    batched = b"".join(f.binaryChunks(columns, batch_size=4))
+
+    assert whole == batched
+
+
+def test_binary_missing_label_is_null():
+    columns = [("stressor", np.array([0, -1, 1]), np.array(["co2", "ch4"], dtype=object)),
+               ("value",    np.array([1.0, 2.0, 3.0]), None)]
+    data = b"".join(f.binaryChunks(columns, batch_size=10))
+
+    assert decodeBinary(data, [None, ">d"]) == [("co2", 1.0), (None, 2.0), ("ch4", 3.0)]
+
+
+def test_empty_columns_give_header_and_trailer_only():
+    columns = [("value", np.array([], dtype=np.float64), None)]
+    assert decodeBinary(b"".join(f.binaryChunks(columns, batch_size=10)), [">d"]) == []
+
+
+def test_csv_rows_match_the_columns():
+    df = pd.DataFrame({"stressor": ["co2", "ch4", "co2"],
+                       "value":    [1.5, 2.0, 3.25]})
+    data = b"".join(f.csvChunks(f.frameToColumns(df), batch_size=2))
+
+    assert data.decode("utf-8").splitlines() == ["co2,1.5", "ch4,2.0", "co2,3.25"]
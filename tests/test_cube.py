@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cube read path: row order, keyset continuation and batch capping, which
+must agree with the SQL queries.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import functions as f
+import cube
+import queries
+
+
+def matrix(year):
+    ''' EmissionsMatrix whose labels are stored out of order. '''
+    columns = pd.MultiIndex.from_product([["DE", "AT"], ["Wheat", "Rice", "Maize"]], names=["region", "sector"])
+    values  = np.arange(18, dtype=np.float64).reshape(3, 6) + year
+    return f.EmissionsMatrix(pd.DataFrame(values, index=["n2o", "co2", "ch4"], columns=columns), year)
+
+
+@pytest.fixture
+def store(tmp_path):
+    writer = cube.CubeWriter(str(tmp_path), doi="test")
+    for year in (2020, 2019):
+        for tblext in ("dpba", "dcba"):
+            writer.write(matrix(year), tblext)
+    writer.publish()
+    return cube.CubeStore(str(tmp_path))
+
+
+def key(row):
+    return (row["year"], row["stressor"], row["sector"])
+
+
+def test_ordered_rows_follow_the_sql_order(store):
+    rows = list(store.iterRows("dcba", ["at"], ordered=True))
+    assert [key(row) for row in rows] == sorted(key(row) for row in rows)
+    assert len(rows) == 2 * 3 * 3
+
+
+def test_rows_hold_the_stored_values(store):
+    rows = store.iterRows("dpba", ["at"], [2019], ["co2"], ["rice"])
+    # co2 is the second stressor, AT the second region, rice its second sector
+    assert list(rows) == [{"stressor": "co2", "sector": "rice", "region": "at",
+                           "value": 6.0 + 4 + 2019, "year": 2019}]
+
+
+def test_after_continues_past_the_key(store):
+    rows  = list(store.iterRows("dcba", ["at"], ordered=True))
+    after = key(rows[6])
+    rest  = list(store.iterRows("dcba", ["at"], ordered=True, after=after))
+    assert rest == rows[7:]
+
+
+def test_pages_cover_every_row_once(store):
+    rows  = list(store.iterRows("dcba", ["at"], ordered=True))
+    pages = []
+    after = None
+    while True:
+        page = store.emissions("consumption", "at", limit=4, after=after,
+                               ordered=True, require_filter=False)
+        if not page:
+            break
+        pages += page
+        after = key(page[-1])
+    assert pages == rows
+
+
+def test_capped_batch_matches_the_sql_order(store):
+    batch = {"lenses": ["production", "consumption"], "regions": ["de", "at"],
+             "years": [], "stressors": [], "sectors": []}
+
+    rows  = store.batch(batch, limit=10)
+    every = store.batch(batch)
+
+    order = lambda row: (row["lens"], row["region"], row["year"], row["stressor"], row["sector"])
+    assert [order(row) for row in every] == sorted(order(row) for row in every)
+    assert rows == every[:10]
+    assert rows[0]["lens"] == "dcba" and rows[0]["region"] == "at"
+
+
+def test_unpublished_cube_is_unavailable(tmp_path):
+    store = cube.CubeStore(str(tmp_path))
+    with pytest.raises(queries.QueryError) as e:
+        store.refresh()
+    assert e.value.status == 503
+
+    # An empty CURRENT is the same as none
+    open(os.path.join(str(tmp_path), "CURRENT"), "w").close()
+    with pytest.raises(queries.QueryError) as e:
+        store.refresh()
+    assert e.value.status == 503
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Response encoding: compressed ETag variants, NDJSON lines, content coding
+negotiation and the columnar layout.
+"""
+
+import json
+import decimal
+import pytest
+import encoding
+
+
+def test_variant_etag():
+    assert encoding.variantETag('"abc"', "gzip") == '"abc-gzip"'
+    assert encoding.variantETag('"abc"', "br") == '"abc-br"'
+    assert encoding.variantETag(None, "gzip") is None
+
+
+def test_304_repeats_the_etag_the_client_holds():
+    etag = '"abc"'
+    # Uncompressed 200 (small or not compressible): the plain ETag
+    assert encoding.revalidatedETag(etag, '"abc"', "gzip") == '"abc"'
+    # Compressed 200: its variant
+    assert encoding.revalidatedETag(etag, '"abc-gzip"', "gzip") == '"abc-gzip"'
+    assert encoding.revalidatedETag(etag, 'W/"abc-br"', "gzip") == '"abc-br"'
+    # Without If-None-Match, the plain ETag
+    assert encoding.revalidatedETag(etag, None, "br") == '"abc"'
+
+
+@pytest.mark.parametrize("accept, coding", [("gzip", "gzip"),
+                                            ("gzip;q=0, deflate", None),
+                                            ("", None),
+                                            (None, None),
+                                            ("identity", None)])
+def test_negotiate_gzip(monkeypatch, accept, coding):
+    monkeypatch.setattr(encoding, "brotli", None)
+    assert encoding.negotiate(accept) == coding
+
+
+def test_compressible():
+    assert encoding.compressible("application/json", encoding.compress_min_size)
+    assert encoding.compressible("application/json", None)
+    assert not encoding.compressible("application/json", encoding.compress_min_size - 1)
+    assert not encoding.compressible("application/vnd.apache.parquet", 1 << 20)
+
+
+def test_ndjson_lines_are_valid_json():
+    rows  = [{"value": float("nan"), "year": 2019}, {"value": float("inf"), "total": decimal.Decimal("1.5")}]
+    lines = encoding.ndjsonLines(rows).splitlines()
+
+    assert [json.loads(line) for line in lines] == [{"value": None, "year": 2019},
+                                                    {"value": None, "total": "1.5"}]
+
+
+def test_ndjson_lines_without_orjson(monkeypatch):
+    monkeypatch.setattr(encoding, "orjson", None)
+    rows = [{"value": float("nan"), "total": decimal.Decimal("1.5")}]
+    assert json.loads(encoding.ndjsonLines(rows)) == {"value": None, "total": "1.5"}
+
+
+def test_columnar_layout_round_trip():
+    rows = [{"stressor": "co2", "region": "at", "value": 1.0},
+            {"stressor": "ch4", "region": "at", "value": 2.0}]
+    data = encoding.columnar(rows)
+
+    assert data["rows"] == 2
+    assert data["constants"] == {"region": "at"}
+    assert data["columns"] == {"stressor": ["co2", "ch4"], "value": [1.0, 2.0]}
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Region exports: the pre-built files and the ones built from the database
+share one schema.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import functions as f
+import queries
+
+pyarrow = pytest.importorskip("pyarrow")
+
+
+def test_prebuilt_and_database_exports_share_a_schema():
+    columns = pd.MultiIndex.from_product([["AT", "BE"], ["Rice", "Wheat"]], names=["region", "sector"])
+    df      = pd.DataFrame(np.arange(8, dtype=np.float64).reshape(2, 4), index=["co2", "ch4"], columns=columns)
+
+    prebuilt = f.regionToArrow(f.EmissionsMatrix(df, 2019)["at"])
+    # COPY of the regional table: value before year
+    database = queries.readExportCSV(b"stressor,sector,region,value,year\nco2,rice,at,0.0,2019\n")
+
+    assert prebuilt.schema.equals(queries.exportSchema())
+    assert database.schema.equals(queries.exportSchema())
+    assert database.to_pylist() == prebuilt.slice(0, 1).to_pylist()
+
+
+@pytest.mark.parametrize("layout", ["regional", "partitioned"])
+def test_export_query_selects_the_schema_columns(dimensions, monkeypatch, layout):
+    monkeypatch.setattr(queries, "storage_layout", layout)
+    query, params = queries.buildExportQuery("consumption", "AT", 2019)
+
+    assert query.startswith('SELECT "stressor", "sector", "region", "year", "value" FROM (')
+    assert params[-1] == 2019
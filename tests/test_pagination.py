@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keyset pagination of the production lens: cursor tokens and page splits.
+"""
+
+import pytest
+import queries
+
+
+def row(year, stressor, sector, value=1.0):
+    return {"stressor": stressor, "sector": sector, "region": "at", "value": value, "year": year}
+
+
+def test_cursor_round_trip():
+    token = queries.encodeCursor(row(2019, "co2_-_combustion_-_air", "cultivation_of_wheat"))
+    assert queries.decodeCursor(token) == (2019, "co2_-_combustion_-_air", "cultivation_of_wheat")
+
+
+def test_cursor_is_url_safe():
+    token = queries.encodeCursor(row(2019, "é?/+", "a&b=c"))
+    assert all(c.isalnum() or c in "-_=" for c in token)
+    assert queries.decodeCursor(token) == (2019, "é?/+", "a&b=c")
+
+
+def test_no_cursor_is_the_first_page():
+    assert queries.decodeCursor(None) is None
+    assert queries.decodeCursor("") is None
+
+
+@pytest.mark.parametrize("token", ["not base64!", "bm90IGpzb24=", "WzEsIDJd", "WyJ4IiwgImEiLCAiYiJd"])
+def test_bad_cursor_is_rejected(token):
+    # garbage, "not json", [1, 2] and ["x", "a", "b"]
+    with pytest.raises(queries.QueryError) as e:
+        queries.decodeCursor(token)
+    assert e.value.status == 400
+
+
+def test_split_page_with_more_rows():
+    record = [row(2019, "a", str(i)) for i in range(4)]
+    page, cursor = queries.splitPage(record, 3)
+    assert page == record[:3]
+    assert queries.decodeCursor(cursor) == (2019, "a", "2")
+
+
+def test_split_last_page():
+    record = [row(2019, "a", str(i)) for i in range(3)]
+    assert queries.splitPage(record, 3) == (record, None)
+    assert queries.splitPage([], 3) == ([], None)
+
+
+def test_page_size():
+    assert queries.pageSize(None) == queries.page_size
+    assert queries.pageSize(5) == 5
+    for limit in (0, queries.max_page_size + 1):
+        with pytest.raises(queries.QueryError):
+            queries.pageSize(limit)
+
+
+def test_after_cursor_continues_in_key_order(dimensions):
+    query, params = queries.buildEmissionsQuery("production", "AT", after=(2019, "a", "b"),
+                                                limit=3, require_filter=False)
+    assert "(year, stressor, sector) > (%s, %s, %s)" in query
+    assert query.rstrip(";").endswith("ORDER BY year, stressor, sector LIMIT %s")
+    assert params == [2019, "a", "b", 3]